@@ -4,148 +4,64 @@ import numpy as np
 import dash
 from dash import dcc
 from dash import html
+from dash import Patch
 from dash.dependencies import Input, Output, State
 import base64
 import io
-from scipy import optimize
+import os
+import uuid
 import dash_bootstrap_components as dbc
 
 from dash import dash_table
-from mvgavg import mvgavg
 
+#the fitting functions live in ojip_core, re-exported here for the scripts importing OJIP_fit
+from ojip_core import *  # noqa: F401,F403
+from jobs import JobQueue
+from plotting import decimate_log
+from live import live_fits, open_source
+from imaging import intensity_maps
+from results import default_store, fit_record
+from autotune import autotune
+from api import register_api
 
+#fits run as background jobs, one live job per browser session
+fit_jobs = JobQueue(max_workers = int(os.environ.get("OJIP_FIT_WORKERS", 2)))
 
-x = np.linspace(0, 10, 50)
-y = np.exp(-x)
-
-df_init = pd.DataFrame(np.array([x,y]).T, columns = ["time", "fluorescence"])
-df_init=df_init.to_dict()
-
-
-
-def pre_process(time_array, fluo, N_mvg = 10, N_log = 1000 ):
-    #remove blank
-    blank = np.mean(fluo[0:10])
-    fluo = fluo-blank
-
-    #stop at max
-    #stop_fluo = int(np.argmax(fluo))
-    #fluo = fluo[0:stop_fluo]
-    #time_array = time_array[0:stop_fluo]
-
-    #normalise
-    fluo_ref = fluo/fluo.max()    
-
-    #collect the fluorescence rise: during the jump of light
-    ind_ref = (fluo_ref>0.1)
-    #perform moving average
-    binit = True
-    t = mvgavg(time_array[ind_ref], N_mvg, binning = binit)
-    y = mvgavg(fluo[ind_ref], N_mvg, binning = binit)
-    
-    # start at 0
-    t-=t[0]
-    
-    #logarithmic subsampling to accelerate the fit
-    ind= np.unique(np.logspace(np.log10(1), np.log10(len(t)-1), N_log).astype(int))
-    t = t[ind]
-    y = y[ind]
-
-    return t, y
-
-
-def sigmoidal_OJIP(parameters, tdata):
-    F0 = parameters[0]
-    Aoj = parameters[1]
-    koj = parameters[2]
-    soj = parameters[3]
-    Aji = parameters[4]
-    kji = parameters[5]
-    sji = parameters[6]
-    Aip = parameters[7]
-    kip = parameters[8]
-    sip = parameters[9]
-    y = F0 + Aoj*(1-np.exp(-koj*tdata))**soj + Aji*(1-np.exp(-kji*tdata))**sji +  Aip*(1-np.exp(-kip*tdata))**sip
-    
-    return y
-     
-def multiexp_fit(t, y):
-    """ triexponential sigmoidal fit of the fluorescence rise based on Joly & Carpentier 2009"""
-
-    #initial parameters based on Joly & Carpentier, 2009
-    dF = y.max()-y.min()
-    x0 = [y.min(), dF/2, 5E3, 1.24, dF/4, 0.06E3, 1.2, dF/4, 0.0023E3, 8.2]
-
-    parameters_estimated = optimize.least_squares(residuals,  x0, bounds = ([-1e5,-1e5, 0, 1,-1e5, 0, 1,-1e5, 0, 1], [1e5,1e5, 1e5, 20,1e5, 1e5, 20,1e5, 1e5, 20]),
-                                args = (t, y, sigmoidal_OJIP))
-    
-    #recover the characteristic time of the first phase (O-J)
-    tau = 1/parameters_estimated.x[2]
-    
-    ypred = sigmoidal_OJIP(parameters_estimated.x, t)
-    
-    return tau, ypred
-    
-
-
-def get_fit(t, y):    
-    time_spread = t.max()-t.min()
-    start = np.mean(y[0])
-    stop = np.mean(y[-10:])
-    x0 = [start, 1/time_spread, stop]
-    t = t-t[0]
-
-    parameters_estimated = optimize.least_squares(residuals,  x0, bounds = (-1e8,1e8),
-                                args = (t, y, exp_decay))
-
-    tau = parameters_estimated.x[1]
-
-    pos_tau = find_nearest(t, tau)
-
-    x0 = parameters_estimated.x #initial guess: parameters from previous fit
-    #second fit
-    parameters_estimated  = optimize.least_squares(residuals,  x0, bounds = (-1e9,1e9),
-                                            args = (t[0:int(pos_tau*5)], y[0: int(pos_tau*5)], exp_decay))
-
-    return  parameters_estimated.x
-
+#optional residual bootstrap of the confidence intervals, over a process pool
+BOOTSTRAP_SAMPLES = int(os.environ.get("OJIP_BOOTSTRAP_SAMPLES", 200))
+BOOTSTRAP_SECONDS = float(os.environ.get("OJIP_BOOTSTRAP_SECONDS", 10))
+BOOTSTRAP_WORKERS = int(os.environ["OJIP_BOOTSTRAP_WORKERS"]) if "OJIP_BOOTSTRAP_WORKERS" in os.environ else None
 
-def find_nearest(array, value):
-    array = np.asarray(array)
-    idx = (np.abs(array - value)).argmin()
-    return idx
+#live acquisition reads files and sockets of the server: only offered with OJIP_LIVE=1
+LIVE = bool(os.environ.get("OJIP_LIVE"))
+LIVE_INTERVAL = float(os.environ.get("OJIP_LIVE_INTERVAL", 1))
 
+#profiling slows the next fit down for any client: /debug/profile only exists with OJIP_PROFILE=1
+PROFILE = bool(os.environ.get("OJIP_PROFILE"))
 
+#the last fit of each file is kept in the results store (OJIP_RESULTS_DB, empty to disable), which also answers
+#resubmissions; its database is only created by the first fit
+results_store = default_store()
+SETUP = os.environ.get("OJIP_SETUP", "default")
 
-    
-def exp_decay(parameters, xdata):
-    '''
-    Calculate an exponential decay of the form:
-    S = a * exp(-xdata/b)
-    '''
-    A = parameters[0]
-    tau = parameters[1]
-    y0 = parameters[2]
-    return A * (1 - np.exp(-xdata/tau))**1.24 + y0
+x = np.linspace(0, 10, 50)
+y = np.exp(-x)
 
+df_init = pd.DataFrame(np.array([x,y]).T, columns = ["time", "fluorescence"])
 
-def residuals(parameters, x_data, y_observed, func):
-    '''
-    Compute residuals of y_predicted - y_observed
-    where:
-    y_predicted = func(parameters,x_data)
-    '''
-    return func(parameters,x_data) - y_observed
 
 
+# cached stages of update_fit
+pipeline = FitPipeline()
 
-# Define a function to calculate the value based on the selected component
-def calculate_value(sigma, params):
-    # Replace this with your own calculation logic based on the chemical and wavelength
-    return 1e6/(sigma*params[1])
+df_init = store_table(df_init.to_csv(index=False).encode(), "init.csv")
 
 # Create the Dash app instance
 app = dash.Dash(external_stylesheets=[dbc.themes.BOOTSTRAP])
+#request timings on /metrics, /debug/profile profiles the next fit (with OJIP_PROFILE=1)
+telemetry.instrument_server(app.server, profile = PROFILE)
+#fits of the acquisition software on /api/fit, sharing the cached stages of the app
+register_api(app.server, pipeline)
 
 # Define the layout of the app
 
@@ -165,6 +81,9 @@ controls = dbc.Card(
             value = 470,
                 ),
 
+        html.Div(html.Strong('Setup:'), style={'margin-top': '10px'}),
+        dcc.Input(id='setup-name', type='text', debounce=True, value=SETUP),
+
         html.Div(id='output-container', 
                                 children=[html.Div('Sigma (m²/mol):', style={'font-weight': 'bold', 'margin-right': '10px', "color":"darkred"})]),
         html.Div(id='sigma-value', 
@@ -206,6 +125,13 @@ controls = dbc.Card(
                             },
                             multiple=False,    
                         ),
+
+        html.Div(id='live-controls', hidden=not LIVE,
+                 children=[html.Strong('Or follow a recording: '),
+                           dcc.Input(id='live-source', type='text', debounce=True,
+                                     placeholder='file being written, named pipe, tcp:host:port or unix:path',
+                                     style={'width': '60%'}),
+                           html.Button('Follow', id='live-button', n_clicks=0, style={'margin': '10px'})]),
            
 
     html.Div(id='output-container3', 
@@ -226,7 +152,11 @@ controls = dbc.Card(
 
     html.Div(id='intensity-value-watt', 
                 style={'display': 'inline-block', 'font-size': '24px', 'vertical-align': 'middle'},
-                )  
+                ),
+    html.Div(id='output-container6', 
+                    children=[html.Div('JIP test:', style={'font-weight': 'bold', 'margin-right': '10px'})]),
+
+    html.Div(id='jip-values', style={'font-size': '18px'}),
     ]   
 )
             
@@ -247,7 +177,9 @@ loading =  dbc.Card(
         dcc.Loading(
                 id="loading2",
                 type="graph",
-                children=[dcc.Store(id='fit-store', data = "None")],
+                children=[dcc.Store(id='fit-store', data = "None"),
+                          dcc.Store(id='fit-job', data = None),
+                          dcc.Store(id='session-id', data = None, storage_type = 'session')],
                 style={
                                 'width': '80%',
                                 'height': '60px',
@@ -289,6 +221,14 @@ graph =  html.Div([
                 placeholder="Select Y-axis Column",
                 style={'margin': '10px'}
             ),
+            dcc.Dropdown(
+                id='y-multi-dropdown',
+                options=[],
+                value=[],
+                multi=True,
+                placeholder="Fit several Y columns together (replicates)",
+                style={'margin': '10px'}
+            ),
 
             html.Div(id='select-smooth', 
                                 children=[html.Div('Select the smoothing window size and logarithmic subsampling:', style={'font-weight': 'bold', 'margin-right': '10px',
@@ -309,6 +249,28 @@ graph =  html.Div([
                 value = 10000,
                 ),
 
+            html.Button('Auto-tune', id='autotune-button', n_clicks=0, style={'margin': '10px'}),
+            dcc.Loading(html.Div(id='autotune-status', style={'font-style': 'italic'}), type="dot"),
+
+            dcc.RadioItems(
+                id='preprocess-mode',
+                options=[{'label': ' Moving average + logarithmic subsampling', 'value': 'mvgavg'},
+                         {'label': ' Logarithmic binning (weighted fit, no smoothing window)', 'value': 'logbin'}],
+                value='mvgavg',
+                style={'margin': '10px'}
+                ),
+
+            dcc.Checklist(
+                id='bootstrap-option',
+                options=[{'label': ' Bootstrap the confidence intervals (slower)', 'value': 'bootstrap'}],
+                value=[],
+                style={'margin': '10px'}
+                ),
+
+    html.Div(id='fit-progress', style={'margin': '10px', 'font-style': 'italic'}),
+    dcc.Interval(id='fit-interval', interval=250, disabled=True),
+    dcc.Store(id='plot-state', data=None),
+
     dcc.Graph(id='data-plot',
                     style={
                     #'height': '500px',
@@ -322,6 +284,25 @@ graph =  html.Div([
                 
                     ),
 
+    html.Div(id='multi-fit-table'),
+
+    #tau and intensity maps of an imaging stack, from imaging.py
+    dcc.Upload(id='upload-map',
+               children=html.Div(['Drop the maps of an imaging stack (.npz from imaging.py)']),
+               style={'width': '80%', 'height': '40px', 'lineHeight': '40px', 'borderWidth': '1px',
+                      'borderStyle': 'dashed', 'borderRadius': '5px', 'textAlign': 'center', 'margin': '10px'},
+               multiple=False),
+    dcc.Store(id='map-store', data=None),
+    dcc.RadioItems(id='map-choice',
+                   options=[{'label': ' tau (s)', 'value': 'tau'},
+                            {'label': ' µE/m²/s', 'value': 'eins'},
+                            {'label': ' mW/mm²', 'value': 'watt'}],
+                   value='eins', inline=True, style={'margin': '10px'}),
+    dcc.Graph(id='map-plot', style={'display': 'none'}),
+
+    #calibration history of the setup at the wavelength, from the results store
+    dcc.Graph(id='drift-plot', style={'display': 'none'}),
+
             ])   
 
 
@@ -343,6 +324,12 @@ app.layout = dbc.Container(
 
 )
 
+#optional panel with the timings and solver statistics of the last fits
+DEBUG_PANEL = bool(os.environ.get("OJIP_DEBUG_PANEL"))
+if DEBUG_PANEL:
+    app.layout.children.append(html.Details([html.Summary("Debug"),
+                                             html.Pre(id='debug-panel', style={'font-size': '12px'})]))
+
 
 
 
@@ -356,7 +343,10 @@ def update_output_value(wl):
     if wl is None:
         return ""
     else:
-        return '{:.1e}'.format(sigma_spectra[wavelength==wl][0])
+        sigma = sigma_at(wl)
+        if np.isnan(sigma):
+            return 'no value outside {:.0f}-{:.0f} nm'.format(wavelength[0], wavelength[-1])
+        return '{:.1e}'.format(sigma)
     
 # Define the callback function that updates the output value based on the selected chemical and wavelength
 @app.callback(
@@ -364,10 +354,20 @@ def update_output_value(wl):
     Input('fit-store', 'data')
 )
 def update_tau_value(params):
-    if params is None:
+    if not isinstance(params, dict):
         return ""
+    elif params['params_exp'] is None:
+        #partial result: only the JC fit is done
+        return '{:.1e} (JC fit, exponential fit running)'.format(params['tau_JC'])
+    elif params.get('ci') == 'provisional':
+        return '{:.1e} (provisional, fit running)'.format(params['params_exp'][1])
     else:
-        return '{:.1e}'.format(params['params_exp'][1])
+        return format_interval(params['params_exp'][1], params['tau_ci'], params['ci'])
+
+def format_interval(value, interval, method):
+    if method == 'provisional':
+        return '{:.1e} (provisional)'.format(value)
+    return '{:.1e} (95%: {:.1e} - {:.1e}, {})'.format(value, *interval, method)
         
 @app.callback(
     Output('intensity-value-watt', 'children'),
@@ -376,12 +376,13 @@ def update_tau_value(params):
 
 )
 def update_output_value(dico, wl):
-    if wl is None  or dico is None:
+    if wl is None or not isinstance(dico, dict) or dico['params_exp'] is None:
         return ""
     else:
-        sigma = sigma_spectra[wavelength==wl]
-        value = calculate_value( sigma, dico['params_exp'])[0]
-        return '{:.1e}'.format(value/1000*120/int(wl))
+        value = intensity_values(dico['params_exp'], wl)[1]
+        if dico['tau_ci'] is None:
+            return format_interval(value, None, dico['ci'])
+        return format_interval(value, intensity_intervals(dico['tau_ci'], wl)[1], dico['ci'])
     
 @app.callback(
     Output('intensity-value-eins', 'children'),
@@ -389,12 +390,23 @@ def update_output_value(dico, wl):
     Input('wavelength-dropdown', 'value')
 )
 def update_output_value(dico, wl):
-    if wl is None or dico is None:
+    if wl is None or not isinstance(dico, dict) or dico['params_exp'] is None:
         return ""
     else:
-        sigma = sigma_spectra[wavelength==wl]
-        value = calculate_value(sigma, dico['params_exp'])[0]
-        return '{:.1e}'.format(value)
+        value = intensity_values(dico['params_exp'], wl)[0]
+        if dico['tau_ci'] is None:
+            return format_interval(value, None, dico['ci'])
+        return format_interval(value, intensity_intervals(dico['tau_ci'], wl)[0], dico['ci'])
+
+@app.callback(
+    Output('jip-values', 'children'),
+    Input('fit-store', 'data')
+)
+def update_jip_values(dico):
+    #only the final fit has the JIP-test parameters
+    if not isinstance(dico, dict) or 'jip' not in dico:
+        return ""
+    return " | ".join('{}: {:.3g}'.format(name, dico['jip'][name]) for name in JIP_FIELDS)
 
 """DATA STORAGE"""
 @app.callback(
@@ -407,27 +419,11 @@ def update_storage(contents, filename):
         content_type, content_string = contents.split(',')
         decoded = base64.b64decode(content_string)
         try:
-            if 'csv' in filename:
-                # Assume that the user uploaded a CSV file
-                df = pd.read_csv(io.StringIO(decoded.decode('utf-8')))
+            return store_table(decoded, filename)
 
-            elif 'xls' in filename:
-                # Assume that the user uploaded an Excel file
-                df = pd.read_excel(decoded, engine = 'openpyxl', encoding='ISO-8859-1')
+        except ValueError as e:
+            return html.Div([str(e)])
 
-            elif 'txt' or 'tsv' in filename:
-                # Assume that the user upl, delimiter = '\t'
-                df = pd.read_csv(io.StringIO(decoded.decode('utf-8')), delimiter = '\t')
-            
-            else:
-                return html.Div([
-                    'The uploaded file format is not supported. Please upload a CSV, Excel, TXT or TSV file.'
-                ])
-            
-
-
-            return df.to_dict()
-        
         except Exception as e:
             print(e)
             return html.Div([
@@ -435,6 +431,64 @@ def update_storage(contents, filename):
             ])
 
 
+@app.callback(
+    Output('map-store', 'data'),
+    Input('upload-map', 'contents'),
+)
+def update_map_storage(contents):
+    if contents is None:
+        return None
+    decoded = base64.b64decode(contents.split(',')[1])
+    with np.load(io.BytesIO(decoded), allow_pickle=False) as npz:
+        return {"key": dataset_store.put({"tau": npz["tau"], "mask": npz["mask"]})}
+
+
+@app.callback(
+    Output('map-plot', 'figure'),
+    Output('map-plot', 'style'),
+    Input('map-store', 'data'),
+    Input('map-choice', 'value'),
+    Input('wavelength-dropdown', 'value'),
+)
+def update_map(store, choice, wl):
+    maps = dataset_store.get(store["key"]) if isinstance(store, dict) else None
+    if maps is None or (choice != 'tau' and wl is None):
+        return go.Figure(), {'display': 'none'}
+    #the intensities follow the selected wavelength
+    values = maps["tau"] if choice == 'tau' else intensity_maps(maps, wl)[0 if choice == 'eins' else 1]
+    #at most about 512 values per side are sent to the browser
+    step = max(1, int(np.ceil(max(values.shape)/512)))
+    fig = go.Figure(go.Heatmap(z=np.where(maps["mask"], values, np.nan)[::step, ::step],
+                               colorscale='Viridis', colorbar={'exponentformat': 'e'}))
+    fig.update_layout(plot_bgcolor='white', yaxis={'autorange': 'reversed', 'scaleanchor': 'x'},
+                      title={'tau': 'tau (s)', 'eins': 'Light intensity (µE/m²/s)', 'watt': 'Light intensity (mW/mm²)'}[choice])
+    return fig, {'margin': '10px'}
+
+
+@app.callback(
+    Output('drift-plot', 'figure'),
+    Output('drift-plot', 'style'),
+    Input('fit-store', 'data'),
+    Input('setup-name', 'value'),
+    Input('wavelength-dropdown', 'value'),
+)
+def update_drift(dico, setup, wl):
+    #redrawn after each fit, the indexed query only reads the records of the setup and wavelength
+    records = results_store.history(setup or SETUP, wl) if results_store is not None and wl is not None else []
+    if len(records) < 2:
+        return go.Figure(), {'display': 'none'}
+    dates = pd.to_datetime([r["created"] for r in records], unit='s')
+    eins = np.array([r["intensity_eins"] for r in records], dtype=float)
+    low, high = intensity_intervals(np.array([[r["tau_low"], r["tau_high"]] for r in records], dtype=float).T, wl)[0]
+    fig = go.Figure(go.Scatter(x=dates, y=eins, mode='lines+markers', name='intensity',
+                               error_y=dict(type='data', symmetric=False, array=np.asarray(high) - eins,
+                                            arrayminus=eins - np.asarray(low)),
+                               text=[r["filename"] for r in records]))
+    fig.update_layout(plot_bgcolor='white', title='Calibration history of {} at {} nm'.format(setup or SETUP, wl),
+                      yaxis_title='Light intensity (µE/m²/s)', xaxis=dict(showgrid=False), yaxis=dict(showgrid=False))
+    return fig, {'margin': '10px'}
+
+
 def read_table(df):
         df = pd.DataFrame(df)
         return html.Div([
@@ -463,51 +517,299 @@ def update_table(df):
 @app.callback(
     dash.dependencies.Output('x-axis-dropdown', 'options'),
     dash.dependencies.Output('y-axis-dropdown', 'options'),
+    dash.dependencies.Output('y-multi-dropdown', 'options'),
     dash.dependencies.Input('data-store', 'data')
 )
-def update_dropdowns(df):
-    if df is not None:
-        df = pd.DataFrame(df)
-        x_axis_options = [{'label': col, 'value': col} for col in df.columns]
-        y_axis_options = [{'label': col, 'value': col} for col in df.columns]
-        return x_axis_options, y_axis_options
+def update_dropdowns(store):
+    if store is not None:
+        x_axis_options = [{'label': col, 'value': col} for col in store["columns"]]
+        y_axis_options = [{'label': col, 'value': col} for col in store["columns"]]
+        return x_axis_options, y_axis_options, y_axis_options
     else:
-        return [], []
+        return [], [], []
+
+def fit_job(job, data_key, table, key_time, key_fluo, N_mvg, N_log, mode, bootstrap=False, wl=None, setup=SETUP):
+    """ background job of update_fit, reporting the provisional tau of preview_fit, then the JC fit as partial results
+    with bootstrap, the fit with the covariance intervals is reported before the bootstrap runs
+    a fit already in the results store is not run again, new fits are appended to the store"""
+    preview = {"params_exp": None}
+    def progress(name, partial):
+        if partial is None:
+            job.report("{} done".format(name.replace("_", " ")))
+        elif name == "preview":
+            #no arrays yet: only the tau and intensity fields are updated
+            preview["params_exp"] = [float(v) for v in partial["params_exp"]]
+            job.report("provisional tau, JC fit running",
+                       {"key": None, "points_key": None, "params_exp": preview["params_exp"], "tau_JC": None,
+                        "tau_ci": None, "ci": "provisional"})
+        else:
+            dataset_store.put({"t": partial["t"], "y": partial["y"], "y_JC": partial["y_JC"]}, key = partial["key"])
+            job.report("JC fit done, exponential fit running",
+                       {"key": partial["key"], "points_key": partial["points_key"], "params_exp": preview["params_exp"],
+                        "tau_JC": float(partial["tau_JC"]), "tau_ci": None, "ci": "provisional"})
+
+    settings = dict(input_hash = data_key, time_column = key_time, fluo_column = key_fluo, N_mvg = N_mvg, N_log = N_log,
+                    mode = mode, method = "trf")
+    record = None
+    if results_store is not None:
+        record = results_store.find(ci = "bootstrap" if bootstrap else "covariance", **settings)
+    if record is not None:
+        return stored_fit(record, data_key, table, key_time, key_fluo, N_mvg, N_log, mode)
+    with telemetry.request("fit"):
+        result = pipeline.run(data_key, table, key_time, key_fluo, N_mvg = N_mvg, N_log = N_log, mode = mode,
+                              progress = progress)
+    dataset_store.put({"t": result["t"], "y": result["y"], "y_JC": result["y_JC"]}, key = result["key"])
+    summary = fit_summary(result, result["key"], result["points_key"])
+    if bootstrap:
+        job.report("bootstrap running", summary)
+        boot = bootstrap_fit(result, n_samples = BOOTSTRAP_SAMPLES, time_budget = BOOTSTRAP_SECONDS,
+                             workers = BOOTSTRAP_WORKERS,
+                             progress = lambda done, total: job.report("bootstrap {}/{}".format(done, total)))
+        if boot["n"] >= 2:
+            summary = dict(summary, tau_ci = [float(v) for v in boot["tau_ci"]], ci = "bootstrap n={}".format(boot["n"]))
+    if results_store is not None:
+        #the last fit of the file replaces those of the earlier slider positions in the history
+        results_store.replace(fit_record(dict(result, tau_ci = summary["tau_ci"]), wl, setup = setup or SETUP,
+                                         source = "app", filename = str(table["filename"]), ci = summary["ci"],
+                                         **settings))
+    return summary
+
+
+def stored_fit(record, data_key, table, key_time, key_fluo, N_mvg, N_log, mode):
+    """ summary of a fit from the results store: only the preprocessing runs, the JC curve comes from its parameters"""
+    points_key, (t, y, _) = pipeline.points(data_key, table, key_time, key_fluo, N_mvg, N_log, mode)
+    key = dataset_store.put({"t": t, "y": y, "y_JC": sigmoidal_OJIP(record["params_JC"], t)})
+    return {"key": key, "points_key": points_key, "params_exp": record["params_exp"], "tau_JC": record["tau_JC"],
+            "tau_ci": [record["tau_low"], record["tau_high"]], "ci": record["ci"],
+            "jip": jip_test(record["params_JC"], t, y)}
+
+
+def fit_summary(result, key, points_key):
+    #only the key of the fit arrays and the scalar results go to the browser
+    return {"key": key, "points_key": points_key,
+            "params_exp": [float(v) for v in result["params_exp"]], "tau_JC": float(result["tau_JC"]),
+            "tau_ci": [float(v) for v in result["tau_ci"]], "ci": "covariance", "jip": result["jip"]}
+
+
+def live_job(job, source, key_time, key_fluo, N_log):
+    """ background job following a live source until it ends or the job is cancelled, reporting each refit"""
+    job.report("live: reading {}".format(source))
+    for result in live_fits(open_source(source), key_time, key_fluo, N_log = N_log, interval = LIVE_INTERVAL):
+        if result is None:
+            job.check()
+            continue
+        key = dataset_store.put({"t": result["t"], "y": result["y"], "y_JC": result["y_JC"]})
+        #the zoom is kept from one refit to the next
+        job.report("live: {} samples".format(result["samples"]), dict(fit_summary(result, key, key), uirevision = job.id))
+    return job.result
+
 
 @app.callback(
-    Output('fit-store', 'data'),
+    Output('fit-job', 'data'),
+    Output('session-id', 'data'),
     Input('data-store',"data"),
     Input('x-axis-dropdown', 'value'),
     Input('y-axis-dropdown', 'value'),
     Input('smooth-dropdown', 'value'),
     Input('log-dropdown', 'value'),
+    Input('preprocess-mode', 'value'),
+    Input('bootstrap-option', 'value'),
+    Input('live-button', 'n_clicks'),
+    State('live-source', 'value'),
+    State('wavelength-dropdown', 'value'),
+    State('setup-name', 'value'),
+    State('session-id', 'data'),
+
+)
+def update_fit(store, key_time, key_fluo, N_mvg, N_log, mode, bootstrap, n_clicks, source, wl, setup, session):
+    #submitting a job cancels the previous job of the session, so quick edits of the settings do not queue up
+    session = session or uuid.uuid4().hex
+    if dash.ctx.triggered_id == 'live-button' and LIVE and source:
+        #the live trace is log-binned, its columns default to the first two
+        job = fit_jobs.submit(session, live_job, source, None, None, N_log)
+        return job.id, session
+    if key_time is None or not isinstance(store, dict):
+        fit_jobs.cancel(session)
+        return None, session
+    table = dataset_store.get(store["key"])
+    if table is None:
+        fit_jobs.cancel(session)
+        return None, session
+    job = fit_jobs.submit(session, fit_job, store["key"], table, key_time, key_fluo, N_mvg, N_log, mode,
+                          'bootstrap' in (bootstrap or []), wl, setup)
+    return job.id, session
+
+
+@app.callback(
+    Output('fit-store', 'data'),
+    Output('fit-progress', 'children'),
+    Output('fit-interval', 'disabled'),
+    Input('fit-interval', 'n_intervals'),
+    Input('fit-job', 'data'),
+    State('fit-store', 'data'),
+)
+def poll_fit(n_intervals, job_id, current):
+    job = fit_jobs.get(job_id)
+    if job is None:
+        return (None if job_id is None else dash.no_update), "", True
+    if job.status == "error":
+        return dash.no_update, "Fit failed: {}".format(job.error), True
+    if job.status == "cancelled":
+        return dash.no_update, "", True
+    #send the partial or final result only when it changed
+    result = job.result if job.result != current else dash.no_update
+    if job.status == "done":
+        return result, "", True
+    return result, job.message or "Fit queued", False
+
 
+@app.callback(
+    Output('smooth-dropdown', 'value'),
+    Output('log-dropdown', 'value'),
+    Output('autotune-status', 'children'),
+    Input('autotune-button', 'n_clicks'),
+    State('data-store', 'data'),
+    State('x-axis-dropdown', 'value'),
+    State('y-axis-dropdown', 'value'),
+    State('preprocess-mode', 'value'),
+    prevent_initial_call=True,
 )
-def update_fit(df, key_time, key_fluo, N_mvg, N_log):
-    if key_time is None or df is None:
+def update_autotune(n_clicks, store, key_time, key_fluo, mode):
+    #the best settings replace the inputs, which triggers the fit
+    table = dataset_store.get(store["key"]) if isinstance(store, dict) else None
+    if table is None or key_time is None or key_fluo is None:
+        return dash.no_update, dash.no_update, "Select the columns first"
+    with telemetry.request("autotune"):
+        t, y = stored_columns(table, key_time, key_fluo)
+        try:
+            result = autotune(t, y, mode = mode)
+        except ValueError as e:
+            return dash.no_update, dash.no_update, "Auto-tune failed: {}".format(e)
+    return result["N_mvg"], result["N_log"], "Smoothing {} and subsampling {} chosen among {} candidates in {:.1f} s".format(
+        result["N_mvg"], result["N_log"], len(result["candidates"]), result["seconds"])
+
+
+@app.callback(
+    Output('multi-fit-table', 'children'),
+    Input('data-store',"data"),
+    Input('x-axis-dropdown', 'value'),
+    Input('y-multi-dropdown', 'value'),
+    Input('smooth-dropdown', 'value'),
+    Input('log-dropdown', 'value'),
+    Input('wavelength-dropdown', 'value'),
+)
+def update_multi_fit(store, key_time, keys_fluo, N_mvg, N_log, wl):
+    if key_time is None or store is None or not keys_fluo:
         return None
     else:
-        df = pd.DataFrame(df)
+        table = dataset_store.get(store["key"])
+        if table is None:
+            return None
+        with telemetry.request("multi_fit"):
+            df = pd.DataFrame(read_columns(table["raw"], str(table["filename"]), [key_time] + list(keys_fluo)))
+            table = fit_columns_table(df, key_time, keys_fluo, N_mvg = N_mvg, N_log = N_log, wl = wl)
+        return read_table(table.to_dict())
+
+
+def format_trace(trace):
+    """ text of a telemetry request trace for the debug panel"""
+    lines = ["{} {:.3f} s".format(trace["name"], trace["seconds"])]
+    lines += ["  {:<16} {:8.4f} s {:10.2f} MB{}".format(stage["stage"], stage["seconds"], stage["bytes"]/2**20,
+                                                       " (cached)" if stage["cached"] else "")
+              for stage in trace["stages"]]
+    lines += ["  least_squares {:<15} nfev {:4d} njev {:>4} status {} cost {:.3e} {:.4f} s".format(
+              solver["model"], solver["nfev"], solver["njev"], solver["status"], solver["cost"], solver["seconds"])
+              for solver in trace["solvers"]]
+    if trace["memory"] is not None:
+        lines += ["  traced peak memory {:.1f} MB".format(trace["memory"]["peak_mb"])] + trace["memory"]["top"]
+    if trace["profile"] is not None:
+        lines.append(trace["profile"])
+    return "\n".join(lines)
+
+
+if DEBUG_PANEL:
+    @app.callback(
+        Output('debug-panel', 'children'),
+        Input('fit-store', 'data'),
+        Input('multi-fit-table', 'children'),
+    )
+    def update_debug_panel(dico, multi_table):
+        return "\n\n".join(format_trace(trace) for trace in reversed(telemetry.metrics.last))
 
-        t, y = pre_process(df[key_time], df[key_fluo], N_mvg = N_mvg, N_log = N_log)
-        tau, ypred =  multiexp_fit(t,y)
-        print(tau)
-        pos = 3*tau
-        pos_tau = find_nearest(t, pos)
-        params = get_fit(t[:pos_tau], y[:pos_tau])
-        print(params[1])
-        return {"y_JC":ypred, "params_exp":params, "t": t, "y": y}
+
+def x_range(relayout):
+    """ (t_min, t_max) of the zoomed log x axis from relayoutData, None for autorange,
+    False if the x axis did not change"""
+    if not relayout:
+        return False
+    if relayout.get('xaxis.autorange'):
+        return None
+    if 'xaxis.range[0]' in relayout:
+        bounds = relayout['xaxis.range[0]'], relayout['xaxis.range[1]']
+    elif 'xaxis.range' in relayout:
+        bounds = relayout['xaxis.range']
+    else:
+        return False
+    #the range of a log axis is given in decades
+    return tuple(10**np.array(bounds, dtype=float))
+
+
+def exp_curve(params_exp, t):
+    """ exponential fit drawn on 1024 log-spaced times"""
+    t = t[t > 0]
+    x_pred = np.logspace(np.log10(np.min(t)), np.log10(np.max(t)), 1024)
+    return x_pred, exp_decay(params_exp, x_pred)
 
 
 # Define the callback function that collects the file and reads it
+#the traces are always [raw, exponential fit, JC fit] so that they can be patched by index
 @app.callback(
     Output('data-plot', 'figure'),
+    Output('plot-state', 'data'),
     Input('fit-store',"data"),
     Input('x-axis-dropdown', 'value'),
     Input('y-axis-dropdown', 'value'),
+    Input('data-plot', 'relayoutData'),
+    State('plot-state', 'data'),
 
 )
-def update_figure(dico, key_time, key_fluo):
+def update_figure(dico, key_time, key_fluo, relayout, state):
+            arrays = dataset_store.get(dico['key']) if isinstance(dico, dict) else None
+            state = state or {}
+            trigger = dash.ctx.triggered_id
+            #the provisional tau comes before any array: the previous plot stays until the JC fit
+            if trigger == 'fit-store' and isinstance(dico, dict) and dico['key'] is None:
+                return dash.no_update, dash.no_update
+            same_points = arrays is not None and state.get('points_key') == dico['points_key']
+
+            #only send what changed when the plotted points are the same
+            if same_points and trigger in ('x-axis-dropdown', 'y-axis-dropdown'):
+                patched = Patch()
+                patched['layout']['xaxis']['title']['text'] = key_time
+                patched['layout']['yaxis']['title']['text'] = key_fluo
+                return patched, dash.no_update
+            if same_points and trigger == 'data-plot':
+                t_range = x_range(relayout)
+                if t_range is False:
+                    return dash.no_update, dash.no_update
+                #zoom: decimate the visible points only, down to full resolution
+                index = decimate_log(arrays['t'], arrays['y'], t_range = t_range)
+                patched = Patch()
+                patched['data'][0]['x'] = arrays['t'][index]
+                patched['data'][0]['y'] = arrays['y'][index]
+                patched['data'][2]['x'] = arrays['t'][index]
+                patched['data'][2]['y'] = arrays['y_JC'][index]
+                return patched, dash.no_update
+            if same_points and trigger == 'fit-store':
+                #the exponential fit following the partial result
+                if dico['params_exp'] is None:
+                    return dash.no_update, dash.no_update
+                x_pred, y_pred = exp_curve(dico['params_exp'], arrays['t'])
+                patched = Patch()
+                patched['data'][1]['x'] = x_pred
+                patched['data'][1]['y'] = y_pred
+                return patched, dash.no_update
+
             fig = go.Figure()
 
             fig.update_layout(
@@ -516,26 +818,28 @@ def update_figure(dico, key_time, key_fluo):
                     xaxis=dict(showgrid=False),  # Hide the x-axis grid lines
                     yaxis=dict(showgrid=False),  # Hide the y-axis grid lines
 )
-            if dico is None or key_time is None or key_fluo is None:
-                return fig
+            #a live trace does not depend on the selected columns
+            live = arrays is not None and 'uirevision' in dico
+            if arrays is None or (key_time is None or key_fluo is None) and not live:
+                return fig, None
             else:
-                X = dico['t']
-                Y = dico['y']
+                index = decimate_log(arrays['t'], arrays['y'])
+                X = arrays['t'][index]
 
                 fig.add_trace(go.Scatter(
                     
                     x=X, 
-                    y=Y, 
+                    y=arrays['y'][index], 
                     name = "raw",
                     mode = "markers",
                     marker_color='rgba(152, 0, 0, .8)',
                     )
                 )
-                x_pred = np.logspace(np.log10(np.min(X)), np.log10(np.max(X)), 1024)
-                y_pred = exp_decay(dico["params_exp"], x_pred)
+                #a partial result has no exponential fit yet
+                x_pred, y_pred = exp_curve(dico["params_exp"], arrays['t']) if dico["params_exp"] is not None else ([], [])
                 fig.add_trace(go.Scatter(
-                                x = x_pred.tolist(), 
-                                y=y_pred.tolist(), 
+                                x = x_pred, 
+                                y=y_pred, 
                                 name = "exponential fit",
                                 mode = "lines",
                                 line_color = "rgba(0,0,0,0.6)",
@@ -543,146 +847,21 @@ def update_figure(dico, key_time, key_fluo):
                 )
                 fig.add_trace(go.Scatter(
                                 x = X, 
-                                y=dico['y_JC'], 
+                                y=arrays['y_JC'][index], 
                                 name = "JC fit",
                                 mode = "lines",
                                 line_color = "rgba(1,0,0,1)",
                                 )
                 )
                 fig.update_layout(
-                    xaxis_title=key_time,  # Set the x-axis label
-                    yaxis_title=key_fluo,  # Set the y-axis label
-                    xaxis_type='log'
+                    xaxis_title=key_time if not live else 'time',  # Set the x-axis label
+                    yaxis_title=key_fluo if not live else 'fluorescence',  # Set the y-axis label
+                    xaxis_type='log',
+                    uirevision=dico.get('uirevision', dico['points_key']),  # keep the zoom until the points change
                 )
                 
-                return fig
-
-
-sigma_spectra = np.array([1080320.36324794, 1096525.82659956, 1112731.28995119,
-       1128936.75330282, 1145142.21665445, 1161347.68000608,
-       1177553.1433577 , 1193758.60670933, 1209964.07006095,
-       1226169.53341258, 1242374.99676421, 1258580.46011584,
-       1274785.92346746, 1290991.38681909, 1307196.85017072,
-       1323402.31352234, 1339607.77687397, 1373153.35502663,
-       1411905.79143144, 1451673.70138916, 1478670.56466059,
-       1515274.3414749 , 1548152.43008973, 1539517.61161135,
-       1583957.42642031, 1613578.00644628, 1643833.38937371,
-       1665504.34583023, 1691833.2616521 , 1713721.44702742,
-       1734676.01453642, 1757146.36611417, 1765487.82513961,
-       1767094.41048528, 1783768.76508012, 1789866.41365457,
-       1791637.52973493, 1801831.56652883, 1815463.26548964,
-       1845030.58414562, 1846578.66360136, 1863979.89956837,
-       1869297.85274318, 1902973.70718976, 1922833.10302972,
-       1932393.08574838, 1920830.76990208, 1929339.3557416 ,
-       1943226.70453895, 1946433.07570567, 1948326.3226245 ,
-       1943552.35931765, 1929795.11622905, 1934624.02574136,
-       1916399.22013779, 1882641.23395522, 1857959.33610857,
-       1806948.59035621, 1753736.01031018, 1718573.34900475,
-       1680012.77893194, 1631544.86418464, 1590600.18960301,
-       1553916.54869223, 1517889.90183009, 1482708.31324421,
-       1450548.18458663, 1429028.00325783, 1397699.82415812,
-       1374989.16295397, 1374790.54338109, 1367168.5460158 ,
-       1368033.77665265, 1379182.02567163, 1405920.42837571,
-       1413738.91475073, 1434123.67956377, 1448988.46172296,
-       1473030.9927783 , 1492334.03517098, 1497323.22892746,
-       1503626.64754565, 1515327.58272851, 1523428.05879884,
-       1529298.19431568, 1542857.14285714, 1542576.79188756,
-       1541548.89922265, 1550567.31610827, 1536215.83950724,
-       1512423.57573875, 1499206.69943644, 1485409.30531317,
-       1479630.06861839, 1470755.5418759 , 1462681.65170448,
-       1458408.4264974 , 1448040.64278621, 1438886.96113299,
-       1420759.70904844, 1398294.20753932, 1372085.2049734 ,
-       1333710.62395713, 1314941.31821197, 1277702.45173747,
-       1257359.1401519 , 1220428.06595823, 1186748.58146191,
-       1132252.80887725, 1091719.85740871, 1044718.58630797,
-        996027.48626862,  951288.91747806,  904267.35425221,
-        867574.78031876,  819640.33542742,  782829.37362567,
-        745628.94470458,  715579.50112647,  686670.54770786,
-        656777.46277505,  630307.47555064,  598427.46076374,
-        566948.8898423 ,  543721.49269629,  521713.03584591,
-        498082.13220402,  478332.80220379,  465021.58937712,
-        445962.2678377 ,  425367.69197932,  409067.69657186,
-        388986.76297839,  371871.3247358 ,  362868.2130055 ,
-        352515.7156202 ,  340674.78530855,  334304.10521768,
-        324257.76779525,  318966.60588279,  312956.6737609 ,
-        309455.17324309,  309357.25769934,  305914.35345918,
-        303200.38196645,  298094.6168562 ,  297644.82081274,
-        292007.94069656,  297522.06926282,  295377.64262062,
-        297085.45001645,  290429.1900518 ,  290534.31619159,
-        291988.25802339,  291361.52979218,  294164.43232791,
-        297278.81265898,  296679.11267928,  298932.41951389,
-        301271.97836244,  302210.71624825,  305234.91677873,
-        303828.20393297,  303788.05741674,  302627.86066651,
-        304607.7980444 ,  299006.6492145 ,  302964.0241715 ,
-        295382.91699819,  294406.87787231,  297872.26589567,
-        300546.77447763,  303939.46652755,  303214.59489387,
-        307395.09672919,  309366.33209283,  308924.85321731,
-        313385.53114165,  317841.0477302 ,  325406.87857612,
-        335877.30969035,  337368.2387927 ,  355642.58734382,
-        358300.44169331,  367389.7945327 ,  375952.1663928 ,
-        371255.72362331,  373648.53436215,  381892.83691055,
-        380134.28410989,  387538.58267784,  392092.97517867,
-        397844.23723147,  401655.75777558,  402206.89873785,
-        405823.47024202,  404579.67076031,  402660.25674658,
-        400331.65750322,  409568.91526944,  409465.29261404,
-        417096.47974219,  417025.67367902,  421364.50223237,
-        432240.59058115,  440388.65891419,  438779.67464752,
-        440600.06346725,  446711.77753169,  456313.13167753,
-        463354.87973147,  471658.83493694,  471477.21567323,
-        482308.17816221,  486566.28537259,  489923.87621808,
-        491983.72936474,  500368.59753164,  502571.00243522,
-        505745.62455663,  503845.02961724,  506239.80310324,
-        503651.24769957,  515835.76797197,  508511.24269749,
-        515908.66986217,  508934.37201447,  513040.91397102,
-        515390.89931683,  516475.20390449,  510321.36941409,
-        512654.37736637,  509188.73522681,  508916.862424  ,
-        514044.00659683,  513211.21717674,  520218.02740401,
-        523064.84317152,  525364.24563228,  520416.34924037,
-        525419.9910144 ,  527250.57854259,  527839.2979549 ,
-        524666.47266005,  524180.28722176,  531624.19461285,
-        527817.78088701,  534094.5718205 ,  539457.40050247,
-        545880.14718371,  552107.79608908,  550494.33419321,
-        557452.63669133,  580712.20522034,  605173.29073261,
-        625164.06975426,  648216.08108103,  676233.06808596,
-        691287.70760725,  735439.29711113,  766771.55370299,
-        812219.08118596,  849139.64705903,  865441.92866851,
-        892126.74625705,  917447.6092084 ,  936198.20234079,
-        958605.81126973,  974184.78761212,  989773.78017848,
-       1001107.03224672, 1016398.75442679, 1031686.71451576,
-       1049660.39254716, 1073591.0810498 , 1055642.37679175,
-       1134054.40309067, 1158380.66171228, 1152754.41263563,
-       1189887.1017159 , 1211132.09693735, 1240335.41347613,
-       1276705.44341248, 1283540.40693822, 1309489.70098349,
-       1323724.42575004, 1326903.60188728, 1339888.60744422,
-       1320294.97796485, 1329808.07135887, 1316872.04570731])
-
-wavelength = np.array([385., 386., 387., 388., 389., 390., 391., 392., 393., 394., 395.,
-       396., 397., 398., 399., 400., 401., 402., 403., 404., 405., 406.,
-       407., 408., 409., 410., 411., 412., 413., 414., 415., 416., 417.,
-       418., 419., 420., 421., 422., 423., 424., 425., 426., 427., 428.,
-       429., 430., 431., 432., 433., 434., 435., 436., 437., 438., 439.,
-       440., 441., 442., 443., 444., 445., 446., 447., 448., 449., 450.,
-       451., 452., 453., 454., 455., 456., 457., 458., 459., 460., 461.,
-       462., 463., 464., 465., 466., 467., 468., 469., 470., 471., 472.,
-       473., 474., 475., 476., 477., 478., 479., 480., 481., 482., 483.,
-       484., 485., 486., 487., 488., 489., 490., 491., 492., 493., 494.,
-       495., 496., 497., 498., 499., 500., 501., 502., 503., 504., 505.,
-       506., 507., 508., 509., 510., 511., 512., 513., 514., 515., 516.,
-       517., 518., 519., 520., 521., 522., 523., 524., 525., 526., 527.,
-       528., 529., 530., 531., 532., 533., 534., 535., 536., 537., 538.,
-       539., 540., 541., 542., 543., 544., 545., 546., 547., 548., 549.,
-       550., 551., 552., 553., 554., 555., 556., 557., 558., 559., 560.,
-       561., 562., 563., 564., 565., 566., 567., 568., 569., 570., 571.,
-       572., 573., 574., 575., 576., 577., 578., 579., 580., 581., 582.,
-       583., 584., 585., 586., 587., 588., 589., 590., 591., 592., 593.,
-       594., 595., 596., 597., 598., 599., 600., 601., 602., 603., 604.,
-       605., 606., 607., 608., 609., 610., 611., 612., 613., 614., 615.,
-       616., 617., 618., 619., 620., 621., 622., 623., 624., 625., 626.,
-       627., 628., 629., 630., 631., 632., 633., 634., 635., 636., 637.,
-       638., 639., 640., 641., 642., 643., 644., 645., 646., 647., 648.,
-       649., 650., 651., 652., 653., 654., 655., 656., 657., 658., 659.,
-       660., 661., 662., 663., 664., 665., 666., 667., 668., 669., 670.,
-       671., 672., 673., 674., 675.])
+                return fig, {'points_key': dico['points_key']}
+
 
 # Run the app
 if __name__ == '__main__':
@@ -0,0 +1,258 @@
+"""
+HTTP fitting API on the Flask server of the app, for acquisition software.
+
+POST /api/fit fits one or many traces concurrently with the cached fit pipeline
+of the app, and returns tau with its 95% interval, the intensities, the JIP-test
+parameters and the time of every stage as JSON. The traces are sent as:
+
+    application/json      {"traces": [{"time": [...], "fluorescence": [...], "wavelength": 470,
+                           "N_mvg": 10, "N_log": 1000, "mode": "mvgavg"}, ...], "curves": false}
+                          or a single trace object
+    application/msgpack   the same, the arrays as lists or raw float64 bytes (needs msgpack)
+    application/x-npy     one (1 + traces, samples) array: the time, then the fluorescence of each trace
+    application/x-npz     "time" (samples) and "fluorescence" (samples, or traces x samples) arrays
+
+The settings missing from a trace are taken from the query string
+(/api/fit?wavelength=470&N_log=1000&curves=1), then from the defaults. With
+curves, the preprocessed points and the fitted curves are returned too.
+Requests larger than OJIP_API_MAX_MB (64 MB) or with more than
+OJIP_API_MAX_TRACES (64) traces are refused.
+
+    python api.py trace.csv --local --wavelength 470       # Flask test client, no server needed
+    python api.py trace.csv --url http://127.0.0.1:8050 --binary
+"""
+import argparse
+import io
+import json
+import os
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import telemetry
+from storage import arrays_key
+from ojip_core import exp_decay, intensity_values, intensity_intervals
+
+MAX_BYTES = int(os.environ.get("OJIP_API_MAX_MB", 64))*2**20
+MAX_TRACES = int(os.environ.get("OJIP_API_MAX_TRACES", 64))
+WORKERS = int(os.environ.get("OJIP_API_WORKERS", 4))
+
+#settings of a trace and their types
+SETTINGS = {"wavelength": float, "N_mvg": int, "N_log": int, "mode": str}
+DEFAULTS = {"wavelength": None, "N_mvg": 10, "N_log": 1000, "mode": "mvgavg"}
+
+
+class PayloadError(ValueError):
+    """ request that cannot be fitted, answered with its HTTP status"""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_payload(mimetype, body, args=None):
+    """ list of traces (dicts of "time", "fluorescence" and the settings) and the curves flag of a request"""
+    args = args or {}
+    if mimetype in ("application/json", "application/msgpack"):
+        loads = json.loads if mimetype == "application/json" else _msgpack().unpackb
+        try:
+            data = loads(body)
+        except ValueError as e:
+            raise PayloadError("invalid {} payload: {}".format(mimetype, e))
+        if not isinstance(data, dict):
+            raise PayloadError("the payload must be an object")
+        traces = data["traces"] if "traces" in data else [data]
+        curves = data.get("curves", args.get("curves"))
+    elif mimetype in ("application/x-npy", "application/x-npz", "application/octet-stream"):
+        try:
+            loaded = np.load(io.BytesIO(body), allow_pickle=False)
+        except (ValueError, OSError) as e:
+            raise PayloadError("invalid NumPy payload: {}".format(e))
+        if isinstance(loaded, np.ndarray):
+            if loaded.ndim != 2 or len(loaded) < 2:
+                raise PayloadError("the .npy array must be (1 + traces, samples): the time, then the fluorescence")
+            time_array, fluo = loaded[0], loaded[1:]
+        else:
+            with loaded:
+                if "time" not in loaded.files or "fluorescence" not in loaded.files:
+                    raise PayloadError('the .npz file needs "time" and "fluorescence" arrays')
+                time_array, fluo = loaded["time"], np.atleast_2d(loaded["fluorescence"])
+        traces = [{"time": time_array, "fluorescence": row} for row in fluo]
+        curves = args.get("curves")
+    else:
+        raise PayloadError("unsupported content type {}".format(mimetype), 415)
+    if not isinstance(traces, list) or not traces:
+        raise PayloadError("no trace in the payload")
+    if len(traces) > MAX_TRACES:
+        raise PayloadError("{} traces, at most {} per request".format(len(traces), MAX_TRACES), 413)
+    return [_trace(trace, args) for trace in traces], str(curves).lower() in ("1", "true", "yes")
+
+
+def _trace(trace, args):
+    if not isinstance(trace, dict) or "time" not in trace or "fluorescence" not in trace:
+        raise PayloadError('every trace needs "time" and "fluorescence" arrays')
+    parsed = {}
+    for name in ("time", "fluorescence"):
+        values = trace[name]
+        try:
+            parsed[name] = np.frombuffer(values, dtype=float) if isinstance(values, bytes) else np.asarray(values, dtype=float)
+        except (TypeError, ValueError) as e:
+            raise PayloadError("invalid {} array: {}".format(name, e))
+    if parsed["time"].ndim != 1 or parsed["time"].shape != parsed["fluorescence"].shape:
+        raise PayloadError("time and fluorescence must be 1-D arrays of the same length")
+    for name, kind in SETTINGS.items():
+        value = trace.get(name, args.get(name, DEFAULTS[name]))
+        try:
+            parsed[name] = None if value is None else kind(value)
+        except (TypeError, ValueError):
+            raise PayloadError("invalid {}: {!r}".format(name, value))
+    if parsed["mode"] not in ("mvgavg", "logbin") or parsed["N_mvg"] < 1 or parsed["N_log"] < 2:
+        raise PayloadError("invalid settings: mode {mode}, N_mvg {N_mvg}, N_log {N_log}".format(**parsed))
+    return parsed
+
+
+def fit_payload(pipeline, trace, curves=False):
+    """ result of one parsed trace, errors of the fit are reported in the result"""
+    data_key = arrays_key({"time": trace["time"], "fluorescence": trace["fluorescence"]})
+    result = {"N_mvg": trace["N_mvg"], "N_log": trace["N_log"], "mode": trace["mode"],
+              "wavelength": trace["wavelength"], "error": None}
+    with telemetry.request("api_fit") as request:
+        try:
+            fit = pipeline.run(data_key, trace, "time", "fluorescence", N_mvg = trace["N_mvg"], N_log = trace["N_log"],
+                               mode = trace["mode"])
+        except Exception as e:
+            #the payload is valid: any failure of the fit only fails this trace, not the whole request
+            fit = None
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+    result["timings"] = {"seconds": request.seconds,
+                         "stages": [{k: stage[k] for k in ("stage", "seconds", "cached")} for stage in request.stages],
+                         "solvers": request.solvers}
+    if fit is None:
+        return _json_ready(result)
+    result.update(tau = fit["params_exp"][1], tau_ci = fit["tau_ci"], tau_JC = fit["tau_JC"], tau_JC_ci = fit["tau_JC_ci"],
+                  params_exp = fit["params_exp"], params_JC = fit["params_JC"], jip = fit["jip"])
+    if trace["wavelength"] is not None:
+        result["intensity_eins"], result["intensity_watt"] = intensity_values(fit["params_exp"], trace["wavelength"])
+        result["intensity_eins_ci"], result["intensity_watt_ci"] = intensity_intervals(fit["tau_ci"], trace["wavelength"])
+    if curves:
+        result["curves"] = {"t": fit["t"], "y": fit["y"], "y_JC": fit["y_JC"],
+                            "y_exp": exp_decay(fit["params_exp"], fit["t"] - fit["t"][0])}
+    return _json_ready(result)
+
+
+def _json_ready(value):
+    #arrays to lists, and no NaN or infinity, which are not valid JSON
+    if isinstance(value, dict):
+        return {k: _json_ready(v) for k, v in value.items()}
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [_json_ready(v) for v in value]
+    if isinstance(value, (float, np.floating)):
+        return float(value) if np.isfinite(value) else None
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+def register_api(server, pipeline, workers=WORKERS):
+    """ add the /api/fit route to a Flask server, the traces of a request are fitted concurrently on workers threads"""
+    import flask
+
+    pool = ThreadPoolExecutor(workers, thread_name_prefix="api-fit")
+
+    @server.route("/api/fit", methods=["POST"])
+    def _api_fit():
+        start = time.perf_counter()
+        request = flask.request
+        if request.content_length is not None and request.content_length > MAX_BYTES:
+            return _error("request of {} bytes, at most {}".format(request.content_length, MAX_BYTES), 413)
+        body = request.get_data(cache=False)
+        if len(body) > MAX_BYTES:
+            return _error("request of {} bytes, at most {}".format(len(body), MAX_BYTES), 413)
+        try:
+            traces, curves = parse_payload(request.mimetype, body, request.args)
+        except PayloadError as e:
+            return _error(str(e), e.status)
+        results = list(pool.map(lambda trace: fit_payload(pipeline, trace, curves), traces))
+        return flask.Response(json.dumps({"results": results, "seconds": time.perf_counter() - start}),
+                              mimetype="application/json")
+
+    def _error(message, status):
+        return flask.Response(json.dumps({"error": message}), status=status, mimetype="application/json")
+
+
+def _msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        raise PayloadError("msgpack is not installed on the server (pip install msgpack)", 415)
+    return msgpack
+
+
+def fit_request(url, time_array, fluo, binary=False, client=None, curves=False, **settings):
+    """
+    fit traces with the API at url (e.g. http://127.0.0.1:8050) and return the decoded response
+    fluo: one trace, or (traces, samples) sharing time_array; settings: wavelength, N_mvg, N_log, mode
+    binary: send a .npy array instead of JSON
+    client: a Flask test client (app.server.test_client()) to call the API without a server
+    """
+    time_array = np.asarray(time_array, dtype=float)
+    fluo = np.atleast_2d(np.asarray(fluo, dtype=float))
+    settings = {k: v for k, v in settings.items() if v is not None}
+    if binary:
+        buffer = io.BytesIO()
+        np.save(buffer, np.vstack([time_array, fluo]))
+        body, mimetype = buffer.getvalue(), "application/x-npy"
+        query = dict(settings, curves=int(curves))
+    else:
+        body = json.dumps({"traces": [dict(settings, time=time_array.tolist(), fluorescence=row.tolist()) for row in fluo],
+                           "curves": curves}).encode()
+        mimetype, query = "application/json", {}
+    path = "/api/fit" + ("?" + "&".join("{}={}".format(k, v) for k, v in query.items()) if query else "")
+    if client is not None:
+        response = client.post(path, data=body, content_type=mimetype)
+        if response.status_code != 200:
+            raise RuntimeError("{}: {}".format(response.status_code, response.get_json()["error"]))
+        return response.get_json()
+    request = urllib.request.Request(url.rstrip("/") + path, data=body, headers={"Content-Type": mimetype})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def main(argv=None):
+    from ingest import read_columns, read_header
+
+    parser = argparse.ArgumentParser(description="Fit traces with the HTTP API of the app.")
+    parser.add_argument("files", nargs="+", help="trace tables (.csv, .txt, .xlsx ...), first two columns: time and fluorescence")
+    parser.add_argument("--url", default="http://127.0.0.1:8050", help="address of the app")
+    parser.add_argument("--local", action="store_true", help="call the API through the Flask test client, without a server")
+    parser.add_argument("--binary", action="store_true", help="send .npy arrays instead of JSON")
+    parser.add_argument("--wavelength", type=float, default=None, help="excitation wavelength (nm)")
+    parser.add_argument("--smooth", dest="N_mvg", type=int, default=None, help="moving average window size")
+    parser.add_argument("--log", dest="N_log", type=int, default=None, help="logarithmic subsampling size")
+    parser.add_argument("--mode", choices=["mvgavg", "logbin"], default=None, help="preprocessing of the fits")
+    args = parser.parse_args(argv)
+
+    client = None
+    if args.local:
+        from OJIP_fit import app
+        client = app.server.test_client()
+    failures = 0
+    for path in args.files:
+        with open(path, "rb") as f:
+            data = f.read()
+        names = read_header(data, path)[:2]
+        columns = read_columns(data, path, names)
+        response = fit_request(args.url, columns[names[0]], columns[names[1]], binary=args.binary, client=client,
+                               wavelength=args.wavelength, N_mvg=args.N_mvg, N_log=args.N_log, mode=args.mode)
+        for result in response["results"]:
+            failures += result["error"] is not None
+            stages = ", ".join("{} {:.1f} ms".format(s["stage"], 1e3*s["seconds"]) for s in result["timings"]["stages"])
+            print("{}: {}".format(path, result["error"] or "tau = {:.3e} s ({})".format(result["tau"], stages)))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
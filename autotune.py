@@ -0,0 +1,178 @@
+"""
+Automatic choice of the smoothing window (N_mvg) and logarithmic subsampling size (N_log).
+
+A grid of (N_mvg, N_log) candidates is fitted over a process pool. The trace is
+parsed and blank-corrected once, in shared memory that every worker maps without
+copying, and each worker computes one moving average for all the N_log of its
+N_mvg. A candidate is scored on the full-resolution rise rather than on its own
+preprocessed points, so that the candidates are compared on the same data:
+
+    goodness: mean squared residual of the exponential fit on the raw samples of the
+              first 3 tau (median tau of the grid), in units of the noise variance
+    stability: relative width of the 95% interval of tau
+    score = goodness * (1 + stability), candidates whose tau is more than 20% away
+    from the median tau of the grid are rejected
+
+    python autotune.py trace.csv --time time --fluo fluorescence
+"""
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+
+N_MVGS = (1, 2, 5, 10, 20, 50)
+N_LOGS = (300, 1000, 3000, 10000)
+#largest deviation of tau from the median of the grid
+MAX_DEVIATION = 0.2
+
+
+def share_arrays(arrays):
+    """ copy a dict of float arrays into one shared memory block, returns the block and the spec to map it"""
+    arrays = {name: np.ascontiguousarray(array, dtype=float) for name, array in arrays.items()}
+    block = shared_memory.SharedMemory(create=True, size=max(1, sum(a.nbytes for a in arrays.values())))
+    spec, offset = [], 0
+    for name, array in arrays.items():
+        np.ndarray(array.shape, dtype=float, buffer=block.buf, offset=offset)[:] = array
+        spec.append((name, array.shape, offset))
+        offset += array.nbytes
+    return block, (block.name, spec)
+
+
+def _mapped(spec):
+    name, layout = spec
+    block = shared_memory.SharedMemory(name=name)
+    return block, {array: np.ndarray(shape, dtype=float, buffer=block.buf, offset=offset) for array, shape, offset in layout}
+
+
+def noise_level(y):
+    """ standard deviation of the noise of a trace, from the median absolute difference of successive samples"""
+    return np.median(np.abs(np.diff(y)))/(0.6745*np.sqrt(2))
+
+
+def tune_candidates(spec, N_mvg, N_logs, mode="mvgavg", jac=True):
+    """ exponential fits of the candidates (N_mvg, N_log) for the N_logs, on the shared arrays of spec (or a dict of arrays)
+    the "origin" of a fit is the time of the raw rise at which its time axis starts"""
+    from ojip_core import moving_average, log_subsample, log_bin, multiexp_fit, get_fit, find_nearest
+
+    block, arrays = _mapped(spec) if isinstance(spec, tuple) else (None, spec)
+    try:
+        t_rise, y_rise = arrays["t_rise"], arrays["y_rise"]
+        if mode != "logbin":
+            #one moving average for all the N_log
+            t_mvg, y_mvg = moving_average(t_rise, y_rise, N_mvg)
+            origin = t_rise[:N_mvg].mean()
+        candidates = []
+        for N_log in N_logs:
+            candidate = {"N_mvg": N_mvg, "N_log": N_log, "params": None, "tau": np.nan, "score": np.inf, "error": None}
+            start = time.perf_counter()
+            try:
+                if mode == "logbin":
+                    t, y, _, sigma = log_bin(arrays["time"], arrays["fluo"], N_log)
+                    origin = t_rise[0]
+                else:
+                    t, y = log_subsample(t_mvg, y_mvg, N_log)
+                    sigma = None
+                tau_JC, _ = multiexp_fit(t, y, jac = jac, sigma = sigma)
+                pos_tau = find_nearest(t, 3*tau_JC)
+                params, cov = get_fit(t[:pos_tau], y[:pos_tau], jac = jac,
+                                      sigma = None if sigma is None else sigma[:pos_tau], full_output = True)
+                candidate.update(params = [float(v) for v in params], origin = float(origin + t[0]), tau = params[1],
+                                 stability = 2*1.96*np.sqrt(cov[1, 1])/abs(params[1]))
+            except (ValueError, IndexError, np.linalg.LinAlgError) as e:
+                candidate["error"] = "{}: {}".format(type(e).__name__, e)
+            candidate["seconds"] = time.perf_counter() - start
+            candidates.append({k: (v.item() if isinstance(v, np.generic) else v) for k, v in candidate.items()})
+        return candidates
+    finally:
+        if block is not None:
+            block.close()
+
+
+def autotune(time_array, fluo, N_mvgs=N_MVGS, N_logs=N_LOGS, mode="mvgavg", workers=None, jac=True):
+    """
+    best (N_mvg, N_log) of a trace over the grid N_mvgs x N_logs (N_mvg is not used with mode="logbin")
+    workers: number of worker processes, 0 to run in this process
+    Returns a dict of the best N_mvg, N_log, tau and score, the scored candidates and the time taken.
+    """
+    from ojip_core import select_rise, exp_decay
+
+    start = time.perf_counter()
+    time_array = np.asarray(time_array, dtype=float)
+    fluo = np.asarray(fluo, dtype=float)
+    t_rise, y_rise = select_rise(time_array, fluo)
+    arrays = {"t_rise": t_rise, "y_rise": y_rise}
+    if mode == "logbin":
+        arrays.update(time = time_array, fluo = fluo)
+        N_mvgs = N_mvgs[:1]
+    N_logs = [N_log for N_log in N_logs if N_log < len(t_rise)] or [min(N_logs)]
+
+    candidates = []
+    if workers == 0:
+        for N_mvg in N_mvgs:
+            candidates += tune_candidates(arrays, N_mvg, N_logs, mode, jac)
+    else:
+        block, spec = share_arrays(arrays)
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(tune_candidates, spec, N_mvg, N_logs, mode, jac) for N_mvg in N_mvgs]
+                for future in as_completed(futures):
+                    candidates += future.result()
+        finally:
+            block.close()
+            block.unlink()
+
+    candidates.sort(key=lambda c: (c["N_mvg"], c["N_log"]))
+    fitted = [c for c in candidates if c["params"] is not None and c["tau"] > 0 and np.isfinite(c["stability"])]
+    if not fitted:
+        raise ValueError("no candidate could be fitted")
+    median = np.median([c["tau"] for c in fitted])
+    #all the candidates are scored on the same raw samples
+    window = (t_rise >= t_rise[0]) & (t_rise <= t_rise[0] + 3*median)
+    noise = noise_level(y_rise)
+    for c in fitted:
+        raw_t = np.maximum(t_rise[window] - c["origin"], 0)
+        c["goodness"] = float(np.mean((y_rise[window] - exp_decay(c["params"], raw_t))**2)/noise**2)
+        c["score"] = c["goodness"]*(1 + c["stability"])
+        #unstable: far from the consensus of the grid
+        if abs(c["tau"]/median - 1) > MAX_DEVIATION:
+            c["score"] = np.inf
+            c["error"] = "tau {:.0%} away from the median of the grid".format(c["tau"]/median - 1)
+    best = min(fitted, key=lambda c: (c["score"], c["N_log"]))
+    return {"N_mvg": best["N_mvg"], "N_log": best["N_log"], "tau": best["tau"], "score": best["score"],
+            "candidates": candidates, "seconds": time.perf_counter() - start}
+
+
+def main(argv=None):
+    from ingest import read_columns, read_header
+
+    parser = argparse.ArgumentParser(description="Choose the smoothing window and logarithmic subsampling size of a trace.")
+    parser.add_argument("file", help="trace table (.csv, .txt, .xlsx ...)")
+    parser.add_argument("--time", dest="key_time", default=None, help="time column (default: first column)")
+    parser.add_argument("--fluo", dest="key_fluo", default=None, help="fluorescence column (default: second column)")
+    parser.add_argument("--mode", choices=["mvgavg", "logbin"], default="mvgavg", help="preprocessing of the fits")
+    parser.add_argument("--smooth", dest="N_mvgs", type=int, nargs="+", default=N_MVGS, help="moving average windows tried")
+    parser.add_argument("--log", dest="N_logs", type=int, nargs="+", default=N_LOGS, help="logarithmic subsampling sizes tried")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: CPU count)")
+    args = parser.parse_args(argv)
+
+    with open(args.file, "rb") as f:
+        data = f.read()
+    names = read_header(data, args.file)
+    key_time = args.key_time if args.key_time is not None else names[0]
+    key_fluo = args.key_fluo if args.key_fluo is not None else names[1]
+    columns = read_columns(data, args.file, [key_time, key_fluo])
+    result = autotune(columns[key_time], columns[key_fluo], args.N_mvgs, args.N_logs, args.mode, args.workers)
+    print("{:>6} {:>6} {:>10} {:>9} {:>9} {:>9}".format("N_mvg", "N_log", "tau", "goodness", "stability", "score"))
+    for c in result["candidates"]:
+        print("{:>6} {:>6} {:>10.3e} {:>9.3g} {:>9.3g} {:>9.3g} {}".format(
+            c["N_mvg"], c["N_log"], c["tau"], c.get("goodness", np.nan), c.get("stability", np.nan), c["score"],
+            c["error"] or ""))
+    print("best: --smooth {} --log {} (tau = {:.3e} s), tuned in {:.1f} s".format(
+        result["N_mvg"], result["N_log"], result["tau"], result["seconds"]))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
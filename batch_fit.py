@@ -0,0 +1,216 @@
+"""
+Headless batch fitting of OJIP traces.
+
+Runs the same chain as the app (pre_process -> multiexp_fit -> get_fit -> intensity_values)
+on every file of a directory or glob pattern, spread over a process pool.
+One row per file is written to the output as soon as its fit finishes; a file
+that fails gets a row with the error message instead of stopping the run.
+
+    python batch_fit.py data/ --time time --fluo fluorescence --wavelength 470 -o results.csv
+    python batch_fit.py "data/*.txt" --workers 8 -o results.parquet
+
+The *_low and *_high columns are the 95% confidence intervals, from the covariance
+of the fit, or from a residual bootstrap of n_bootstrap refits with --bootstrap.
+The JIP-test parameters (Fo to area) come from the same preprocessed points and JC fit.
+
+With --results, every fit is also appended to the results store of the app
+(results.py), and a file already fitted with the same settings is read from the
+store instead of being fitted again (unless --refit).
+"""
+import argparse
+import csv
+import glob
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+
+FIELDS = ["file", "time_column", "fluo_column", "N_mvg", "N_log", "mode", "tau_JC",
+          "A", "tau", "y0", "tau_low", "tau_high", "n_bootstrap", "wavelength",
+          "intensity_eins", "intensity_eins_low", "intensity_eins_high",
+          "intensity_watt", "intensity_watt_low", "intensity_watt_high",
+          "Fo", "Fm", "Fv/Fm", "Vj", "Vi", "Mo", "area",
+          "seconds", "error"]
+
+EXTENSIONS = (".csv", ".txt", ".tsv", ".xls", ".xlsx")
+
+
+def collect_files(inputs):
+    """ expand directories and glob patterns into a sorted list of files"""
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            files += [os.path.join(item, f) for f in os.listdir(item)
+                      if f.lower().endswith(EXTENSIONS)]
+        else:
+            files += glob.glob(item)
+    return sorted(set(files))
+
+
+def fit_file(path, key_time=None, key_fluo=None, N_mvg=10, N_log=10000, wl=None, mode="mvgavg",
+             bootstrap=0, bootstrap_seconds=None, results=None, setup="default", refit=False):
+    """ fit one file and return its result row, errors are recorded in the row
+    bootstrap: number of bootstrap refits for the confidence intervals, run in this worker (0: covariance)
+    results: path of a results store the fit is appended to, and read from unless refit"""
+    from ingest import read_columns, read_header
+    from ojip_core import fit_trace, intensity_values, intensity_intervals, bootstrap_fit, preprocess_trace, jip_test
+    from results import ResultsStore, fit_record
+
+    row = dict.fromkeys(FIELDS)
+    row.update(file=path, N_mvg=N_mvg, N_log=N_log, mode=mode, wavelength=wl)
+    start = time.perf_counter()
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        if key_time is None or key_fluo is None:
+            columns = read_header(data, path)
+            key_time = key_time if key_time is not None else columns[0]
+            key_fluo = key_fluo if key_fluo is not None else columns[1]
+        row.update(time_column=key_time, fluo_column=key_fluo)
+
+        #same key as the uploads of the app, so the store is shared with it
+        settings = dict(input_hash=hashlib.blake2b(data, digest_size=16).hexdigest(), time_column=key_time,
+                        fluo_column=key_fluo, N_mvg=N_mvg, N_log=N_log, mode=mode, method="trf")
+        store = ResultsStore(results) if results else None
+        record = None
+        if store is not None and not refit:
+            record = store.find(ci="bootstrap" if bootstrap else "covariance", **settings)
+        #only the two fitted columns are parsed
+        columns = read_columns(data, path, [key_time, key_fluo])
+        if record is not None:
+            #no fit, the JIP test only needs the preprocessed points
+            t, y, _ = preprocess_trace(columns[key_time], columns[key_fluo], N_mvg=N_mvg, N_log=N_log, mode=mode)
+            result = {"params_exp": record["params_exp"], "tau_JC": record["tau_JC"],
+                      "jip": jip_test(record["params_JC"], t, y)}
+            tau_ci = (record["tau_low"], record["tau_high"])
+            row["n_bootstrap"] = _bootstrap_samples(record["ci"])
+        else:
+            result = fit_trace(columns[key_time], columns[key_fluo], N_mvg=N_mvg, N_log=N_log, mode=mode)
+            tau_ci = result["tau_ci"]
+            if bootstrap:
+                boot = bootstrap_fit(result, n_samples=bootstrap, time_budget=bootstrap_seconds, workers=0)
+                row["n_bootstrap"] = boot["n"]
+                tau_ci = boot["tau_ci"]
+            if store is not None:
+                ci = "bootstrap n={}".format(row["n_bootstrap"]) if bootstrap else "covariance"
+                store.append(fit_record(dict(result, tau_ci=tau_ci), wl, setup=setup, source="batch",
+                                        filename=os.path.abspath(path), ci=ci, **settings))
+        A, tau, y0 = result["params_exp"]
+        row.update(tau_JC=result["tau_JC"], A=A, tau=tau, y0=y0, **result["jip"])
+        row["tau_low"], row["tau_high"] = tau_ci
+        if wl is not None:
+            row["intensity_eins"], row["intensity_watt"] = intensity_values(result["params_exp"], wl)
+            ((row["intensity_eins_low"], row["intensity_eins_high"]),
+             (row["intensity_watt_low"], row["intensity_watt_high"])) = intensity_intervals(tau_ci, wl)
+    except Exception as e:
+        row["error"] = "{}: {}".format(type(e).__name__, e)
+    row["seconds"] = time.perf_counter() - start
+    return {k: (float(v) if isinstance(v, np.generic) else v) for k, v in row.items()}
+
+
+def _bootstrap_samples(ci):
+    #"bootstrap n=200" -> 200, None for the covariance intervals
+    return int(ci.rsplit("=", 1)[1]) if ci.startswith("bootstrap") else None
+
+
+class CSVResultWriter:
+    """ append result rows to a CSV file, flushed after each row"""
+    def __init__(self, path):
+        self._file = open(path, "w", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=FIELDS)
+        self._writer.writeheader()
+
+    def write(self, row):
+        self._writer.writerow(row)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetResultWriter:
+    """ append result rows to a Parquet file, one row group per finished fit"""
+    def __init__(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._schema = pa.schema([("file", pa.string()), ("time_column", pa.string()),
+                                  ("fluo_column", pa.string()), ("N_mvg", pa.int64()),
+                                  ("N_log", pa.int64()), ("mode", pa.string())]
+                                 + [(k, pa.float64()) for k in FIELDS[6:-1]]
+                                 + [("error", pa.string())])
+        self._writer = pq.ParquetWriter(path, self._schema)
+
+    def write(self, row):
+        row = dict(row)
+        for k in ("file", "time_column", "fluo_column", "error"):
+            if row[k] is not None:
+                row[k] = str(row[k])
+        self._writer.write_table(self._pa.Table.from_pylist([row], schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+def result_writer(path):
+    if path.lower().endswith((".parquet", ".pq")):
+        return ParquetResultWriter(path)
+    return CSVResultWriter(path)
+
+
+def run(files, output, key_time=None, key_fluo=None, N_mvg=10, N_log=10000, wl=None, workers=None, mode="mvgavg",
+        bootstrap=0, bootstrap_seconds=None, results=None, setup="default", refit=False):
+    """ fit all files over a process pool, streaming one row per file to output; returns the number of failures"""
+    writer = result_writer(output)
+    failures = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(fit_file, f, key_time, key_fluo, N_mvg, N_log, wl, mode, bootstrap, bootstrap_seconds,
+                                   results, setup, refit)
+                       for f in files]
+            for future in as_completed(futures):
+                row = future.result()
+                failures += row["error"] is not None
+                writer.write(row)
+                print("{} {}".format(row["file"], row["error"] or "tau = {:.3e} s".format(row["tau"])))
+    finally:
+        writer.close()
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch OJIP fit of a directory or glob of traces.")
+    parser.add_argument("inputs", nargs="+", help="directories, files or glob patterns")
+    parser.add_argument("-o", "--output", default="results.csv", help="output .csv or .parquet file")
+    parser.add_argument("--time", dest="key_time", default=None, help="time column (default: first column)")
+    parser.add_argument("--fluo", dest="key_fluo", default=None, help="fluorescence column (default: second column)")
+    parser.add_argument("--smooth", dest="N_mvg", type=int, default=10, help="moving average window size")
+    parser.add_argument("--log", dest="N_log", type=int, default=10000, help="logarithmic subsampling size (number of bins with --mode logbin)")
+    parser.add_argument("--mode", choices=["mvgavg", "logbin"], default="mvgavg",
+                        help="moving average + log subsampling, or logarithmic binning with weighted fits")
+    parser.add_argument("--wavelength", type=float, default=None, help="excitation wavelength (nm) to compute the intensity")
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="number of residual bootstrap refits for the confidence intervals (default: covariance)")
+    parser.add_argument("--bootstrap-seconds", type=float, default=None, help="time budget of the bootstrap of each file")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument("--results", default=None, help="results store (SQLite file) the fits are appended to")
+    parser.add_argument("--setup", default="default", help="name of the setup in the results store")
+    parser.add_argument("--refit", action="store_true", help="fit again the files already in the results store")
+    args = parser.parse_args(argv)
+
+    files = collect_files(args.inputs)
+    if not files:
+        parser.error("no input file found")
+    failures = run(files, args.output, args.key_time, args.key_fluo, args.N_mvg, args.N_log,
+                   args.wavelength, args.workers, args.mode, args.bootstrap, args.bootstrap_seconds,
+                   args.results, args.setup, args.refit)
+    print("{} files fitted, {} failed, results in {}".format(len(files) - failures, failures, args.output))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
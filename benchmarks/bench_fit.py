@@ -0,0 +1,155 @@
+"""
+Benchmark of the preprocessing and fitting stages on seeded synthetic traces.
+
+Every stage of the fit (and the whole update_fit path: table upload, column
+parsing, preprocessing and fits) is timed and its peak memory traced, and the
+fitted parameters are compared with the true ones. The results are written to a
+JSON file to compare commits or optimizer settings.
+
+The synthetic traces last 1 s and their O-J phase 0.3 ms: below about 1e5 samples
+the moving average leaves too few points in it and get_fit raises ValueError.
+
+    python benchmarks/bench_fit.py                                   # 1e5 and 1e6 samples, trf, analytic Jacobian
+    python benchmarks/bench_fit.py --sizes 1e7 1e8 --no-update-fit
+    python benchmarks/bench_fit.py --methods trf dogbox lm --jac analytic 2-point 3-point -o fit.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic import synthetic_trace  # noqa: E402
+import ojip_core  # noqa: E402
+#import the lazily imported dependencies of ojip_core now, so that they are not timed with the first stage
+import mvgavg  # noqa: E402,F401
+import scipy.optimize  # noqa: E402,F401
+
+
+def measure(function, *args, repeat=1):
+    """ result, best time (s) and peak traced memory (MB) of function(*args)"""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak/2**20
+
+
+def relative_error(value, truth):
+    return float(np.abs(np.asarray(value) - truth).max()/np.abs(truth)) if np.isscalar(truth) else \
+        (np.abs(np.asarray(value) - np.asarray(truth))/np.abs(truth)).tolist()
+
+
+def bench_trace(t, y, truth, N_mvg, N_log, mode, method, jac, repeat):
+    """ timings, peak memory and errors of each stage on one trace"""
+    stages = {}
+    if mode == "logbin":
+        (t_fit, y_fit, _, sigma), *stages["log_bin"] = measure(ojip_core.log_bin, t, y, N_log, repeat=repeat)
+    else:
+        (t_fit, y_fit), *stages["select_rise"] = measure(ojip_core.select_rise, t, y, repeat=repeat)
+        (t_fit, y_fit), *stages["moving_average"] = measure(ojip_core.moving_average, t_fit, y_fit, N_mvg, repeat=repeat)
+        (t_fit, y_fit), *stages["log_subsample"] = measure(ojip_core.log_subsample, t_fit, y_fit, N_log, repeat=repeat)
+        sigma = None
+    (tau_JC, _, params_JC, _), *stages["multiexp_fit"] = measure(
+        lambda: ojip_core.multiexp_fit(t_fit, y_fit, jac, sigma, None, True, method), repeat=repeat)
+    pos_tau = ojip_core.find_nearest(t_fit, 3*tau_JC)
+    params_exp, *stages["get_fit"] = measure(
+        lambda: ojip_core.get_fit(t_fit[:pos_tau], y_fit[:pos_tau], jac, None if sigma is None else sigma[:pos_tau],
+                                 None, method), repeat=repeat)
+    return {"stages": {name: {"seconds": s, "peak_mb": m} for name, (s, m) in stages.items()},
+            "points": int(t_fit.size),
+            "tau_JC": float(tau_JC), "tau": float(params_exp[1]),
+            "error_tau_JC": relative_error(tau_JC, truth["tau"]),
+            "error_tau": relative_error(params_exp[1], truth["tau"]),
+            "error_parameters_JC": relative_error(params_JC, truth["parameters"])}
+
+
+def bench_update_fit(t, y, N_mvg, N_log, mode, method, jac):
+    """ the whole update_fit path from the uploaded CSV bytes, with empty caches"""
+    import pandas as pd
+
+    data = pd.DataFrame({"time": t, "fluorescence": y}).to_csv(index=False).encode()
+
+    def update_fit():
+        store = ojip_core.store_table(data, "bench.csv")
+        table = ojip_core.dataset_store.get(store["key"])
+        ojip_core.warm_starts.put((store["key"], "time", "fluorescence"), {})
+        return ojip_core.FitPipeline().run(store["key"], table, "time", "fluorescence", N_mvg = N_mvg, N_log = N_log,
+                                          jac = jac, mode = mode, method = method)
+
+    _, seconds, peak = measure(update_fit)
+    return {"seconds": seconds, "peak_mb": peak, "csv_mb": len(data)/2**20}
+
+
+def metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    import scipy
+    return {"commit": commit, "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "numpy": np.__version__, "scipy": scipy.__version__, "machine": platform.machine(),
+            "cpus": os.cpu_count()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the OJIP fit on synthetic traces.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1e5, 1e6], help="numbers of samples")
+    parser.add_argument("--noise", type=float, default=0.005, help="standard deviation of the noise")
+    parser.add_argument("--blank", type=float, default=0.05, help="blank offset")
+    parser.add_argument("--rates", type=float, nargs=3, default=None, help="rates (1/s) of the O-J, J-I and I-P phases")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--smooth", dest="N_mvg", type=int, default=10, help="moving average window size")
+    parser.add_argument("--log", dest="N_log", type=int, default=1000, help="logarithmic subsampling size")
+    parser.add_argument("--modes", nargs="+", default=["mvgavg"], choices=["mvgavg", "logbin"])
+    parser.add_argument("--methods", nargs="+", default=["trf"], choices=["trf", "dogbox", "lm", "varpro"])
+    parser.add_argument("--jac", nargs="+", default=["analytic"], choices=["analytic", "2-point", "3-point"])
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions of each timing (best is kept)")
+    parser.add_argument("--no-update-fit", dest="update_fit", action="store_false",
+                        help="skip the update_fit path (it writes the trace to CSV)")
+    parser.add_argument("-o", "--output", default="bench_fit.json")
+    args = parser.parse_args(argv)
+
+    runs = []
+    for n_samples in args.sizes:
+        t, y, truth = synthetic_trace(n_samples, noise=args.noise, blank=args.blank, rates=args.rates, seed=args.seed)
+        repeat = args.repeat if n_samples <= 1e6 else 1
+        for mode in args.modes:
+            for method in args.methods:
+                for jac_name in args.jac:
+                    jac = True if jac_name == "analytic" else jac_name
+                    run = {"samples": int(n_samples), "mode": mode, "method": method, "jac": jac_name}
+                    try:
+                        run.update(bench_trace(t, y, truth, args.N_mvg, args.N_log, mode, method, jac, repeat))
+                        if args.update_fit:
+                            run["update_fit"] = bench_update_fit(t, y, args.N_mvg, args.N_log, mode, method, jac)
+                    except Exception as e:
+                        run["error"] = "{}: {}".format(type(e).__name__, e)
+                    runs.append(run)
+                    print("{:>10.0e} {:>7} {:>7} {:>9} {}".format(
+                        n_samples, mode, method, jac_name, run.get("error") or
+                        "fits {:.3f}s  total {:.3f}s  tau error {:.1e}".format(
+                            run["stages"]["multiexp_fit"]["seconds"] + run["stages"]["get_fit"]["seconds"],
+                            sum(s["seconds"] for s in run["stages"].values()), run["error_tau_JC"])))
+
+    config = {k: v for k, v in vars(args).items() if k != "output"}
+    with open(args.output, "w") as f:
+        json.dump({"metadata": metadata(), "config": config, "runs": runs}, f, indent=1)
+    print("results in {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
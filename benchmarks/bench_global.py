@@ -0,0 +1,74 @@
+"""
+Benchmark of the global fit of an intensity series on seeded synthetic traces.
+
+The rates of the traces grow linearly with the drive, the sigmoidicities are the
+same for all: global_fit is timed against the independent multiexp_fit of every
+trace (same preprocessing and weights), and the scatter of the O-J taus around the
+true ones is compared. The run
+fails (exit status 1) if the global fit takes more than --max-seconds.
+
+    python benchmarks/bench_global.py                                # 24 traces of 1e5 samples
+    python benchmarks/bench_global.py --curves 5 --samples 1e5 --mode mvgavg --jac 2-point
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic import synthetic_trace, DEFAULT_PARAMETERS  # noqa: E402
+import ojip_core  # noqa: E402
+
+
+def series(n_curves, n_samples, noise, seed):
+    """ traces and true taus of a series at drives from 20 to 100 (the default rates are those of drive 60)"""
+    drive = np.linspace(20, 100, n_curves)
+    traces = []
+    for i, d in enumerate(drive):
+        t, y, _ = synthetic_trace(n_samples, noise=noise, rates=np.array(DEFAULT_PARAMETERS)[[2, 5, 8]]*d/60,
+                                  seed=seed + i)
+        traces.append((t, y))
+    return traces, 60/(DEFAULT_PARAMETERS[2]*drive)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the global fit of an intensity series.")
+    parser.add_argument("--curves", type=int, default=24, help="number of traces of the series")
+    parser.add_argument("--samples", type=float, default=1e5, help="number of samples of each trace")
+    parser.add_argument("--noise", type=float, default=0.01, help="standard deviation of the noise")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log", dest="N_log", type=int, default=1000, help="number of logarithmic bins of each trace")
+    parser.add_argument("--mode", default="logbin", choices=["logbin", "mvgavg"])
+    parser.add_argument("--jac", default="analytic", choices=["analytic", "2-point", "3-point"])
+    parser.add_argument("--max-seconds", type=float, default=20, help="time limit of the global fit")
+    args = parser.parse_args(argv)
+
+    traces, tau = series(args.curves, args.samples, args.noise, args.seed)
+    start = time.perf_counter()
+    independent = []
+    for t, y in traces:
+        if args.mode == "logbin":
+            t_fit, y_fit, _, sigma = ojip_core.log_bin(t, y, N_log=args.N_log)
+        else:
+            (t_fit, y_fit), sigma = ojip_core.pre_process(t, y, N_log=args.N_log), None
+        independent.append(ojip_core.multiexp_fit(t_fit, y_fit, sigma=sigma)[0])
+    seconds_independent = time.perf_counter() - start
+    start = time.perf_counter()
+    result = ojip_core.global_fit(traces, N_log=args.N_log, mode=args.mode, jac=True if args.jac == "analytic" else args.jac)
+    seconds = time.perf_counter() - start
+
+    print("{} traces of {:.0e} samples".format(args.curves, args.samples))
+    print("independent fits {:8.2f} s  tau error {:.3f}".format(seconds_independent,
+                                                                np.std(np.array(independent)/tau - 1)))
+    print("global fit       {:8.2f} s  tau error {:.3f}  ({} evaluations, status {})".format(
+        seconds, np.std(result["tau_JC"]/tau - 1), result["result"].nfev, result["result"].status))
+    if seconds > args.max_seconds:
+        print("the global fit took more than {:g} s".format(args.max_seconds))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
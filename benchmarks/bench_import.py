@@ -0,0 +1,61 @@
+"""
+Import time of the compute core and of the app, against a time budget.
+
+Each module is imported in a fresh interpreter several times and the best wall
+time is compared with its budget; the slowest imports of the last run are listed
+(python -X importtime). The exit code is 1 if a budget is exceeded.
+
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --core-budget 0.2 --app-budget 2
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+#the app module must not start the server when imported
+SNIPPET = "import time; start = time.perf_counter(); import {}; print(time.perf_counter() - start)"
+
+
+def import_time(module, repeat=5):
+    """ best import time (s) of module in a fresh interpreter, and the -X importtime report of the last run"""
+    best = float("inf")
+    for _ in range(repeat):
+        run = subprocess.run([sys.executable, "-X", "importtime", "-c", SNIPPET.format(module)],
+                             capture_output=True, text=True, cwd=ROOT, check=True)
+        best = min(best, float(run.stdout.split()[-1]))
+    return best, run.stderr
+
+
+def slowest(report, n=8):
+    """ the n imports with the largest cumulative time (s) of a -X importtime report"""
+    rows = []
+    for line in report.splitlines():
+        if line.startswith("import time:") and "|" in line and "cumulative" not in line:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            rows.append((int(cumulative)/1e6, name.strip()))
+    return sorted(rows, reverse=True)[:n]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import-time budget of ojip_core and OJIP_fit.")
+    parser.add_argument("--core-budget", type=float, default=0.5, help="budget of ojip_core (s)")
+    parser.add_argument("--app-budget", type=float, default=3.0, help="budget of OJIP_fit (s)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    over = False
+    for module, budget in (("ojip_core", args.core_budget), ("OJIP_fit", args.app_budget)):
+        seconds, report = import_time(module, args.repeat)
+        over |= seconds > budget
+        print("{:<10} {:.3f} s (budget {:.3f} s) {}".format(module, seconds, budget,
+                                                             "OK" if seconds <= budget else "OVER BUDGET"))
+        for cumulative, name in slowest(report):
+            print("    {:.3f} s  {}".format(cumulative, name))
+    return 1 if over else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,52 @@
+"""
+Benchmark of the table ingestion against the former pd.read_csv(io.StringIO(...)) path.
+
+    python benchmarks/bench_ingest.py            # 1e6 and 1e7 rows
+    python benchmarks/bench_ingest.py 1e5 1e6    # other sizes
+"""
+import io
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import ingest  # noqa: E402
+
+
+def make_csv(n_rows, n_fluo=3, seed=0):
+    """ CSV bytes of a time column and n_fluo fluorescence columns"""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({"time": np.linspace(0, 1, n_rows)})
+    for i in range(n_fluo):
+        df["fluorescence_{}".format(i)] = rng.random(n_rows)
+    return df.to_csv(index=False).encode()
+
+
+def timed(function, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(sizes):
+    print("pyarrow available: {}".format(ingest.arrow() is not None))
+    print("{:>10} {:>10} {:>12} {:>12} {:>12} {:>12}".format(
+        "rows", "MB", "StringIO", "all columns", "2 columns", "speedup"))
+    for n_rows in sizes:
+        data = make_csv(int(n_rows))
+        repeat = 3 if n_rows <= 1e6 else 1
+        reference = timed(lambda: pd.read_csv(io.StringIO(data.decode("utf-8"))), repeat)
+        full = timed(lambda: ingest.read_columns(data, "bench.csv"), repeat)
+        two = timed(lambda: ingest.read_columns(data, "bench.csv", ["time", "fluorescence_0"]), repeat)
+        print("{:>10.0e} {:>10.1f} {:>11.3f}s {:>11.3f}s {:>11.3f}s {:>11.1f}x".format(
+            n_rows, len(data)/2**20, reference, full, two, reference/two))
+
+
+if __name__ == '__main__':
+    main([float(s) for s in sys.argv[1:]] or [1e6, 1e7])
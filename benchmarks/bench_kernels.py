@@ -0,0 +1,73 @@
+"""
+Benchmark of the fused sigmoidal_OJIP kernel against the reference functions.
+
+Times one residual + Jacobian evaluation with the module functions (residuals of
+sigmoidal_OJIP and sigmoidal_OJIP_jac), with ResidualsWithJacobian and with each
+backend of the fused kernel (numba only if it is installed), and checks that the
+kernel matches the module functions to 1e-12.
+
+    python benchmarks/bench_kernels.py
+    python benchmarks/bench_kernels.py 1e3 1e5
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import kernels  # noqa: E402
+from ojip_core import ResidualsWithJacobian, residuals, sigmoidal_OJIP, sigmoidal_OJIP_jac  # noqa: E402
+from synthetic import DEFAULT_PARAMETERS  # noqa: E402
+
+
+def evaluation_time(evaluator, P, t, y, repeat=5, calls=50):
+    """ best time (s) of one residuals + jac evaluation at new parameters"""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(calls):
+            Q = P*(1 + 1e-9*i)
+            evaluator.residuals(Q, t, y)
+            evaluator.jac(Q, t, y)
+        best = min(best, (time.perf_counter() - start)/calls)
+    return best
+
+
+class ModuleFunctions:
+    """ residuals and Jacobian from the module functions, each evaluated on its own"""
+    def __init__(self, sigma):
+        self.sigma = sigma
+
+    def residuals(self, P, t, y):
+        return residuals(P, t, y, sigmoidal_OJIP, self.sigma)
+
+    def jac(self, P, t, y):
+        return sigmoidal_OJIP_jac(P, t)[1]/self.sigma[:, None]
+
+
+def main(sizes):
+    P = np.array(DEFAULT_PARAMETERS)
+    backends = ["numpy"] + (["numba"] if kernels.numba_kernel() is not None else [])
+    print("numba available: {}".format(kernels.numba_kernel() is not None))
+    for n in sizes:
+        t = np.concatenate([[0], np.logspace(-5, 0, int(n) - 1)])
+        y = sigmoidal_OJIP(P, t) + np.random.default_rng(0).normal(0, 0.005, t.size)
+        sigma = np.full(t.size, 0.005)
+        reference = ModuleFunctions(sigma)
+        line = "{:>10.0e} functions {:8.1f} us  ResidualsWithJacobian {:8.1f} us".format(
+            n, evaluation_time(reference, P, t, y)*1e6,
+            evaluation_time(ResidualsWithJacobian(sigmoidal_OJIP, sigma), P, t, y)*1e6)
+        for backend in backends:
+            fused = kernels.FusedResiduals(sigma, backend=backend)
+            error = max(np.abs(fused.residuals(P, t, y) - reference.residuals(P, t, y)).max()
+                        /np.abs(reference.residuals(P, t, y)).max(),
+                        (np.abs(fused.jac(P, t, y) - reference.jac(P, t, y))
+                         /np.maximum(np.abs(reference.jac(P, t, y)), 1)).max())
+            assert error < 1e-12, error
+            line += "  {} {:8.1f} us (error {:.0e})".format(backend, evaluation_time(fused, P, t, y)*1e6, error)
+        print(line)
+
+
+if __name__ == '__main__':
+    main([float(s) for s in sys.argv[1:]] or [1e3, 1e4, 1e5])
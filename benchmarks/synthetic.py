@@ -0,0 +1,39 @@
+"""
+Seeded synthetic OJIP traces for the benchmarks.
+
+The rise is sigmoidal_OJIP with known parameters, delayed after a blank of
+constant offset and sampled regularly, with Gaussian noise.
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+#F0, then amplitude, rate (1/s) and sigmoidicity of the O-J, J-I and I-P phases
+DEFAULT_PARAMETERS = (0.3, 0.35, 3e3, 1.5, 0.2, 80., 1.3, 0.15, 8., 3.)
+
+
+def synthetic_trace(n_samples=10**5, noise=0.005, blank=0.05, rates=None, parameters=DEFAULT_PARAMETERS,
+                    t_max=1.0, t_start=0.01, seed=0, dtype=np.float64):
+    """
+    time, fluorescence and true parameters of a synthetic trace.
+    n_samples: number of samples (1e5 to 1e8 resolve the O-J phase of the default parameters)
+    noise: standard deviation of the Gaussian noise
+    blank: fluorescence before the light is switched on at t_start (s)
+    rates: rate constants (1/s) of the three phases, replacing those of parameters
+    The true parameters are those of sigmoidal_OJIP on t - t_start; tau is 1/rate of the O-J phase.
+    """
+    from ojip_core import sigmoidal_OJIP
+
+    parameters = np.array(parameters, dtype=float)
+    if rates is not None:
+        parameters[[2, 5, 8]] = rates
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, t_max, int(n_samples), dtype=dtype)
+    y = rng.normal(blank, noise, t.size).astype(dtype, copy=False)
+    rise = t > t_start
+    y[rise] += sigmoidal_OJIP(parameters, t[rise] - t_start)
+    truth = {"parameters": parameters.tolist(), "tau": 1/parameters[2], "t_start": t_start, "blank": blank}
+    return t, y, truth
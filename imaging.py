@@ -0,0 +1,223 @@
+"""
+Per-pixel OJIP fits of fluorescence imaging stacks.
+
+A stack (frames x height x width) is memory-mapped from a .npy file or a TIFF
+(tifffile is needed for TIFF files; compressed TIFFs are first decoded into a
+temporary memory-mapped file). It is processed by blocks of rows, each one read,
+optionally binned into square regions, preprocessed and fitted with the batched
+column fit of ojip_core (fit_columns) on a worker process: the memory used is
+bounded by the block size and the number of workers, not by the stack size.
+Regions without a fluorescence rise are masked.
+
+    python imaging.py stack.npy --frame-time 1e-5 --bin 4 --wavelength 470 -o maps.npz
+    python imaging.py stack.tif --times times.csv --workers 8 -o maps.npz
+
+The maps (.npz) can be opened in the app.
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from calibration import monochromatic, intensities
+
+
+def open_stack(path):
+    """ memory-mapped (frames, height, width) stack of a .npy or TIFF file"""
+    if path.lower().endswith(".npy"):
+        stack = np.load(path, mmap_mode="r")
+    else:
+        try:
+            import tifffile
+        except ImportError:
+            raise ImportError("tifffile is needed to read TIFF stacks (pip install tifffile)")
+        try:
+            stack = tifffile.memmap(path, mode="r")
+        except ValueError:
+            #compressed or non-contiguous: decode once into a temporary memory-mapped file
+            stack = tifffile.imread(path, out="memmap")
+    if stack.ndim != 3:
+        raise ValueError("expected a (frames, height, width) stack, got the shape {}".format(stack.shape))
+    return stack
+
+
+def read_times(path):
+    """ frame times from a .npy file or a one-column text file"""
+    if path.lower().endswith(".npy"):
+        return np.load(path).astype(float)
+    return np.loadtxt(path, delimiter=",", ndmin=1).astype(float)
+
+
+def stack_spec(stack):
+    """ what a worker needs to map the same stack again, or the array itself if it is not memory-mapped"""
+    if isinstance(stack, np.memmap) and stack.filename is not None:
+        return (stack.filename, stack.dtype.str, stack.shape, stack.offset,
+                "F" if stack.flags.f_contiguous and not stack.flags.c_contiguous else "C")
+    return stack
+
+
+def _stack(spec):
+    if isinstance(spec, tuple):
+        filename, dtype, shape, offset, order = spec
+        return np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shape, order=order)
+    return spec
+
+
+def read_block(stack, r0, r1, binning=1):
+    """ rows r0:r1 of the stack as float, averaged over binning x binning regions
+    returns (frames, r1-r0 // binning, width // binning)"""
+    block = np.asarray(stack[:, r0:r1], dtype=float)
+    if binning == 1:
+        return block
+    frames, rows, width = block.shape
+    block = block[:, :rows - rows % binning, :width - width % binning]
+    return block.reshape(frames, rows//binning, binning, width//binning, binning).mean(axis=(2, 4))
+
+
+def rise_amplitude(stack, binning=1, block_bytes=256*2**20):
+    """ maximum minus blank (mean of the first 10 frames) of every region, read by blocks of rows"""
+    frames, height, width = stack.shape
+    rows = block_rows(stack.shape, binning, block_bytes=block_bytes)
+    return np.concatenate([_amplitude(read_block(stack, r0, min(r0 + rows, height), binning))
+                           for r0 in range(0, height - height % binning, rows)])
+
+
+def _amplitude(block):
+    return block.max(axis=0) - block[:10].mean(axis=0)
+
+
+def block_rows(shape, binning=1, pixels=512, block_bytes=None):
+    """ number of rows (a multiple of binning) of a block of about `pixels` regions, or of block_bytes of float data"""
+    frames, _, width = shape
+    if block_bytes is not None:
+        rows = block_bytes // (8*frames*width)
+    else:
+        rows = pixels*binning*binning // width
+    return max(binning, rows//binning*binning)
+
+
+def fit_block(spec, times, r0, r1, binning, mask, N_mvg, N_log):
+    """ tau_JC and tau of the regions of rows r0:r1 (NaN where mask is False or the fit failed)"""
+    from ojip_core import fit_columns, fit_trace
+
+    block = read_block(_stack(spec), r0, r1, binning)
+    fluo = block[:, mask]
+    tau_JC, tau = np.full(mask.shape, np.nan), np.full(mask.shape, np.nan)
+    if fluo.shape[1] == 0:
+        return r0, tau_JC, tau
+    try:
+        result = fit_columns(times, fluo, N_mvg = N_mvg, N_log = N_log)
+        taus = result["tau_JC"], result["params_exp"][:, 1]
+    except (ValueError, np.linalg.LinAlgError):
+        #one region broke the batched fit: fit them one by one
+        taus = np.full((2, fluo.shape[1]), np.nan)
+        for i in range(fluo.shape[1]):
+            try:
+                result = fit_trace(times, fluo[:, i], N_mvg = N_mvg, N_log = N_log)
+                taus[:, i] = result["tau_JC"], result["params_exp"][1]
+            except (ValueError, np.linalg.LinAlgError):
+                pass
+    tau_JC[mask], tau[mask] = taus
+    #diverged fits
+    tau[~(tau > 0)] = np.nan
+    return r0, tau_JC, tau
+
+
+def fit_stack(stack, times, binning=1, N_mvg=1, N_log=1000, min_signal=0.1, pixels=512, workers=None,
+              progress=None):
+    '''
+    tau maps of a stack (frames, height, width) with the frame times.
+    binning: side of the square regions averaged before the fit
+    min_signal: regions whose rise is below this fraction of the 99th percentile of the rises are masked
+    pixels: regions per block of rows fitted by one task; at most 2 blocks per worker are in memory
+    workers: process pool size, 0 fits in this process
+    progress: called as progress(rows done, height) after each block
+    returns a dict of (height // binning, width // binning) maps: tau, tau_JC and mask
+    '''
+    times = np.asarray(times, dtype=float)
+    frames, height, width = stack.shape
+    if len(times) != frames:
+        raise ValueError("{} frame times for {} frames".format(len(times), frames))
+    amplitude = rise_amplitude(stack, binning)
+    mask = amplitude > min_signal*np.nanpercentile(amplitude, 99)
+    tau_JC, tau = np.full(mask.shape, np.nan), np.full(mask.shape, np.nan)
+    rows = block_rows(stack.shape, binning, pixels)
+    blocks = [(r0, min(r0 + rows, height - height % binning)) for r0 in range(0, height - height % binning, rows)]
+    progress = progress if progress is not None else (lambda done, total: None)
+
+    def store(r0, block_tau_JC, block_tau):
+        tau_JC[r0//binning:r0//binning + len(block_tau)] = block_tau_JC
+        tau[r0//binning:r0//binning + len(block_tau)] = block_tau
+        progress(min(r0 + rows, height), height)
+
+    spec = stack_spec(stack)
+    tasks = [(spec, times, r0, r1, binning, mask[r0//binning:r1//binning], N_mvg, N_log) for r0, r1 in blocks]
+    if workers == 0:
+        for task in tasks:
+            store(*fit_block(*task))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            #a bounded number of blocks in flight keeps the memory bounded
+            limit = 2*(workers or os.cpu_count() or 1)
+            pending = set()
+            for task in tasks:
+                if len(pending) >= limit:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        store(*future.result())
+                pending.add(pool.submit(fit_block, *task))
+            for future in wait(pending)[0]:
+                store(*future.result())
+    return {"tau": tau, "tau_JC": tau_JC, "mask": mask, "binning": np.array(binning)}
+
+
+def intensity_maps(maps, wl):
+    """ µE/m²/s and mW/mm² maps from the tau map and the excitation wavelength"""
+    return intensities(maps["tau"], *monochromatic(wl))
+
+
+def save_maps(path, maps, wl=None):
+    """ write the maps to a .npz file, with the intensity maps if the wavelength is given"""
+    maps = dict(maps)
+    if wl is not None:
+        maps["intensity_eins"], maps["intensity_watt"] = intensity_maps(maps, wl)
+        maps["wavelength"] = np.array(wl)
+    with open(path, "wb") as f:
+        np.savez(f, **maps)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-pixel OJIP fit of a fluorescence imaging stack.")
+    parser.add_argument("stack", help="(frames, height, width) stack, .npy or TIFF")
+    times = parser.add_mutually_exclusive_group(required=True)
+    times.add_argument("--frame-time", type=float, help="time between frames (s)")
+    times.add_argument("--times", help="frame times (s), .npy or one-column text file")
+    parser.add_argument("--bin", dest="binning", type=int, default=1, help="side of the square regions fitted (pixels)")
+    parser.add_argument("--smooth", dest="N_mvg", type=int, default=1, help="moving average window size (frames)")
+    parser.add_argument("--log", dest="N_log", type=int, default=1000, help="logarithmic subsampling size")
+    parser.add_argument("--min-signal", type=float, default=0.1,
+                        help="mask the regions whose rise is below this fraction of the brightest ones")
+    parser.add_argument("--wavelength", type=float, default=None, help="excitation wavelength (nm) to compute the intensity maps")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument("-o", "--output", default="maps.npz", help="output .npz file")
+    args = parser.parse_args(argv)
+
+    stack = open_stack(args.stack)
+    times = read_times(args.times) if args.times is not None else np.arange(stack.shape[0])*args.frame_time
+    start = time.perf_counter()
+    maps = fit_stack(stack, times, binning=args.binning, N_mvg=args.N_mvg, N_log=args.N_log,
+                     min_signal=args.min_signal, workers=args.workers,
+                     progress=lambda done, total: print("{}/{} rows".format(done, total), end="\r", flush=True))
+    print()
+    save_maps(args.output, maps, args.wavelength)
+    fitted = np.isfinite(maps["tau"]).sum()
+    print("{} of {} regions fitted in {:.1f} s, median tau = {:.3e} s, maps in {}".format(
+        fitted, maps["tau"].size, time.perf_counter() - start, np.nanmedian(maps["tau"]) if fitted else np.nan,
+        args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,141 @@
+"""
+Reading of the uploaded tables.
+
+The delimiter and header are sniffed from the first lines only, then the table is
+parsed with the multithreaded pyarrow CSV reader when pyarrow is installed (pandas'
+C parser otherwise), straight into float arrays. Once the time and fluorescence
+columns are known, only those columns are converted. pyarrow and pandas are
+imported on the first table read.
+"""
+import csv
+import io
+
+import numpy as np
+
+_arrow = []
+
+SNIFF_BYTES = 64*1024
+DELIMITERS = ",\t; "
+EXCEL_EXTENSIONS = ("xls", "xlsx", "xlsm")
+TEXT_EXTENSIONS = ("csv", "txt", "tsv", "dat")
+BOM = b"\xef\xbb\xbf"
+
+
+def arrow():
+    """ (pyarrow, pyarrow.csv), or None if pyarrow is not installed"""
+    if not _arrow:
+        try:
+            import pyarrow as pa
+            from pyarrow import csv as pa_csv
+            _arrow.append((pa, pa_csv))
+        except ImportError:
+            _arrow.append(None)
+    return _arrow[0]
+
+
+def table_format(filename):
+    """ 'excel' or 'text' from the file extension"""
+    extension = filename.lower().rsplit(".", 1)[-1]
+    if extension in EXCEL_EXTENSIONS:
+        return "excel"
+    if extension in TEXT_EXTENSIONS:
+        return "text"
+    raise ValueError('The uploaded file format is not supported. Please upload a CSV, Excel, TXT or TSV file.')
+
+
+def sniff(data):
+    """ delimiter, presence of a header line and column names of a text table, from its first lines"""
+    sample = bytes(data[:SNIFF_BYTES]).decode("utf-8", errors="ignore")
+    lines = [line for line in sample.splitlines()[:-1] or sample.splitlines() if line.strip()]
+    if not lines:
+        raise ValueError("The uploaded file is empty.")
+    try:
+        delimiter = csv.Sniffer().sniff("\n".join(lines[:20]), delimiters=DELIMITERS).delimiter
+    except csv.Error:
+        delimiter = "\t" if "\t" in lines[0] else ","
+    first = [token.strip().strip('"') for token in lines[0].split(delimiter)]
+    header = not all(_is_number(token) for token in first if token)
+    columns = first if header else [str(i) for i in range(len(first))]
+    return delimiter, header, columns
+
+
+def read_header(data, filename):
+    """ column names of a table, without parsing its values"""
+    data = _strip_bom(data)
+    if table_format(filename) == "excel":
+        import pandas as pd
+        return [str(col) for col in pd.read_excel(io.BytesIO(data), nrows=0, engine=_excel_engine()).columns]
+    return sniff(data)[2]
+
+
+def read_columns(data, filename, columns=None, dtype=np.float64):
+    """
+    Parse a table from its raw bytes into a dict {column name: array}.
+    columns: names of the columns to load (all by default); numeric columns are converted to dtype.
+    """
+    data = _strip_bom(data)
+    if table_format(filename) == "excel":
+        return _read_excel(data, columns, dtype)
+    delimiter, header, names = sniff(data)
+    if columns is None:
+        columns = names
+    missing = [col for col in columns if col not in names]
+    if missing:
+        raise KeyError("columns not found in the table: {}".format(missing))
+    if arrow() is not None:
+        return _read_arrow(data, delimiter, header, names, columns, dtype)
+    return _read_pandas(data, delimiter, header, names, columns, dtype)
+
+
+def _read_arrow(data, delimiter, header, names, columns, dtype):
+    pa, pa_csv = arrow()
+    read_options = pa_csv.ReadOptions(use_threads=True, column_names=None if header else names)
+    parse_options = pa_csv.ParseOptions(delimiter=delimiter)
+    convert_options = pa_csv.ConvertOptions(include_columns=list(columns))
+    table = pa_csv.read_csv(pa.BufferReader(memoryview(data)), read_options=read_options,
+                            parse_options=parse_options, convert_options=convert_options)
+    return {col: _as_array(table.column(col).to_numpy(), dtype) for col in columns}
+
+
+def _read_pandas(data, delimiter, header, names, columns, dtype):
+    import pandas as pd
+
+    df = pd.read_csv(io.BytesIO(data), sep=delimiter, header=0 if header else None,
+                     names=None if header else names, usecols=list(columns), engine="c")
+    return {col: _as_array(df[col].to_numpy(), dtype) for col in columns}
+
+
+def _read_excel(data, columns, dtype):
+    import pandas as pd
+
+    df = pd.read_excel(io.BytesIO(data), usecols=columns, engine=_excel_engine())
+    df.columns = [str(col) for col in df.columns]
+    return {col: _as_array(df[col].to_numpy(), dtype) for col in (columns or df.columns)}
+
+
+def _excel_engine():
+    #calamine is much faster than openpyxl when it is installed
+    try:
+        import python_calamine  # noqa: F401
+        return "calamine"
+    except ImportError:
+        return "openpyxl"
+
+
+def _as_array(values, dtype):
+    if values.dtype.kind in "fiub":
+        return values.astype(dtype, copy=False)
+    return values.astype(str)
+
+
+def _is_number(token):
+    try:
+        float(token)
+        return True
+    except ValueError:
+        return False
+
+
+def _strip_bom(data):
+    data = memoryview(data)
+    return data[len(BOM):] if bytes(data[:len(BOM)]) == BOM else data
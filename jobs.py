@@ -0,0 +1,103 @@
+"""
+Background fit jobs.
+
+The fits run on a small thread pool instead of inside the Dash callbacks, so a
+long fit does not hold a server worker. Each session has at most one live job:
+submitting a new one cancels the previous one, which stops at its next
+checkpoint. Jobs report their progress and partial results, which the app polls
+with a dcc.Interval. Threads share the in-memory caches of the app (pipeline
+stages, warm starts, stored arrays), unlike worker processes.
+"""
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobCancelled(Exception):
+    """ raised at a checkpoint of a job that was superseded"""
+
+
+class Job:
+    """
+    State of one background job, shared with the thread running it.
+    status: "queued", "running", "done", "error" or "cancelled"
+    result: last partial result reported, then the final result
+    """
+    def __init__(self, session):
+        self.id = uuid.uuid4().hex
+        self.session = session
+        self.status = "queued"
+        self.message = ""
+        self.result = None
+        self.error = None
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        """ checkpoint: stop the job here if it was cancelled"""
+        if self.cancelled:
+            raise JobCancelled(self.id)
+
+    def report(self, message, result=None):
+        """ checkpoint that also publishes a progress message and optionally a partial result"""
+        self.check()
+        self.message = message
+        if result is not None:
+            self.result = result
+
+
+class JobQueue:
+    """ runs function(job, *args) on a thread pool, one live job per session"""
+    def __init__(self, max_workers=2, keep=256):
+        self.keep = keep
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="fit-job")
+        self._jobs = OrderedDict()
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def submit(self, session, function, *args, **kwargs):
+        """ start a job for session, cancelling the job it replaces"""
+        job = Job(session)
+        with self._lock:
+            previous = self._jobs.get(self._sessions.get(session))
+            if previous is not None:
+                previous.cancel()
+            self._sessions[session] = job.id
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.keep:
+                _, old = self._jobs.popitem(last=False)
+                old.cancel()
+                if self._sessions.get(old.session) == old.id:
+                    del self._sessions[old.session]
+        self._pool.submit(self._run, job, function, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, session):
+        """ cancel the live job of session, if any"""
+        with self._lock:
+            job = self._jobs.get(self._sessions.pop(session, None))
+        if job is not None:
+            job.cancel()
+
+    def _run(self, job, function, args, kwargs):
+        try:
+            job.check()
+            job.status = "running"
+            job.result = function(job, *args, **kwargs)
+            job.status = "done"
+        except JobCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            job.error = "{}: {}".format(type(e).__name__, e)
+            job.status = "error"
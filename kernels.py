@@ -0,0 +1,157 @@
+"""
+Fused residual and Jacobian kernel of sigmoidal_OJIP.
+
+Each evaluation computes exp(-k*t), 1-exp(-k*t), its power, its log and the
+three Jacobian columns of each phase into buffers allocated once per fit,
+instead of a dozen temporary arrays per call. With numba installed the whole
+evaluation is one compiled loop over the samples; otherwise the NumPy version
+with out= buffers is used. Both match sigmoidal_OJIP_jac to 1e-12.
+"""
+import numpy as np
+
+_numba = []
+
+
+def _sigmoidal_loop(P, t, y_observed, inv_sigma, res, J):
+    #one pass over the samples, compiled by numba
+    weighted = inv_sigma.shape[0] > 0
+    for i in range(t.shape[0]):
+        ti = t[i]
+        value = P[0]
+        J[i, 0] = 1.0
+        for j in (1, 4, 7):
+            A = P[j]
+            k = P[j + 1]
+            s = P[j + 2]
+            e = np.exp(-k*ti)
+            u = 1.0 - e
+            p = u**s
+            if u > 0:
+                p_over_u = p/u
+                log_u = np.log(u)
+            else:
+                p_over_u = 0.0 if s > 1 else 1.0
+                log_u = 0.0
+            value += A*p
+            J[i, j] = p
+            J[i, j + 1] = A*s*p_over_u*ti*e
+            J[i, j + 2] = A*p*log_u
+        res[i] = value - y_observed[i]
+        if weighted:
+            res[i] *= inv_sigma[i]
+            for j in range(10):
+                J[i, j] *= inv_sigma[i]
+
+
+def numba_kernel():
+    """ the compiled _sigmoidal_loop, None if numba is not installed"""
+    if not _numba:
+        try:
+            import numba
+            _numba.append(numba.njit(cache=True)(_sigmoidal_loop))
+        except ImportError:
+            _numba.append(None)
+    return _numba[0]
+
+
+class SigmoidalWorkspace:
+    """ buffers of the NumPy kernel for tdata of n samples, or only the residuals and the Jacobian
+    by rows for the numba loop (compiled=True); J is the (samples, 10) Jacobian in both cases"""
+    def __init__(self, n, compiled=False):
+        self.res = np.empty(n)
+        if compiled:
+            self.J = np.empty((n, 10))
+            return
+        self.e = np.empty(n)
+        self.u = np.empty(n)
+        self.p = np.empty(n)
+        self.tmp = np.empty(n)
+        self.positive = np.empty(n, dtype=bool)
+        self.zero = np.empty(n, dtype=bool)
+        #Jacobian stored by column, so that each column is written contiguously
+        self.JT = np.empty((10, n))
+        self.J = self.JT.T
+
+
+def sigmoidal_numpy_kernel(P, t, y_observed, inv_sigma, ws):
+    """ residuals (ws.res) and transposed Jacobian (ws.JT) of sigmoidal_OJIP with NumPy out= buffers"""
+    e, u, p, tmp, positive, zero, JT, res = ws.e, ws.u, ws.p, ws.tmp, ws.positive, ws.zero, ws.JT, ws.res
+    res.fill(P[0])
+    JT[0].fill(1.0)
+    for j in (1, 4, 7):
+        A, k, s = P[j], P[j + 1], P[j + 2]
+        np.multiply(t, -k, out=e)
+        np.exp(e, out=e)
+        np.subtract(1.0, e, out=u)
+        np.power(u, s, out=p)
+        np.greater(u, 0, out=positive)
+        np.logical_not(positive, out=zero)
+        np.multiply(p, A, out=tmp)
+        res += tmp
+        JT[j] = p
+        #d(u**s)/dk = A*s*(p/u)*t*e, with the limit of p/u at u=0
+        np.divide(p, u, out=tmp, where=positive)
+        np.copyto(tmp, 0.0 if s > 1 else 1.0, where=zero)
+        np.multiply(tmp, t, out=JT[j + 1])
+        JT[j + 1] *= e
+        JT[j + 1] *= A*s
+        #d(u**s)/ds = A*p*log(u), 0 at u=0
+        np.log(u, out=tmp, where=positive)
+        np.copyto(tmp, 0.0, where=zero)
+        np.multiply(p, tmp, out=JT[j + 2])
+        JT[j + 2] *= A
+    res -= y_observed
+    if inv_sigma is not None:
+        res *= inv_sigma
+        JT *= inv_sigma
+
+
+class FusedResiduals:
+    '''
+    Residuals and Jacobian of sigmoidal_OJIP for optimize.least_squares, like
+    ResidualsWithJacobian but computed by the fused kernel into buffers reused
+    for the whole fit, and returned without copies. least_squares only asks for
+    the Jacobian of the steps it accepts: trial steps are computed into a second
+    workspace, which becomes the current one when its Jacobian is asked, so the
+    arrays of the current iterate stay valid while the trial steps are evaluated.
+    backend: "numba", "numpy", or None for numba when installed
+    '''
+    def __init__(self, sigma=None, backend=None):
+        self.inv_sigma = None if sigma is None else 1/np.asarray(sigma, dtype=float)
+        self.compiled = numba_kernel() if backend in (None, "numba") else None
+        if backend == "numba" and self.compiled is None:
+            raise ImportError("the numba backend needs numba")
+        self.backend = "numba" if self.compiled is not None else "numpy"
+        #workspaces of the current iterate and of the trial step, with the keys of their parameters
+        self._workspaces = None
+        self._keys = [None, None]
+
+    def _evaluate(self, parameters, x_data, y_observed):
+        key = (parameters.tobytes(), id(x_data), id(y_observed))
+        if key == self._keys[0]:
+            return self._workspaces[0]
+        if key != self._keys[1]:
+            P = np.asarray(parameters, dtype=float)
+            t = np.asarray(x_data, dtype=float)
+            if self._workspaces is None or self._workspaces[0].res.size != t.size:
+                self._workspaces = [SigmoidalWorkspace(t.size, self.compiled is not None) for _ in range(2)]
+                self._keys = [None, None]
+            ws = self._workspaces[1]
+            if self.compiled is not None:
+                self.compiled(P, t, np.asarray(y_observed, dtype=float),
+                              self.inv_sigma if self.inv_sigma is not None else np.empty(0), ws.res, ws.J)
+            else:
+                sigmoidal_numpy_kernel(P, t, y_observed, self.inv_sigma, ws)
+            self._keys[1] = key
+        return self._workspaces[1]
+
+    def residuals(self, parameters, x_data, y_observed):
+        return self._evaluate(parameters, x_data, y_observed).res
+
+    def jac(self, parameters, x_data, y_observed):
+        ws = self._evaluate(parameters, x_data, y_observed)
+        if ws is self._workspaces[1]:
+            #accepted step: the trial workspace becomes the current one
+            self._workspaces.reverse()
+            self._keys.reverse()
+        return ws.J
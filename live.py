@@ -0,0 +1,297 @@
+"""
+Live acquisition: fit a trace while the fluorimeter is still recording.
+
+The samples come from a growing text file, a pipe or a local socket, as lines of
+the same table format as the uploads. They are log-binned online: the blank, the
+rise threshold and the bin sums are updated with each chunk, so the work per chunk
+does not grow with the length of the recording. The JC and exponential fits are
+redone at most every `interval` seconds, each one starting from the previous solution.
+
+    python live.py recording.csv --wavelength 470        # follow a growing file
+    acquisition | python live.py - --wavelength 470      # read a pipe
+    python live.py tcp:127.0.0.1:5000                    # read a local socket
+"""
+import argparse
+import io
+import os
+import socket
+import stat
+import sys
+import time
+
+import numpy as np
+
+from ingest import sniff
+from ojip_core import bin_sem, multiexp_fit, get_fit, find_nearest, fit_result, intensity_values, intensity_intervals
+
+
+def follow_file(path, poll=0.2, chunk=2**20):
+    """ chunks of bytes of a file, then of what is appended to it; b"" every poll seconds without new data"""
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(chunk)
+            if not data:
+                time.sleep(poll)
+            yield data
+
+
+def read_stream(stream, chunk=2**16):
+    """ chunks of bytes of a pipe or file object, until its end"""
+    read = getattr(stream, "read1", stream.read)
+    while True:
+        data = read(chunk)
+        if not data:
+            return
+        yield data
+
+
+def read_fifo(path, chunk=2**16):
+    with open(path, "rb") as f:
+        yield from read_stream(f, chunk)
+
+
+def read_socket(address, timeout=0.2, chunk=2**16):
+    """ chunks of bytes from a TCP (host, port) or unix socket path, until the peer closes;
+    b"" every timeout seconds without new data"""
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    with socket.socket(family, socket.SOCK_STREAM) as s:
+        s.connect(address)
+        s.settimeout(timeout)
+        while True:
+            try:
+                data = s.recv(chunk)
+            except socket.timeout:
+                yield b""
+                continue
+            if not data:
+                return
+            yield data
+
+
+def open_source(spec):
+    """ chunks of bytes of a live source: "-" (stdin), "tcp:host:port", "unix:path", a named pipe
+    or a file, followed as it grows"""
+    if spec == "-":
+        return read_stream(sys.stdin.buffer)
+    if spec.startswith("tcp:"):
+        host, port = spec[4:].rsplit(":", 1)
+        return read_socket((host, int(port)))
+    if spec.startswith("unix:"):
+        return read_socket(spec[5:])
+    if stat.S_ISFIFO(os.stat(spec).st_mode):
+        return read_fifo(spec)
+    return follow_file(spec)
+
+
+class LineParser:
+    """
+    Time and fluorescence values of a text table arriving in chunks split anywhere.
+    The delimiter and header are sniffed from the first 3 complete lines, as for the uploads;
+    key_time and key_fluo default to the first two columns.
+    """
+    def __init__(self, key_time=None, key_fluo=None, sniff_lines=3):
+        self.key_time = key_time
+        self.key_fluo = key_fluo
+        self.sniff_lines = sniff_lines
+        self.columns = None
+        self._delimiter = None
+        self._usecols = None
+        self._rest = b""
+
+    def feed(self, data):
+        """ (t, y) arrays of the lines completed by data"""
+        data = self._rest + data
+        end = data.rfind(b"\n") + 1
+        lines, self._rest = data[:end], data[end:]
+        if self.columns is None:
+            if lines.count(b"\n") < self.sniff_lines:
+                self._rest = data
+                return np.empty(0), np.empty(0)
+            lines = self._sniff(lines)
+        if not lines.strip():
+            return np.empty(0), np.empty(0)
+        values = np.loadtxt(io.StringIO(lines.decode("utf-8", errors="ignore")), delimiter=self._delimiter,
+                            usecols=self._usecols, ndmin=2)
+        return values[:, 0], values[:, 1]
+
+    def _sniff(self, lines):
+        delimiter, header, self.columns = sniff(lines)
+        self._delimiter = None if delimiter == " " else delimiter
+        key_time = self.key_time if self.key_time is not None else self.columns[0]
+        key_fluo = self.key_fluo if self.key_fluo is not None else self.columns[1]
+        missing = [col for col in (key_time, key_fluo) if col not in self.columns]
+        if missing:
+            raise KeyError("columns not found in the table: {}".format(missing))
+        self._usecols = (self.columns.index(key_time), self.columns.index(key_fluo))
+        #the header line is not data
+        return lines[lines.find(b"\n") + 1:] if header else lines
+
+
+class LiveBinner:
+    '''
+    log_bin computed online, one chunk of samples at a time.
+    The blank is the mean of the first 10 samples. The rise is detected once the maximum exceeds the blank
+    by min_snr standard deviations of these samples, and starts at the first sample above 10% of the maximum
+    so far. The bins are logarithmic from the first time step of the rise, N_log bins over `decades` decades
+    (the final length of the trace is not known), with their counts, sums and sums of squares accumulated.
+    The first `prefix` samples of the rise are kept: if a higher maximum moves the start of the rise, the
+    bins are rebuilt from them; past them, the start of the rise stays where it is.
+    '''
+    def __init__(self, N_log=1000, decades=6, min_snr=10, prefix=2**16):
+        self.bins_per_decade = N_log/decades
+        self.min_snr = min_snr
+        self.prefix = prefix
+        self.n = 0
+        self.blank = None
+        self.maximum = -np.inf
+        self._first = []
+        self._noise = 0
+        self._prefix_t = np.empty(0)
+        self._prefix_y = np.empty(0)
+        self._sums = np.zeros((4, 0))
+        self.t0 = None
+        self.dt = None
+
+    def add(self, t, y):
+        """ add a chunk of samples, in time order"""
+        t, y = np.asarray(t, dtype=float), np.asarray(y, dtype=float)
+        self.n += len(t)
+        if self.blank is None:
+            self._first += list(zip(t, y))
+            if len(self._first) < 10:
+                return
+            first = np.array(self._first[:10])
+            self.blank, self._noise = first[:, 1].mean(), first[:, 1].std()
+            t, y = np.array(self._first).T
+            self._first = None
+        if len(y) == 0:
+            return
+        self.maximum = max(self.maximum, y.max())
+        threshold = self.blank + 0.1*(self.maximum - self.blank)
+
+        if self.t0 is None:
+            if self.maximum - self.blank <= self.min_snr*self._noise:
+                return
+            start = int(np.argmax(y > threshold))
+            t, y = t[start:], y[start:]
+            self.t0 = t[0]
+        keep = len(self._prefix_t) < self.prefix
+        if keep:
+            self._prefix_t = np.concatenate([self._prefix_t, t])
+            self._prefix_y = np.concatenate([self._prefix_y, y])
+        if keep and (self.dt is None or self._prefix_y[0] <= threshold):
+            #first time step, or the start of the rise moved within the samples kept: bin them again
+            start = int(np.argmax(self._prefix_y > threshold))
+            self._prefix_t, self._prefix_y = self._prefix_t[start:], self._prefix_y[start:]
+            self._rebin()
+        else:
+            self._accumulate(t, y)
+
+    def _rebin(self):
+        self.t0 = self._prefix_t[0]
+        self._sums = np.zeros((4, 0))
+        if len(self._prefix_t) > 1:
+            self.dt = self._prefix_t[1] - self.t0
+            self._accumulate(self._prefix_t, self._prefix_y)
+
+    def _accumulate(self, t, y):
+        if len(t) == 0:
+            return
+        u = (t - self.t0)/self.dt
+        index = np.where(u < 1, 0, np.floor(self.bins_per_decade*np.log10(np.maximum(u, 1))).astype(int) + 1)
+        sums = np.zeros((4, max(self._sums.shape[1], index.max() + 1)))
+        sums[:, :self._sums.shape[1]] = self._sums
+        y = y - self.blank
+        for i, weights in enumerate((None, t - self.t0, y, y*y)):
+            sums[i] += np.bincount(index, weights=weights, minlength=sums.shape[1])
+        self._sums = sums
+
+    def bins(self):
+        """ bin times (from the rise start), means (blank removed), counts and standard errors, as log_bin"""
+        if self.t0 is None or self._sums.shape[1] == 0:
+            return np.empty(0), np.empty(0), np.empty(0, dtype=int), np.empty(0)
+        counts, sum_t, sum_y, squares = self._sums[:, self._sums[0] > 0]
+        t_mean, y_mean = sum_t/counts, sum_y/counts
+        return t_mean, y_mean, counts.astype(int), bin_sem(counts, y_mean, squares, self._noise)
+
+
+class LiveFit:
+    """ refits of the bins of a LiveBinner, at most every interval seconds, each one warm-started from the last"""
+    def __init__(self, binner, interval=1.0, min_bins=20, jac=True, method="trf"):
+        self.binner = binner
+        self.interval = interval
+        self.min_bins = min_bins
+        self.jac = jac
+        self.method = method
+        self.result = None
+        self.error = None
+        self._warm = {}
+        self._fitted = 0
+        self._last = -np.inf
+
+    def update(self, force=False):
+        """ refit if new samples arrived and interval seconds passed (or force); returns the new
+        fit (same dict as fit_trace, plus the number of samples) or None"""
+        if self.binner.n == self._fitted or (not force and time.monotonic() - self._last < self.interval):
+            return None
+        t, y, _, sigma = self.binner.bins()
+        if len(t) < self.min_bins:
+            return None
+        self._last, self._fitted = time.monotonic(), self.binner.n
+        try:
+            tau, ypred, params_JC, cov_JC = multiexp_fit(t, y, jac=self.jac, sigma=sigma, x0=self._warm.get("jc"),
+                                                         full_output=True, method=self.method)
+            pos_tau = find_nearest(t, 3*tau)
+            params, cov = get_fit(t[:pos_tau], y[:pos_tau], jac=self.jac, sigma=sigma[:pos_tau],
+                                  x0=self._warm.get("exp"), method=self.method, full_output=True)
+        except (ValueError, np.linalg.LinAlgError) as e:
+            #too early in the rise for the exponential fit: keep the last fit
+            self.error = "{}: {}".format(type(e).__name__, e)
+            return None
+        self.error = None
+        self._warm = {"jc": params_JC, "exp": params}
+        self.result = fit_result(t, y, sigma, ypred, tau, params_JC, cov_JC, params, cov)
+        self.result["samples"] = self.binner.n
+        return self.result
+
+
+def live_fits(chunks, key_time=None, key_fluo=None, N_log=1000, interval=1.0, jac=True, method="trf"):
+    """ fits of a live source (chunks of bytes, see open_source) as it is recorded: yields the new fit,
+    or None for the chunks that did not give one, so that the caller can stop between chunks"""
+    parser = LineParser(key_time, key_fluo)
+    fit = LiveFit(LiveBinner(N_log), interval, jac=jac, method=method)
+    for data in chunks:
+        fit.binner.add(*parser.feed(data))
+        yield fit.update()
+    #end of the source: last fit with all the samples
+    yield fit.update(force=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit an OJIP trace while it is being recorded.")
+    parser.add_argument("source", help='growing file, named pipe, "-" for stdin, tcp:host:port or unix:path')
+    parser.add_argument("--time", dest="key_time", default=None, help="time column (default: first column)")
+    parser.add_argument("--fluo", dest="key_fluo", default=None, help="fluorescence column (default: second column)")
+    parser.add_argument("--log", dest="N_log", type=int, default=1000, help="number of logarithmic bins over 6 decades")
+    parser.add_argument("--interval", type=float, default=1.0, help="minimum time between two fits (s)")
+    parser.add_argument("--wavelength", type=float, default=None, help="excitation wavelength (nm) to compute the intensity")
+    args = parser.parse_args(argv)
+
+    try:
+        for result in live_fits(open_source(args.source), args.key_time, args.key_fluo, args.N_log, args.interval):
+            if result is None:
+                continue
+            tau, (low, high) = result["params_exp"][1], result["tau_ci"]
+            line = "{} samples: tau = {:.3e} s (95%: {:.3e} - {:.3e})".format(result["samples"], tau, low, high)
+            if args.wavelength is not None:
+                eins, watt = intensity_values(result["params_exp"], args.wavelength)
+                (eins_low, eins_high), _ = intensity_intervals(result["tau_ci"], args.wavelength)
+                line += ", {:.3e} µE/m²/s ({:.3e} - {:.3e}), {:.3e} mW/mm²".format(eins, eins_low, eins_high, watt)
+            print(line, flush=True)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,1127 @@
+"""
+Compute core of the OJIP fit, without the user interface.
+
+Preprocessing (blank, smoothing, logarithmic subsampling or binning), the
+Joly & Carpentier and exponential fits, the cached fit pipeline and the
+server-side storage of the uploaded tables. Only numpy is imported with the
+module: scipy, mvgavg and pandas are imported by the functions that need them,
+so scripts and worker processes start quickly. OJIP_fit.py builds the Dash app
+on top of it and re-exports it.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError, as_completed
+
+import numpy as np
+
+from ingest import read_columns, read_header
+from storage import DatasetStore
+import telemetry
+from kernels import FusedResiduals
+from calibration import sigma_spectra, wavelength, sigma_at, monochromatic, intensities
+
+
+#"fused": residuals and Jacobian of sigmoidal_OJIP from kernels.FusedResiduals (numba if installed),
+#"reference": from sigmoidal_OJIP_jac
+KERNEL = os.environ.get("OJIP_KERNEL", "fused")
+
+#uploaded tables and fit arrays stay on the server, the browser only gets their key
+#set OJIP_STORE_DIR to also keep them on disk
+dataset_store = DatasetStore(max_bytes = int(os.environ.get("OJIP_STORE_MAX_MB", 512))*2**20,
+                             directory = os.environ.get("OJIP_STORE_DIR"))
+
+#memory of the cached stage results of a FitPipeline: one stage of a 1e7-sample trace holds 160 MB
+PIPELINE_MAX_BYTES = int(os.environ.get("OJIP_PIPELINE_MAX_MB", 512))*2**20
+
+
+def pre_process(time_array, fluo, N_mvg = 10, N_log = 1000 ):
+    t, y = select_rise(time_array, fluo)
+    t, y = moving_average(t, y, N_mvg)
+    return log_subsample(t, y, N_log)
+
+
+def select_rise(time_array, fluo):
+    """ first stage of pre_process: remove the blank, normalise and keep the fluorescence rise"""
+    time_array = np.asarray(time_array)
+    fluo = np.asarray(fluo)
+
+    #remove blank
+    blank = np.mean(fluo[0:10])
+    fluo = fluo-blank
+
+    #stop at max
+    #stop_fluo = int(np.argmax(fluo))
+    #fluo = fluo[0:stop_fluo]
+    #time_array = time_array[0:stop_fluo]
+
+    #normalise
+    fluo_ref = fluo/fluo.max()    
+
+    #collect the fluorescence rise: during the jump of light
+    ind_ref = (fluo_ref>0.1)
+    return time_array[ind_ref], fluo[ind_ref]
+
+
+def moving_average(t, y, N_mvg = 10):
+    """ second stage of pre_process: binned moving average, time starting at 0"""
+    from mvgavg import mvgavg
+
+    binit = True
+    t = mvgavg(t, N_mvg, binning = binit)
+    y = mvgavg(y, N_mvg, binning = binit)
+    
+    # start at 0
+    t-=t[0]
+    return t, y
+
+
+def log_subsample(t, y, N_log = 1000):
+    """ last stage of pre_process: logarithmic subsampling to accelerate the fit"""
+    ind= np.unique(np.logspace(np.log10(1), np.log10(len(t)-1), N_log).astype(int))
+    return t[ind], y[ind]
+
+
+def log_bin(time_array, fluo, N_log = 1000, chunk = 2**20):
+    '''
+    Alternative to pre_process: average the fluorescence rise directly in N_log logarithmic time bins.
+    The rise starts at the first sample above 10% of the (blank-corrected) maximum.
+    Bins are found with one searchsorted on the sorted times and summed with np.add.reduceat;
+    the sums of squares are accumulated by chunks so that memory stays O(bins) beyond the input.
+    Returns the bin times (from the rise start), the bin means (blank removed), the counts and
+    the standard errors of the means, to be used as fit weights.
+    '''
+    time_array = np.asarray(time_array, dtype=float)
+    fluo = np.asarray(fluo, dtype=float)
+
+    #remove blank and collect the fluorescence rise
+    blank = np.mean(fluo[0:10])
+    threshold = blank + 0.1*(fluo.max()-blank)
+    start = next((c0 + int(np.argmax(fluo[c0:c0+chunk] > threshold)) for c0 in range(0, len(fluo), chunk)
+                  if fluo[c0:c0+chunk].max() > threshold), None)
+    if start is None:
+        raise ValueError("no fluorescence rise found")
+    t = time_array[start:]
+    y = fluo[start:]
+    n = len(t)
+
+    #logarithmic edges from the first time step to the end of the trace
+    t0 = t[0]
+    edges = t0 + np.concatenate([[0], np.logspace(np.log10(t[1]-t0), np.log10(t[-1]-t0), N_log)[:-1]])
+    starts = np.unique(np.searchsorted(t, edges))
+    starts = starts[starts < n]
+    counts = np.diff(np.append(starts, n))
+
+    t_mean = np.add.reduceat(t, starts)/counts - t0
+    y_mean = np.add.reduceat(y, starts)/counts - blank
+
+    #sums of squares by chunks, bins overlapping two chunks get both contributions
+    squares = np.zeros(len(starts))
+    for c0 in range(0, n, chunk):
+        c1 = min(c0+chunk, n)
+        first = np.searchsorted(starts, c0, side='right') - 1
+        last = np.searchsorted(starts, c1)
+        local = np.maximum(starts[first:last], c0) - c0
+        squares[first:last] += np.add.reduceat(np.square(y[c0:c1]-blank), local)
+
+    return t_mean, y_mean, counts, bin_sem(counts, y_mean, squares, np.std(fluo[0:10]))
+
+
+def bin_sem(counts, means, squares, noise):
+    """ standard errors of the bin means from the counts, means and sums of squares of the bins;
+    noise is the standard deviation used when no bin has more than one sample"""
+    variance = np.maximum(squares/counts - means**2, 0)*counts/np.maximum(counts-1, 1)
+    #single-sample bins get the typical noise of the multi-sample bins
+    std = np.sqrt(variance)
+    std[counts == 1] = np.median(std[counts > 1]) if (counts > 1).any() else noise
+    return np.maximum(std, np.finfo(float).tiny)/np.sqrt(counts)
+
+
+def pre_process_columns(time_array, fluo, N_mvg = 10, N_log = 1000 ):
+    """ pre_process applied column-wise to fluo of shape (samples, columns) sharing one time array.
+    All columns are cut at the earliest threshold crossing so that they keep a common time grid."""
+    time_array = np.asarray(time_array, dtype=float)
+    fluo = np.asarray(fluo, dtype=float)
+
+    #remove blank
+    fluo = fluo - fluo[0:10].mean(axis=0)
+
+    #collect the fluorescence rise from the first column above 10% of its max
+    start = int(np.argmax((fluo/fluo.max(axis=0) > 0.1).any(axis=1)))
+
+    #perform moving average
+    from mvgavg import mvgavg
+
+    t = mvgavg(time_array[start:], N_mvg, binning = True)
+    y = mvgavg(fluo[start:], N_mvg, axis = 0, binning = True)
+
+    # start at 0
+    t -= t[0]
+
+    #logarithmic subsampling to accelerate the fit
+    ind = np.unique(np.logspace(np.log10(1), np.log10(len(t)-1), N_log).astype(int))
+    return t[ind], y[ind]
+
+
+def sigmoidal_OJIP(parameters, tdata):
+    F0 = parameters[0]
+    Aoj = parameters[1]
+    koj = parameters[2]
+    soj = parameters[3]
+    Aji = parameters[4]
+    kji = parameters[5]
+    sji = parameters[6]
+    Aip = parameters[7]
+    kip = parameters[8]
+    sip = parameters[9]
+    y = F0 + Aoj*(1-np.exp(-koj*tdata))**soj + Aji*(1-np.exp(-kji*tdata))**sji +  Aip*(1-np.exp(-kip*tdata))**sip
+
+    return y
+
+
+def sigmoidal_OJIP_jac(parameters, tdata):
+    """ value and analytic Jacobian of sigmoidal_OJIP, sharing the exp terms of each phase
+    parameters may be a batch (..., 10): y is then (..., samples) and J (..., samples, 10)"""
+    tdata = np.asarray(tdata, dtype=float)
+    P = np.asarray(parameters, dtype=float)
+    y = np.repeat(P[..., 0, None], tdata.size, axis=-1)
+    J = np.empty(y.shape + (10,))
+    J[..., 0] = 1
+    for i in (1, 4, 7):
+        A, k, s = P[..., i, None], P[..., i+1, None], P[..., i+2, None]
+        e = np.exp(-k*tdata)
+        u = 1-e
+        p = u**s
+        y += A*p
+        J[..., i] = p
+        #d(u**s)/dk = s*u**(s-1)*t*e, written with p/u to reuse p (its limit at u=0 is 0 for s>1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p_over_u = np.where(u > 0, p/u, np.where(s > 1, 0.0, 1.0))
+            log_u = np.where(u > 0, np.log(u), 0.0)
+        J[..., i+1] = A*s*p_over_u*tdata*e
+        J[..., i+2] = A*p*log_u
+    return y, J
+
+
+JC_BOUNDS = ([-1e5,-1e5, 0, 1,-1e5, 0, 1,-1e5, 0, 1], [1e5,1e5, 1e5, 20,1e5, 1e5, 20,1e5, 1e5, 20])
+
+
+def jc_initial_guess(y):
+    """ initial parameters of sigmoidal_OJIP based on Joly & Carpentier, 2009"""
+    dF = y.max()-y.min()
+    return [y.min(), dF/2, 5E3, 1.24, dF/4, 0.06E3, 1.2, dF/4, 0.0023E3, 8.2]
+
+
+def multiexp_fit(t, y, jac=True, sigma=None, x0=None, full_output=False, method="trf"):
+    """ triexponential sigmoidal fit of the fluorescence rise based on Joly & Carpentier 2009
+    jac: use the analytic Jacobian, False (or "2-point", "3-point") falls back to finite differences
+    sigma: standard errors of y (from log_bin) to weight the fit
+    x0: warm start (parameters of a previous fit of the same trace), the Joly & Carpentier
+    guess is used if it is None or if the fit from it diverges
+    full_output: also return the fitted parameters and their covariance (parameter_covariance)
+    method: least_squares algorithm, "lm" fits without the bounds, "varpro" solves F0 and the
+    amplitudes exactly and iterates over the rates and sigmoidicities only"""
+
+    parameters_estimated = warm_least_squares(sigmoidal_OJIP, x0, jc_initial_guess(y), t, y,
+                                              jac = jac, sigma = sigma, bounds = JC_BOUNDS, method = method)
+    
+    #recover the characteristic time of the first phase (O-J)
+    tau = 1/parameters_estimated.x[2]
+    
+    ypred = sigmoidal_OJIP(parameters_estimated.x, t)
+    
+    if full_output:
+        return tau, ypred, parameters_estimated.x, parameter_covariance(parameters_estimated)
+    return tau, ypred
+    
+
+
+def exp_initial_guess(t, y):
+    """ crude initial parameters of exp_decay"""
+    time_spread = t.max()-t.min()
+    start = np.mean(y[0])
+    stop = np.mean(y[-10:])
+    return [start, 1/time_spread, stop]
+
+
+def get_fit(t, y, jac=True, sigma=None, x0=None, method="trf", full_output=False):
+    """ two-pass exp_decay fit, the second pass restricted to the first 5 tau
+    jac: use the analytic Jacobian, False (or "2-point", "3-point") falls back to finite differences
+    sigma: standard errors of y (from log_bin) to weight the fit
+    x0: warm start of the first pass (parameters of a previous fit of the same trace),
+    exp_initial_guess is used if it is None or if the fit from it diverges
+    method: least_squares algorithm, "varpro" solves A and y0 exactly and iterates over tau only
+    full_output: also return the covariance of the parameters of the second pass"""
+    #three parameters need three points: a sampling coarser than the O-J phase leaves fewer
+    if len(t) < 3:
+        raise ValueError("%d points before 3 tau of the rise, the sampling is too coarse to fit it" % len(t))
+    x0_cold = exp_initial_guess(t, y)
+    t = t-t[0]
+
+    parameters_estimated = warm_least_squares(exp_decay, x0, x0_cold, t, y, jac = jac, sigma = sigma, bounds = (-1e8,1e8),
+                                              method = method)
+
+    tau = parameters_estimated.x[1]
+
+    pos_tau = find_nearest(t, tau)
+
+    x0 = parameters_estimated.x #initial guess: parameters from previous fit
+    #second fit
+    stop = max(int(pos_tau*5), 3)
+    parameters_estimated  = least_squares_model(exp_decay, x0, t[0:stop], y[0:stop],
+                                            jac = jac, sigma = None if sigma is None else sigma[0:stop],
+                                            bounds = (-1e9,1e9), method = method)
+
+    if full_output:
+        return parameters_estimated.x, parameter_covariance(parameters_estimated)
+    return  parameters_estimated.x
+
+
+def preview_fit(t, y, sigma=None, window=3, n_tau=200, chunk=2**20):
+    """ fast approximate exp_decay parameters [A, tau, y0] of the preprocessed rise, without iterations
+    tau is searched on a logarithmic grid: for each tau, A and y0 are solved in closed form over the
+    first window*tau of the rise, like the window of the exponential fit, and the tau explaining
+    the largest fraction of the variance in its window is refined by a parabola in log(tau)"""
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y, dtype=float)
+    t = t-t[0]
+    w = np.ones_like(y) if sigma is None else 1/np.asarray(sigma, dtype=float)**2
+    taus = np.logspace(np.log10(t[t > 0].min()), np.log10(t[-1]/window), n_tau)
+    sums = np.empty((6, n_tau))
+    step = max(1, chunk//len(t))
+    for k0 in range(0, n_tau, step):
+        tau = taus[k0:k0+step, None]
+        #weights of the points inside the window of each tau
+        W = w*(t <= window*tau)
+        U = (1-np.exp(-t/tau))**1.24
+        WU = W*U
+        sums[:, k0:k0+step] = [W.sum(1), WU.sum(1), (WU*U).sum(1), W@y, WU@y, W@(y*y)]
+    n, Su, Suu, Sy, Suy, Syy = sums
+    with np.errstate(divide="ignore", invalid="ignore"):
+        A = (n*Suy - Su*Sy)/(n*Suu - Su**2)
+        y0 = (Sy - A*Su)/n
+        unexplained = (Syy - A*Suy - y0*Sy)/(Syy - Sy**2/n)
+    #a few points are always explained
+    counts = (t[None, :] <= window*taus[:, None]).sum(1)
+    unexplained[(counts < 10) | ~np.isfinite(unexplained)] = np.inf
+    k = int(np.argmin(unexplained))
+    if not np.isfinite(unexplained[k]):
+        raise ValueError("no exponential rise found in the trace")
+    log_tau = np.log(taus[k])
+    if 0 < k < n_tau-1 and np.isfinite(unexplained[k-1:k+2]).all():
+        left, centre, right = unexplained[k-1:k+2]
+        curvature = left - 2*centre + right
+        if curvature > 0:
+            log_tau += 0.5*(left - right)/curvature*np.log(taus[1]/taus[0])
+    return np.array([A[k], np.exp(log_tau), y0[k]])
+
+
+def find_nearest(array, value):
+    array = np.asarray(array)
+    idx = (np.abs(array - value)).argmin()
+    return idx
+
+
+
+    
+def exp_decay(parameters, xdata):
+    '''
+    Calculate an exponential decay of the form:
+    S = a * exp(-xdata/b)
+    '''
+    A = parameters[0]
+    tau = parameters[1]
+    y0 = parameters[2]
+    return A * (1 - np.exp(-xdata/tau))**1.24 + y0
+
+
+def exp_decay_jac(parameters, xdata):
+    """ value and analytic Jacobian of exp_decay, sharing the exp term
+    parameters may be a batch (..., 3): y is then (..., samples) and J (..., samples, 3)"""
+    xdata = np.asarray(xdata, dtype=float)
+    P = np.asarray(parameters, dtype=float)
+    A = P[..., 0, None]
+    tau = P[..., 1, None]
+    y0 = P[..., 2, None]
+    e = np.exp(-xdata/tau)
+    u = 1 - e
+    p = u**1.24
+    J = np.empty(p.shape + (3,))
+    J[..., 0] = p
+    J[..., 1] = -A*1.24*u**0.24*e*xdata/tau**2
+    J[..., 2] = 1
+    return A*p + y0, J
+
+
+def residuals(parameters, x_data, y_observed, func, sigma=None):
+    '''
+    Compute residuals of y_predicted - y_observed
+    where:
+    y_predicted = func(parameters,x_data)
+    divided by the standard errors sigma if given
+    '''
+    if sigma is None:
+        return func(parameters,x_data) - y_observed
+    return (func(parameters,x_data) - y_observed)/sigma
+
+
+#analytic Jacobians of the fitted models
+MODEL_JACOBIANS = {sigmoidal_OJIP: sigmoidal_OJIP_jac, exp_decay: exp_decay_jac}
+
+#separable structure of the models for variable projection: indices of the parameters entering linearly,
+#of the nonlinear ones, and of the linear parameter multiplying the term each nonlinear one belongs to
+VARPRO_MODELS = {sigmoidal_OJIP: ([0, 1, 4, 7], [2, 3, 5, 6, 8, 9], [1, 1, 4, 4, 7, 7]),
+                 exp_decay: ([0, 2], [1], [0])}
+
+
+class ResidualsWithJacobian:
+    '''
+    Residuals and Jacobian of func for optimize.least_squares.
+    least_squares asks for fun and jac separately at the same parameters,
+    so the last evaluation is kept and the exp terms are computed once.
+    '''
+    def __init__(self, func, sigma=None):
+        self.model_jac = MODEL_JACOBIANS[func]
+        self.sigma = sigma
+        self._key = None
+
+    def _evaluate(self, parameters, x_data, y_observed):
+        key = (parameters.tobytes(), id(x_data), id(y_observed))
+        if key != self._key:
+            y, self._J = self.model_jac(parameters, x_data)
+            self._res = y - y_observed
+            if self.sigma is not None:
+                self._res /= self.sigma
+                self._J /= self.sigma[:, None]
+            self._key = key
+        return self._res, self._J
+
+    def residuals(self, parameters, x_data, y_observed):
+        return self._evaluate(parameters, x_data, y_observed)[0]
+
+    def jac(self, parameters, x_data, y_observed):
+        return self._evaluate(parameters, x_data, y_observed)[1]
+
+
+class VarProResiduals:
+    '''
+    Variable projection (Golub & Pereyra) residuals of a separable model for optimize.least_squares.
+    For given nonlinear parameters, the linear ones are solved exactly by linear least squares, so the
+    residuals depend on the nonlinear parameters only. The Jacobian is Kaufman's approximation: the
+    derivative of the model at fixed linear parameters, projected orthogonally to the linear basis.
+    The basis and its derivatives are the model Jacobian at unit linear parameters.
+    '''
+    def __init__(self, func, sigma=None):
+        self.model_jac = MODEL_JACOBIANS[func]
+        self.linear, self.nonlinear, owner = (np.array(i) for i in VARPRO_MODELS[func])
+        self.owner = np.searchsorted(self.linear, owner)
+        self.n_parameters = len(self.linear) + len(self.nonlinear)
+        self.sigma = sigma
+        self._key = None
+
+    def _evaluate(self, theta, x_data, y_observed):
+        key = (theta.tobytes(), id(x_data), id(y_observed))
+        if key != self._key:
+            _, J = self.model_jac(self.parameters(theta, np.ones(len(self.linear))), x_data)
+            basis, dbasis = J[:, self.linear], J[:, self.nonlinear]
+            y = y_observed
+            if self.sigma is not None:
+                basis, dbasis, y = basis/self.sigma[:, None], dbasis/self.sigma[:, None], y/self.sigma
+            if np.all(np.isfinite(basis)) and np.all(np.isfinite(dbasis)):
+                self._coefficients = np.linalg.lstsq(basis, y, rcond=None)[0]
+                Q = np.linalg.qr(basis)[0]
+                D = dbasis*self._coefficients[self.owner]
+                self._res = basis @ self._coefficients - y
+                self._J = D - Q @ (Q.T @ D)
+            else:
+                #outside the domain of the model (e.g. negative tau): least_squares shrinks its step
+                self._coefficients = np.full(len(self.linear), np.nan)
+                self._res = np.full(len(y), np.nan)
+                self._J = np.zeros(dbasis.shape)
+            self._key = key
+        return self._res, self._J
+
+    def parameters(self, theta, coefficients):
+        """ full parameter vector of the model"""
+        parameters = np.empty(self.n_parameters)
+        parameters[self.nonlinear] = theta
+        parameters[self.linear] = coefficients
+        return parameters
+
+    def coefficients(self, theta, x_data, y_observed):
+        self._evaluate(theta, x_data, y_observed)
+        return self._coefficients
+
+    def residuals(self, theta, x_data, y_observed):
+        return self._evaluate(theta, x_data, y_observed)[0]
+
+    def jac(self, theta, x_data, y_observed):
+        return self._evaluate(theta, x_data, y_observed)[1]
+
+
+def varpro_least_squares(func, x0, x_data, y_observed, jac=True, sigma=None, bounds=(-np.inf, np.inf), **kwargs):
+    '''
+    fit of a separable model (VARPRO_MODELS) iterating over its nonlinear parameters only, with trf;
+    x0 and bounds are those of the full parameter vector, the bounds of the linear parameters are not used.
+    The Jacobian is always Kaufman's analytic one whatever jac: finite differences of the projected
+    residuals are flat far from the optimum (e.g. at the exp_initial_guess of get_fit) and stop the fit there.
+    The result has the full parameter vector in x.
+    '''
+    from scipy import optimize
+
+    evaluator = VarProResiduals(func, sigma)
+    lb, ub = (np.broadcast_to(np.asarray(b, dtype=float), (evaluator.n_parameters,)) for b in bounds)
+    nonlinear = evaluator.nonlinear
+    theta0 = np.clip(np.asarray(x0, dtype=float)[nonlinear], lb[nonlinear], ub[nonlinear])
+    result = optimize.least_squares(evaluator.residuals, theta0,
+                                    jac=evaluator.jac,
+                                    bounds=(lb[nonlinear], ub[nonlinear]), args=(x_data, y_observed), **kwargs)
+    result.theta, result.jac_theta = result.x, result.jac
+    result.x = evaluator.parameters(result.x, evaluator.coefficients(result.x, x_data, y_observed))
+    #Jacobian of the full parameter vector, for parameter_covariance
+    result.jac = evaluator.model_jac(result.x, x_data)[1]
+    if sigma is not None:
+        result.jac = result.jac/sigma[:, None]
+    return result
+
+
+def parameter_covariance(result):
+    '''
+    covariance of the fitted parameters from the Jacobian of the last least_squares iteration:
+    s^2 (J^T J)^-1, s^2 being the residual variance, so the weights only need to be relative.
+    Directions that the data do not constrain (singular values below machine precision) are
+    dropped as in curve_fit; parameters stuck on a bound get an optimistic variance.
+    '''
+    J, residual = result.jac, result.fun
+    dof = max(len(residual) - J.shape[1], 1)
+    _, s, VT = np.linalg.svd(J, full_matrices=False)
+    kept = s > np.finfo(float).eps*max(J.shape)*s[0]
+    VT = VT[kept]/s[kept, None]
+    return VT.T @ VT * (2*result.cost/dof)
+
+
+def confidence_interval(value, std, z=1.96):
+    """ (low, high) normal interval, z=1.96 for 95%"""
+    return value - z*std, value + z*std
+
+
+def tau_intervals(params_JC, cov_JC, params_exp, cov_exp, z=1.96):
+    """ confidence intervals of the O-J tau of the JC fit (1/k, delta method) and of the tau of the exponential fit"""
+    k = params_JC[2]
+    return (confidence_interval(1/k, np.sqrt(cov_JC[2, 2])/k**2, z),
+            confidence_interval(params_exp[1], np.sqrt(cov_exp[1, 1]), z))
+
+
+def least_squares_model(func, x0, x_data, y_observed, jac=True, sigma=None, **kwargs):
+    '''
+    optimize.least_squares fit of func to y_observed, with the analytic
+    Jacobian if jac is True, by finite differences otherwise (jac may name the
+    finite difference scheme, "2-point" by default).
+    sigma: standard errors of y_observed to weight the residuals
+    method="varpro" selects varpro_least_squares (trf over the nonlinear parameters only)
+    '''
+    from scipy import optimize
+
+    if kwargs.get("method") == "lm":
+        #Levenberg-Marquardt does not handle bounds
+        kwargs.pop("bounds", None)
+    start = time.perf_counter()
+    if kwargs.get("method") == "varpro":
+        kwargs.pop("method")
+        result = varpro_least_squares(func, x0, x_data, y_observed, jac = jac, sigma = sigma, **kwargs)
+    elif jac is True:
+        evaluator = FusedResiduals(sigma) if func is sigmoidal_OJIP and KERNEL == "fused" else ResidualsWithJacobian(func, sigma)
+        result = optimize.least_squares(evaluator.residuals, x0, jac=evaluator.jac,
+                                        args=(x_data, y_observed), **kwargs)
+    else:
+        result = optimize.least_squares(residuals, x0, jac=jac if isinstance(jac, str) else "2-point",
+                                        args=(x_data, y_observed, func, sigma), **kwargs)
+    telemetry.record_solver(func.__name__, result, time.perf_counter() - start)
+    return result
+
+
+def warm_least_squares(func, x0_warm, x0_cold, x_data, y_observed, jac=True, sigma=None, bounds=(-np.inf, np.inf), **kwargs):
+    '''
+    least_squares_model started from x0_warm, falling back to x0_cold if x0_warm is None
+    or if the warm fit diverges: not converged, not finite, or ending with a higher cost
+    than the cold initial guess.
+    '''
+    if x0_warm is not None:
+        lb, ub = (np.broadcast_to(b, np.shape(x0_cold)) for b in bounds)
+        x0_warm = np.clip(np.asarray(x0_warm, dtype=float), lb, ub)
+        if np.all(np.isfinite(x0_warm)):
+            result = least_squares_model(func, x0_warm, x_data, y_observed, jac = jac, sigma = sigma, bounds = bounds, **kwargs)
+            cost_cold = 0.5*np.sum(residuals(np.asarray(x0_cold, dtype=float), x_data, y_observed, func, sigma)**2)
+            if result.success and np.all(np.isfinite(result.x)) and result.cost <= cost_cold:
+                return result
+    return least_squares_model(func, x0_cold, x_data, y_observed, jac = jac, sigma = sigma, bounds = bounds, **kwargs)
+
+
+def batched_least_squares(model_jac, x0, tdata, Y, bounds, mask=None, max_iter=200, ftol=1e-10):
+    '''
+    Levenberg-Marquardt fit of model_jac to every row of Y (fits, samples) at once.
+    model_jac evaluates all rows in one vectorized pass (parameters of shape (fits, parameters)),
+    the normal equations are solved batched and steps are projected on the bounds.
+    mask (fits, samples) excludes samples of a fit. Returns the parameters and the converged flags.
+    '''
+    x = np.array(x0, dtype=float)
+    lower, upper = (np.broadcast_to(np.asarray(b, dtype=float), x.shape[-1:]) for b in bounds)
+    x = np.clip(x, lower, upper)
+    weight = np.ones(Y.shape) if mask is None else mask.astype(float)
+
+    def evaluate(x):
+        y_model, J = model_jac(x, tdata)
+        r = np.nan_to_num((y_model - Y)*weight)
+        return r, np.nan_to_num(J*weight[..., None])
+
+    r, J = evaluate(x)
+    cost = (r**2).sum(axis=1)
+    lam = np.full(len(x), 1e-3)
+    active = np.ones(len(x), dtype=bool)
+    for _ in range(max_iter):
+        Jt = J.transpose(0, 2, 1)
+        A = Jt @ J
+        g = (Jt @ r[..., None])[..., 0]
+        D = np.maximum(np.diagonal(A, axis1=1, axis2=2), 1e-30)
+        step = -np.linalg.solve(A + (lam[:, None]*D)[:, :, None]*np.eye(x.shape[1]), g[..., None])[..., 0]
+        x_new = np.where(active[:, None], np.clip(x + step, lower, upper), x)
+        r_new, J_new = evaluate(x_new)
+        cost_new = (r_new**2).sum(axis=1)
+        accept = active & (cost_new < cost)
+        converged = accept & (cost - cost_new <= ftol*cost)
+        x[accept], r[accept], J[accept] = x_new[accept], r_new[accept], J_new[accept]
+        cost[accept] = cost_new[accept]
+        lam = np.where(accept, lam/3, lam*2)
+        active &= ~converged & (lam < 1e16)
+        if not active.any():
+            break
+    return x, ~active | (lam >= 1e16)
+
+
+def multiexp_fit_columns(t, Y, jac=True):
+    """ multiexp_fit of every column of Y (shared time t) with the batched solver
+    returns the O-J taus (columns,), the predictions (samples, columns) and the parameters (columns, 10)"""
+    x0 = [jc_initial_guess(y) for y in Y.T]
+    params, converged = batched_least_squares(sigmoidal_OJIP_jac, x0, t, Y.T, JC_BOUNDS)
+    for i in np.flatnonzero(~converged):
+        #fall back to the single column fit
+        params[i] = least_squares_model(sigmoidal_OJIP, x0[i], t, Y[:, i], jac = jac, bounds = JC_BOUNDS).x
+    ypred = sigmoidal_OJIP_jac(params, t)[0].T
+    return 1/params[:, 2], ypred, params
+
+
+def get_fit_columns(t, Y, windows, taus, jac=True):
+    """ get_fit of every column of Y on its own window t[:windows[i]], both passes batched
+    the first pass starts from the O-J taus: the crude get_fit guess is too far off for the batched solver
+    returns the exp_decay parameters (columns, 3)"""
+    t, Y = t[:max(windows)]-t[0], Y[:max(windows)]
+    x0 = [[Y[w-1, i]-Y[0, i], tau, Y[0, i]] for i, (w, tau) in enumerate(zip(windows, taus))]
+    index = np.arange(len(t))
+    params, converged = batched_least_squares(exp_decay_jac, x0, t, Y.T, (-1e8,1e8),
+                                              mask = index < np.asarray(windows)[:, None])
+
+    #second fit, restricted to 5 tau of each column
+    stops = [min(w, int(find_nearest(t[:w], p[1])*5)) for w, p in zip(windows, params)]
+    params, converged_2 = batched_least_squares(exp_decay_jac, params, t, Y.T, (-1e9,1e9),
+                                                mask = index < np.asarray(stops)[:, None])
+    for i in np.flatnonzero(~(converged & converged_2)):
+        #fall back to the single column fit
+        params[i] = get_fit(t[:windows[i]], Y[:windows[i], i], jac = jac)
+    return params
+
+
+
+# Define a function to calculate the value based on the selected component
+def calculate_value(sigma, params):
+    # Replace this with your own calculation logic based on the chemical and wavelength
+    return 1e6/(sigma*params[1])
+
+
+def intensity_values(params, wl):
+    """ light intensity in µE/m²/s and mW/mm² from the exp_decay parameters and the excitation wavelength
+    params may be a batch (fits, 3) and wl an array of wavelengths, see calibration.intensities"""
+    return intensities(np.asarray(params)[..., 1], *monochromatic(wl))
+
+
+def intensity_intervals(tau_interval, wl):
+    """ ((low, high) in µE/m²/s, (low, high) in mW/mm²) from the (low, high) interval of tau:
+    the intensities decrease with tau, so the bounds swap; a low bound of tau <= 0 gives an infinite high bound"""
+    with np.errstate(divide="ignore"):
+        eins, watt = intensities(np.maximum(np.asarray(tau_interval, dtype=float)[::-1], 0.0), *monochromatic(wl))
+    return tuple(eins), tuple(watt)
+
+
+#JIP-test parameters of jip_test
+JIP_FIELDS = ("Fo", "Fm", "Fv/Fm", "Vj", "Vi", "Mo", "area")
+
+
+def jip_test(params_JC, t, y):
+    """
+    JIP-test parameters of traces from their preprocessed points and sigmoidal_OJIP parameters, in one pass
+    params_JC: (10,) or (traces, 10); t and y: (samples,) or (traces, samples), NaN-padded when the traces
+    have different lengths; the time is in s from the start of the rise (as out of pre_process and log_bin)
+    Fo is the fitted F0 and Fm the maximum of the points; the fluorescence at 300 µs (Mo, per ms),
+    2 ms (Vj) and 30 ms (Vi) is read on the fitted curve; area is the area between Fm and the points
+    up to the time of Fm (fluorescence x s). Returns a dict of floats, or of (traces,) arrays.
+    """
+    P = np.asarray(params_JC, dtype=float)
+    params = np.atleast_2d(P)
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    t = np.broadcast_to(np.atleast_2d(np.asarray(t, dtype=float)), y.shape)
+
+    Fo = params[:, 0]
+    #K (300 µs), J (2 ms) and I (30 ms) steps
+    F_K, F_J, F_I = sigmoidal_OJIP(params.T[:, :, None], np.array([300e-6, 2e-3, 30e-3])).T
+    points = np.where(np.isfinite(y), y, -np.inf)
+    peak = np.argmax(points, axis=1)
+    Fm = points[np.arange(len(y)), peak]
+    Fv = Fm - Fo
+
+    #trapezoids between Fm and the points, up to the peak
+    gap = Fm[:, None] - y
+    before = np.arange(y.shape[1] - 1) < peak[:, None]
+    area = np.where(before, 0.5*(gap[:, 1:] + gap[:, :-1])*np.diff(t, axis=1), 0).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values = {"Fo": Fo, "Fm": Fm, "Fv/Fm": Fv/Fm, "Vj": (F_J - Fo)/Fv, "Vi": (F_I - Fo)/Fv,
+                  "Mo": 4*(F_K - Fo)/Fv, "area": area}
+    if P.ndim == 1:
+        return {name: float(value[0]) for name, value in values.items()}
+    return values
+
+
+def fit_trace(time_array, fluo, N_mvg = 10, N_log = 1000, jac=True, mode="mvgavg", warm_key=None, method="trf"):
+    """ full pipeline of the app on one trace: pre_process, JC fit, then exponential fit up to 3 tau
+    mode: "mvgavg" (pre_process) or "logbin" (log_bin, weighted fits; N_mvg is not used)
+    warm_key: hashable identifying the trace (e.g. (file, time column, fluo column)); the fits
+    start from the last parameters found under this key and store theirs in warm_starts
+    jac, method: Jacobian and least_squares algorithm of both fits
+    the result also has the parameters and covariances of both fits, the 95% intervals of both taus
+    and the JIP-test parameters (jip_test)"""
+    t, y, sigma = preprocess_trace(time_array, fluo, N_mvg = N_mvg, N_log = N_log, mode = mode)
+    warm = warm_starts.get(warm_key, {}) if warm_key is not None else {}
+    tau, ypred, params_JC, cov_JC = multiexp_fit(t, y, jac=jac, sigma=sigma, x0=warm.get("jc"), full_output=True,
+                                                 method=method)
+    pos_tau = find_nearest(t, 3*tau)
+    params, cov = get_fit(t[:pos_tau], y[:pos_tau], jac=jac, sigma=None if sigma is None else sigma[:pos_tau],
+                          x0=warm.get("exp"), method=method, full_output=True)
+    if warm_key is not None:
+        warm_starts.put(warm_key, {"jc": params_JC, "exp": params})
+    return fit_result(t, y, sigma, ypred, tau, params_JC, cov_JC, params, cov)
+
+
+def preprocess_trace(time_array, fluo, N_mvg = 10, N_log = 1000, mode="mvgavg"):
+    """ preprocessed points (t, y, sigma) of fit_trace, sigma is None without log binning"""
+    if mode == "logbin":
+        t, y, _, sigma = log_bin(time_array, fluo, N_log = N_log)
+        return t, y, sigma
+    return pre_process(time_array, fluo, N_mvg = N_mvg, N_log = N_log) + (None,)
+
+
+def fit_result(t, y, sigma, ypred, tau, params_JC, cov_JC, params, cov):
+    tau_JC_ci, tau_ci = tau_intervals(params_JC, cov_JC, params, cov)
+    return {"y_JC":ypred, "params_exp":params, "t": t, "y": y, "tau_JC": tau, "sigma": sigma,
+            "params_JC": params_JC, "cov_JC": cov_JC, "cov_exp": cov, "tau_JC_ci": tau_JC_ci, "tau_ci": tau_ci,
+            "jip": jip_test(params_JC, t, y)}
+
+
+def _bootstrap_replicates(jc, exp, n, seed, deadline, jac, method):
+    """ n residual bootstrap refits of the JC fit and of the exponential fit, from their parameters,
+    stopping at the deadline (time.time()); jc and exp are (t, fitted curve, standardized residuals, sigma,
+    parameters); returns the (tau_JC, tau) of the replicates that converged"""
+    rng = np.random.default_rng(seed)
+    taus = []
+    for _ in range(n):
+        if deadline is not None and time.time() > deadline:
+            break
+        (t, y_JC), (t_exp, y_exp) = (_resample(rng, *fit[:4]) for fit in (jc, exp))
+        try:
+            tau_JC = multiexp_fit(t, y_JC, jac=jac, sigma=jc[3], x0=jc[4], method=method)[0]
+            tau = get_fit(t_exp, y_exp, jac=jac, sigma=exp[3], x0=exp[4], method=method)[1]
+        except (ValueError, np.linalg.LinAlgError):
+            continue
+        taus.append((tau_JC, tau))
+    return np.reshape(taus, (-1, 2))
+
+
+def _resample(rng, t, y_fit, residual, sigma):
+    return t, y_fit + rng.choice(residual, len(y_fit))*(1 if sigma is None else sigma)
+
+
+def bootstrap_fit(result, n_samples=200, time_budget=None, workers=None, seed=None, jac=True, method="trf",
+                  level=0.95, progress=None):
+    """
+    residual bootstrap of a fit_trace (or FitPipeline.run) result: the standardized residuals of each fit
+    are resampled onto its fitted curve and the fit is redone from its parameters (warm start), on the same
+    points as the original fit; in chunks over a process pool (workers=0 runs in this process).
+    time_budget: seconds after which no new replicate is started, the replicates done so far are used
+    progress: called as progress(replicates done, n_samples) after each chunk
+    returns the taus of the replicates and the percentile intervals at level
+    """
+    start = time.time()
+    deadline = None if time_budget is None else start + time_budget
+    t, y, sigma = result["t"], result["y"], result.get("sigma")
+    pos_tau = find_nearest(t, 3*result["tau_JC"])
+    t_exp, sigma_exp = t[:pos_tau], None if sigma is None else sigma[:pos_tau]
+    y_exp = exp_decay(result["params_exp"], t_exp - t_exp[0])
+    #the residuals of the exponential are taken where its second pass was fitted
+    stop = min(max(int(find_nearest(t_exp - t_exp[0], result["params_exp"][1])*5), 2), pos_tau)
+    jc = (t, result["y_JC"], _standardized(y - result["y_JC"], sigma), sigma, result["params_JC"])
+    exp = (t_exp, y_exp, _standardized((y[:pos_tau] - y_exp)[:stop], None if sigma is None else sigma[:stop]),
+           sigma_exp, result["params_exp"])
+    n_chunks = min(n_samples, 4*(workers or os.cpu_count() or 1))
+    sizes = [len(chunk) for chunk in np.array_split(np.arange(n_samples), n_chunks)]
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+    progress = progress if progress is not None else (lambda done, total: None)
+
+    taus = []
+    if workers == 0:
+        for size, chunk_seed in zip(sizes, seeds):
+            taus.append(_bootstrap_replicates(jc, exp, size, chunk_seed, deadline, jac, method))
+            progress(sum(len(tau) for tau in taus), n_samples)
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        try:
+            futures = [pool.submit(_bootstrap_replicates, jc, exp, size, chunk_seed, deadline, jac, method)
+                       for size, chunk_seed in zip(sizes, seeds)]
+            #a replicate started just before the deadline is waited for, up to a second
+            for future in as_completed(futures, timeout=None if deadline is None else deadline - start + 1):
+                taus.append(future.result())
+                progress(sum(len(tau) for tau in taus), n_samples)
+        except TimeoutError:
+            pass
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+    taus = np.concatenate(taus) if taus else np.empty((0, 2))
+    percentiles = 50*(1 - level), 50*(1 + level)
+    return {"tau_JC": taus[:, 0], "tau": taus[:, 1], "n": len(taus), "seconds": time.time() - start,
+            "tau_JC_ci": tuple(np.percentile(taus[:, 0], percentiles)) if len(taus) else (np.nan, np.nan),
+            "tau_ci": tuple(np.percentile(taus[:, 1], percentiles)) if len(taus) else (np.nan, np.nan)}
+
+
+def _standardized(residual, sigma):
+    return residual if sigma is None else residual/sigma
+
+
+class LRUCache:
+    """ dict-like cache keeping the maxsize most recently used entries, and at most max_bytes of arrays
+    in them (the newest entry is always kept)"""
+    def __init__(self, maxsize=64, max_bytes=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key][0]
+
+    def put(self, key, value):
+        size = telemetry.nbytes(value) if self.max_bytes is not None else 0
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.nbytes += size
+            while len(self._data) > 1 and (len(self._data) > self.maxsize or
+                                           (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                self.nbytes -= self._data.popitem(last=False)[1][1]
+
+    def __len__(self):
+        return len(self._data)
+
+
+#last converged parameters of each trace, used as warm starts of its next fit
+warm_starts = LRUCache(256)
+
+
+def stage_key(*parts):
+    """ hash identifying a stage result from its name, the key of its input and its parameters"""
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+
+class FitPipeline:
+    '''
+    The fit of update_fit split into cached stages:
+    parse -> blank/normalise/mask -> moving average -> log subsample -> JC fit -> exponential fit.
+    Each result is kept in an LRU cache, bounded by entries and by the bytes of their arrays, under a key
+    hashing its input key and parameters, so only the stages downstream of a changed setting are recomputed.
+    '''
+    def __init__(self, maxsize=64, max_bytes=PIPELINE_MAX_BYTES):
+        self.cache = LRUCache(maxsize, max_bytes)
+
+    def stage(self, name, input_key, parameters, compute, *args):
+        key = stage_key(name, input_key, parameters)
+        start = time.perf_counter()
+        value = self.cache.get(key)
+        cached = value is not None
+        if not cached:
+            value = compute(*args)
+            self.cache.put(key, value)
+        telemetry.record_stage(name, time.perf_counter() - start, value, cached)
+        return key, value
+
+    def points(self, data_key, table, key_time, key_fluo, N_mvg = 10, N_log = 1000, mode="mvgavg", progress=None):
+        """ key and (t, y, sigma) of the preprocessed points, sigma is None without log binning"""
+        progress = progress if progress is not None else (lambda name, partial: None)
+        key, (t, y) = self.stage("parse", data_key, (key_time, key_fluo), stored_columns, table, key_time, key_fluo)
+        progress("parse", None)
+        if mode == "logbin":
+            key, (t, y, _, sigma) = self.stage("log_bin", key, (N_log,), log_bin, t, y, N_log)
+        else:
+            key, (t, y) = self.stage("rise", key, (), select_rise, t, y)
+            key, (t, y) = self.stage("moving_average", key, (N_mvg,), moving_average, t, y, N_mvg)
+            key, (t, y) = self.stage("log_subsample", key, (N_log,), log_subsample, t, y, N_log)
+            sigma = None
+        progress("preprocessing", None)
+        return key, (t, y, sigma)
+
+    def run(self, data_key, table, key_time, key_fluo, N_mvg = 10, N_log = 1000, jac=True, mode="mvgavg",
+            progress=None, method="trf"):
+        """ same result as fit_trace on the columns key_time and key_fluo of the stored table,
+        plus the keys of the last stage and of the preprocessed points
+        progress: called as progress(stage name, partial) after each stage, partial being None
+        except for the preview (its "params_exp", from preview_fit) and the JC fit (the dict of the results so far)"""
+        progress = progress if progress is not None else (lambda name, partial: None)
+        points_key, (t, y, sigma) = self.points(data_key, table, key_time, key_fluo, N_mvg, N_log, mode, progress)
+        key = points_key
+        #provisional tau, replaced by the fits below
+        try:
+            _, preview = self.stage("preview", points_key, (), preview_fit, t, y, sigma)
+            progress("preview", {"params_exp": preview})
+        except ValueError:
+            pass
+        #the warm starts change the starting point, not the optimum, so they are not part of the stage keys
+        warm_key = (data_key, key_time, key_fluo)
+        warm = warm_starts.get(warm_key, {})
+        key, (tau, ypred, params_JC, cov_JC) = self.stage("jc_fit", key, (jac, method), multiexp_fit, t, y, jac, sigma,
+                                                          warm.get("jc"), True, method)
+        progress("jc_fit", {"y_JC":ypred, "t": t, "y": y, "tau_JC": tau, "key": key, "points_key": points_key})
+        pos_tau = find_nearest(t, 3*tau)
+        key, (params, cov) = self.stage("exp_fit", key, (jac, method), get_fit, t[:pos_tau], y[:pos_tau], jac,
+                                        None if sigma is None else sigma[:pos_tau], warm.get("exp"), method, True)
+        warm_starts.put(warm_key, {"jc": params_JC, "exp": params})
+        result = fit_result(t, y, sigma, ypred, tau, params_JC, cov_JC, params, cov)
+        result.update(key = key, points_key = points_key)
+        return result
+
+
+def store_table(decoded, filename, key=None):
+    """ keep the raw bytes of an uploaded table in the dataset store, only its header is parsed now"""
+    columns = read_header(decoded, filename)
+    key = dataset_store.put({"raw": np.frombuffer(decoded, dtype=np.uint8), "filename": np.array(filename)},
+                            key = key if key is not None else hashlib.blake2b(decoded, digest_size=16).hexdigest())
+    return {"key": key, "columns": columns}
+
+
+def stored_columns(table, *names):
+    """ parse only the given columns of a table from the dataset store, as float arrays
+    table may also be a dict of the arrays themselves {name: array} (fits of the HTTP API)"""
+    if "raw" not in table:
+        return tuple(np.asarray(table[name], dtype=float) for name in names)
+    columns = read_columns(table["raw"], str(table["filename"]), list(dict.fromkeys(names)))
+    return tuple(columns[name] for name in names)
+
+
+def fit_columns(time_array, fluo, N_mvg = 10, N_log = 1000, jac=True):
+    """ fit_trace of every column of fluo (samples, columns) sharing time_array, vectorized over the columns"""
+    t, Y = pre_process_columns(time_array, fluo, N_mvg = N_mvg, N_log = N_log)
+    taus, ypred, params_JC = multiexp_fit_columns(t, Y, jac=jac)
+    windows = [find_nearest(t, 3*tau) for tau in taus]
+    params = get_fit_columns(t, Y, windows, taus, jac=jac)
+    return {"y_JC":ypred, "params_exp":params, "t": t, "y": Y, "tau_JC": taus, "params_JC": params_JC,
+            "jip": jip_test(params_JC, t, Y.T)}
+
+
+def fit_columns_table(df, key_time, keys_fluo, N_mvg = 10, N_log = 1000, wl = None):
+    """ per-column tau, intensity and JIP-test parameters of fit_columns as a DataFrame"""
+    import pandas as pd
+
+    result = fit_columns(df[key_time].to_numpy(float), df[keys_fluo].to_numpy(float), N_mvg = N_mvg, N_log = N_log)
+    table = pd.DataFrame({"column": keys_fluo, "tau_JC": result["tau_JC"], "tau": result["params_exp"][:, 1]})
+    if wl is not None:
+        table["intensity_eins"], table["intensity_watt"] = intensity_values(result["params_exp"], wl)
+    for name in JIP_FIELDS:
+        table[name] = result["jip"][name]
+    return table
+
+
+#names of the sigmoidal_OJIP parameters, to declare the shared ones of global_fit
+JC_PARAMETERS = ("F0", "Aoj", "koj", "soj", "Aji", "kji", "sji", "Aip", "kip", "sip")
+
+
+class GlobalModel:
+    '''
+    sigmoidal_OJIP fitted to a series of curves at once: the parameters named in shared are common to
+    all curves, the others belong to each curve. The parameter vector is [shared, curve 0, curve 1, ...],
+    so the residuals of a curve only depend on the shared parameters and on its own block: the Jacobian
+    is block-sparse, with len(shared) + (10 - len(shared)) non-zeros per row whatever the number of curves.
+    '''
+    def __init__(self, ts, sigmas=None, shared=("soj", "sji", "sip")):
+        self.ts = [np.asarray(t, dtype=float) for t in ts]
+        self.sigmas = sigmas if sigmas is not None else [None]*len(self.ts)
+        self.shared = [JC_PARAMETERS.index(name) for name in shared]
+        self.own = [i for i in range(10) if i not in self.shared]
+        self.n_curves = len(self.ts)
+        self.n_parameters = len(self.shared) + self.n_curves*len(self.own)
+        self.offsets = np.cumsum([0] + [len(t) for t in self.ts])
+
+    def curve_parameters(self, x):
+        """ (curves, 10) sigmoidal_OJIP parameters from the global parameter vector"""
+        P = np.empty((self.n_curves, 10))
+        P[:, self.shared] = x[:len(self.shared)]
+        P[:, self.own] = np.reshape(x[len(self.shared):], (self.n_curves, len(self.own)))
+        return P
+
+    def pack(self, P):
+        """ global parameter vector from (curves, 10) parameters, the shared ones being averaged"""
+        P = np.asarray(P, dtype=float)
+        return np.concatenate([P[:, self.shared].mean(axis=0), P[:, self.own].ravel()])
+
+    def columns(self):
+        """ (rows, columns of a row) of the non-zeros: the shared parameters then the block of the curve"""
+        n_shared, n_own = len(self.shared), len(self.own)
+        curve = np.repeat(np.arange(self.n_curves), np.diff(self.offsets))
+        own = n_shared + curve[:, None]*n_own + np.arange(n_own)
+        return np.hstack([np.broadcast_to(np.arange(n_shared), (len(curve), n_shared)), own])
+
+    def sparsity(self):
+        """ sparsity pattern of the Jacobian, for least_squares(jac_sparsity=...)"""
+        from scipy import sparse
+
+        columns = self.columns()
+        return sparse.csr_matrix((np.ones(columns.size), columns.ravel(),
+                                  np.arange(0, columns.size + 1, columns.shape[1])),
+                                 shape=(self.offsets[-1], self.n_parameters))
+
+    def residuals(self, x, ys):
+        res = np.empty(self.offsets[-1])
+        for i, (P, t, y, sigma) in enumerate(zip(self.curve_parameters(x), self.ts, ys, self.sigmas)):
+            res[self.offsets[i]:self.offsets[i+1]] = (sigmoidal_OJIP(P, t) - y)/(1 if sigma is None else sigma)
+        return res
+
+    def jac(self, x, ys):
+        """ analytic Jacobian, as a sparse matrix with the pattern of sparsity()"""
+        from scipy import sparse
+
+        order = self.shared + self.own
+        blocks = []
+        for P, t, sigma in zip(self.curve_parameters(x), self.ts, self.sigmas):
+            J = sigmoidal_OJIP_jac(P, t)[1][:, order]
+            blocks.append(J if sigma is None else J/sigma[:, None])
+        columns = self.columns()
+        return sparse.csr_matrix((np.concatenate(blocks).ravel(), columns.ravel(),
+                                  np.arange(0, columns.size + 1, columns.shape[1])),
+                                 shape=(self.offsets[-1], self.n_parameters))
+
+
+def global_fit(traces, shared=("soj", "sji", "sip"), N_mvg = 10, N_log = 1000, mode="logbin", jac=True, x0=None,
+               **kwargs):
+    '''
+    sigmoidal_OJIP fit of a series of traces (list of (time, fluorescence)) with shared parameters, e.g. an
+    intensity series where the rates change with the drive but the sigmoidicities stay the same.
+    Each trace is preprocessed as in fit_trace (mode "logbin" or "mvgavg"), then all are fitted in one
+    least_squares problem with a block-sparse Jacobian: analytic if jac is True, by finite differences
+    over its sparsity pattern (jac_sparsity) otherwise. The steps are solved by lsmr in the dogbox method,
+    scaled by the Jacobian columns and with tight lsmr tolerances: trf restricts the lsmr steps to a
+    two-dimensional subspace within the bounds and stalls on the badly scaled sigmoidicities.
+    x0: (curves, 10) starting parameters, by default series_initial_guess
+    returns the per-curve parameters (curves, 10), their O-J taus with 95% intervals, the fitted curves
+    and the least_squares result
+    '''
+    from scipy import optimize
+
+    curves = [log_bin(t, y, N_log = N_log) if mode == "logbin" else pre_process(t, y, N_mvg = N_mvg, N_log = N_log)
+              for t, y in traces]
+    ts, ys = [c[0] for c in curves], [c[1] for c in curves]
+    sigmas = [c[3] for c in curves] if mode == "logbin" else None
+    model = GlobalModel(ts, sigmas, shared)
+    x0 = model.pack(x0 if x0 is not None else series_initial_guess(ts, ys, sigmas))
+    lb, ub = (model.pack(np.broadcast_to(b, (model.n_curves, 10))) for b in JC_BOUNDS)
+
+    start = time.perf_counter()
+    options = dict(method="dogbox", tr_solver="lsmr", x_scale="jac", tr_options=dict(atol=1e-10, btol=1e-10))
+    options.update(kwargs)
+    if jac is True:
+        result = optimize.least_squares(model.residuals, np.clip(x0, lb, ub), jac=model.jac, bounds=(lb, ub),
+                                        args=(ys,), **options)
+    else:
+        result = optimize.least_squares(model.residuals, np.clip(x0, lb, ub), jac=jac if isinstance(jac, str) else "2-point",
+                                        jac_sparsity=model.sparsity(), bounds=(lb, ub), args=(ys,), **options)
+    telemetry.record_solver("global_fit", result, time.perf_counter() - start)
+
+    P = model.curve_parameters(result.x)
+    #covariance from the sparse Jacobian: J^T J is only (parameters, parameters)
+    J = model.jac(result.x, ys)
+    dof = max(len(result.fun) - model.n_parameters, 1)
+    cov = np.linalg.pinv((J.T @ J).toarray())*(2*result.cost/dof)
+    k_std = np.sqrt(np.diag(cov))[_global_index(model, "koj")]
+    tau = 1/P[:, 2]
+    return {"params": P, "tau_JC": tau, "tau_JC_ci": np.transpose(confidence_interval(tau, k_std*tau**2)),
+            "t": ts, "y": ys, "y_JC": [sigmoidal_OJIP(p, t) for p, t in zip(P, ts)], "sigma": sigmas,
+            "cov": cov, "result": result}
+
+
+def series_initial_guess(ts, ys, sigmas=None):
+    '''
+    starting parameters of global_fit: an independent multiexp_fit of each curve, its phases sorted by
+    decreasing rate so that they keep the same order along the series. Independent fits rather than
+    fits warm-started one from the other: a badly resolved curve would spoil the guesses of all the next ones.
+    '''
+    sigmas = sigmas if sigmas is not None else [None]*len(ts)
+    P = np.array([multiexp_fit(t, y, sigma=sigma, full_output=True)[2] for t, y, sigma in zip(ts, ys, sigmas)])
+    #(A, k, s) of the phases, fastest first
+    phases = P[:, 1:].reshape(-1, 3, 3)
+    order = np.argsort(-phases[:, :, 1], axis=1)
+    P[:, 1:] = np.take_along_axis(phases, order[:, :, None], axis=1).reshape(-1, 9)
+    return P
+
+
+def _global_index(model, name):
+    """ index of a parameter of every curve in the global parameter vector"""
+    i = JC_PARAMETERS.index(name)
+    if i in model.shared:
+        return np.full(model.n_curves, model.shared.index(i))
+    return len(model.shared) + np.arange(model.n_curves)*len(model.own) + model.own.index(i)
+
+
+def drive_calibration(drive, tau, tau_ci=None, wl=None):
+    '''
+    linear calibration of a light source from an intensity series: the rate 1/tau is fitted as
+    slope*drive + intercept (weighted by the 95% intervals of tau if given). With the excitation
+    wavelength, the intensities, proportional to 1/tau, get the same straight line in µE/m²/s and mW/mm².
+    returns the slope and intercept with their standard errors, and the fitted rates at the drives
+    '''
+    drive, rate = np.asarray(drive, dtype=float), 1/np.asarray(tau, dtype=float)
+    weight = np.ones_like(rate)
+    if tau_ci is not None:
+        #standard error of 1/tau from the half-width of the interval of tau
+        std = (np.asarray(tau_ci)[:, 1] - np.asarray(tau_ci)[:, 0])/(2*1.96)*rate**2
+        weight = 1/np.maximum(std, np.finfo(float).tiny)
+    A = np.stack([drive, np.ones_like(drive)], axis=1)
+    (slope, intercept), *_ = np.linalg.lstsq(A*weight[:, None], rate*weight, rcond=None)
+    fitted = slope*drive + intercept
+    dof = max(len(drive) - 2, 1)
+    cov = np.linalg.pinv((A*weight[:, None]).T @ (A*weight[:, None]))*np.sum(((rate - fitted)*weight)**2)/dof
+    calibration = {"drive": drive, "rate": rate, "fitted_rate": fitted, "slope": slope, "intercept": intercept,
+                   "slope_std": np.sqrt(cov[0, 0]), "intercept_std": np.sqrt(cov[1, 1]),
+                   "r2": 1 - np.sum((rate - fitted)**2)/max(np.sum((rate - rate.mean())**2), np.finfo(float).tiny)}
+    if wl is not None:
+        #intensities of a rate of 1/s
+        eins, watt = intensities(1.0, *monochromatic(wl))
+        calibration.update(eins_slope = eins*slope, eins_intercept = eins*intercept,
+                           watt_slope = watt*slope, watt_intercept = watt*intercept)
+    return calibration
+
+
+def load_dataframe(decoded, filename, columns=None):
+    """ read an uploaded table (all columns or only the given ones) from its raw bytes,
+    the format is chosen from the file extension and the delimiter is sniffed"""
+    import pandas as pd
+
+    return pd.DataFrame(read_columns(decoded, filename, columns))
@@ -0,0 +1,53 @@
+"""
+Decimation of the plotted series.
+
+The browser only needs about as many points as the plot has pixels: the series
+are reduced with the largest-triangle-three-buckets algorithm (LTTB), with
+buckets of equal width in log-time since the time axis is logarithmic. Zooming
+in decimates the points of the visible range only, down to full resolution.
+"""
+import numpy as np
+
+MAX_POINTS = 2000
+
+
+def lttb(x, y, edges):
+    """
+    indices of the points kept by LTTB, one per bucket [edges[i], edges[i+1]) of indices;
+    the first and last points are always kept
+    """
+    n = len(x)
+    edges = np.unique(np.clip(np.append(edges, n - 1), 1, n - 1))
+    if len(edges) < 2:
+        return np.arange(n)
+    #centroid of each bucket, the last point closing the series
+    counts = np.diff(edges)
+    x_mean = np.append(np.add.reduceat(x[:-1], edges[:-1])/counts, x[-1])
+    y_mean = np.append(np.add.reduceat(y[:-1], edges[:-1])/counts, y[-1])
+    kept = np.empty(len(edges) + 1, dtype=np.intp)
+    kept[0] = 0
+    a = 0
+    for i in range(len(edges) - 1):
+        lo, hi = edges[i], edges[i + 1]
+        #point of the bucket making the largest triangle with the previous kept point and the next centroid
+        area = np.abs((x[a] - x_mean[i + 1])*(y[lo:hi] - y[a]) - (x[a] - x[lo:hi])*(y_mean[i + 1] - y[a]))
+        a = lo + np.argmax(area)
+        kept[i + 1] = a
+    kept[-1] = n - 1
+    return kept
+
+
+def decimate_log(t, y, n_out=MAX_POINTS, t_range=None):
+    """
+    indices of at most about n_out points of (t, y) to plot on a log time axis,
+    restricted to t_range = (t_min, t_max) if given; points with t <= 0 are not shown
+    """
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y, dtype=float)
+    lo, hi = (0, np.inf) if t_range is None else t_range
+    index = np.flatnonzero((t > 0) & (t >= lo) & (t <= hi))
+    if len(index) <= n_out:
+        return index
+    log_t = np.log10(t[index])
+    edges = np.searchsorted(log_t, np.linspace(log_t[0], log_t[-1], n_out - 1))
+    return index[lttb(log_t, y[index], edges)]
@@ -0,0 +1,166 @@
+"""
+Store of the fit results, for the calibration history of the setups.
+
+Every fit of batch_fit.py with --results is appended to a SQLite database as one
+row, and the app keeps the last fit of each file and setup (the slider changes and
+auto-tune runs of a file replace its row instead of adding one). A row holds the
+hash of the input file, the columns and preprocessing settings, the fitted
+parameter vectors, the taus with their interval, the wavelength and the
+intensities. Rows are indexed by setup, wavelength and date
+for the history queries, and by input and settings so that an identical
+resubmission is answered from the store instead of being fitted again.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+COLUMNS = ["created", "setup", "source", "input_hash", "filename", "time_column", "fluo_column",
+           "N_mvg", "N_log", "mode", "method", "ci", "params_JC", "params_exp",
+           "tau_JC", "tau", "tau_low", "tau_high", "wavelength", "intensity_eins", "intensity_watt"]
+
+#the fitted parameter vectors are stored as JSON lists
+VECTORS = ("params_JC", "params_exp")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fits (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    setup TEXT NOT NULL,
+    source TEXT,
+    input_hash TEXT,
+    filename TEXT,
+    time_column TEXT,
+    fluo_column TEXT,
+    N_mvg INTEGER,
+    N_log INTEGER,
+    mode TEXT,
+    method TEXT,
+    ci TEXT,
+    params_JC TEXT,
+    params_exp TEXT,
+    tau_JC REAL,
+    tau REAL,
+    tau_low REAL,
+    tau_high REAL,
+    wavelength REAL,
+    intensity_eins REAL,
+    intensity_watt REAL
+);
+CREATE INDEX IF NOT EXISTS fits_history ON fits (setup, wavelength, created);
+CREATE INDEX IF NOT EXISTS fits_created ON fits (created);
+CREATE INDEX IF NOT EXISTS fits_input ON fits (input_hash, time_column, fluo_column, N_mvg, N_log, mode, method);
+"""
+
+
+def fit_record(result, wl=None, **fields):
+    """ row of a fit_trace (or FitPipeline.run) result; fields are the other columns (setup, input_hash, ...)"""
+    from calibration import monochromatic, intensities
+
+    record = dict(fields)
+    record.update(params_JC = result["params_JC"], params_exp = result["params_exp"], tau_JC = result["tau_JC"],
+                  tau = result["params_exp"][1], tau_low = result["tau_ci"][0], tau_high = result["tau_ci"][1],
+                  wavelength = wl)
+    if wl is not None:
+        record["intensity_eins"], record["intensity_watt"] = intensities(record["tau"], *monochromatic(wl))
+    return record
+
+
+class ResultsStore:
+    """ SQLite results store at path (created by the first append), usable from several threads and processes"""
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self, create=True):
+        """ connection of the thread, None if the database does not exist yet and create is False"""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            if not create and not os.path.exists(self.path):
+                return None
+            db = sqlite3.connect(self.path, timeout=30)
+            #readers do not block the writer, and the other way around
+            db.execute("PRAGMA journal_mode=WAL")
+            db.row_factory = sqlite3.Row
+            with db:
+                db.executescript(SCHEMA)
+            self._local.db = db
+        return db
+
+    def append(self, record):
+        """ append a record (dict with keys among COLUMNS, created defaults to now) and return its id"""
+        with self._connect() as db:
+            return _insert(db, record)
+
+    def replace(self, record):
+        """ append a record in place of the earlier ones of the same setup, source, input and columns
+        (the intermediate fits of a file), and return its id"""
+        with self._connect() as db:
+            db.execute("DELETE FROM fits WHERE setup = ? AND source IS ? AND input_hash = ? AND time_column = ?"
+                       " AND fluo_column = ?", [record.get("setup", "default")] +
+                       [record.get(name) for name in ("source", "input_hash", "time_column", "fluo_column")])
+            return _insert(db, record)
+
+    def find(self, input_hash, time_column, fluo_column, N_mvg, N_log, mode="mvgavg", method="trf", ci="covariance"):
+        """ latest record of the same input and settings, None if there is none
+        ci: "covariance" or "bootstrap", the kind of confidence interval required"""
+        db = self._connect(create=False)
+        if db is None:
+            return None
+        rows = db.execute(
+            "SELECT * FROM fits WHERE input_hash = ? AND time_column = ? AND fluo_column = ? AND N_mvg = ? AND N_log = ?"
+            " AND mode = ? AND method = ? AND ci LIKE ? ORDER BY created DESC LIMIT 1",
+            (input_hash, time_column, fluo_column, N_mvg, N_log, mode, method, ci + "%")).fetchall()
+        return _record(rows[0]) if rows else None
+
+    def history(self, setup=None, wavelength=None, since=None, until=None):
+        """ records of a setup and wavelength (all if None) created between since and until (unix times), oldest first"""
+        db = self._connect(create=False)
+        if db is None:
+            return []
+        conditions, values = [], []
+        for column, operator, value in (("setup", "=", setup), ("wavelength", "=", wavelength),
+                                        ("created", ">=", since), ("created", "<", until)):
+            if value is not None:
+                conditions.append("{} {} ?".format(column, operator))
+                values.append(value)
+        query = "SELECT * FROM fits" + (" WHERE " + " AND ".join(conditions) if conditions else "") + " ORDER BY created"
+        return [_record(row) for row in db.execute(query, values)]
+
+    def setups(self):
+        db = self._connect(create=False)
+        return [row[0] for row in db.execute("SELECT DISTINCT setup FROM fits ORDER BY setup")] if db is not None else []
+
+
+def _insert(db, record):
+    record = dict(record)
+    record.setdefault("created", time.time())
+    record.setdefault("setup", "default")
+    row = [_value(name, record.get(name)) for name in COLUMNS]
+    cursor = db.execute("INSERT INTO fits ({}) VALUES ({})".format(", ".join(COLUMNS), ", ".join("?"*len(COLUMNS))), row)
+    return cursor.lastrowid
+
+
+def _value(name, value):
+    if name in VECTORS and value is not None:
+        return json.dumps([float(v) for v in value])
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _record(row):
+    record = dict(row)
+    for name in VECTORS:
+        if record[name] is not None:
+            record[name] = json.loads(record[name])
+    return record
+
+
+def default_store():
+    """ store of the app at OJIP_RESULTS_DB (ojip_results.sqlite by default), None if it is set to an empty string"""
+    path = os.environ.get("OJIP_RESULTS_DB", "ojip_results.sqlite")
+    return ResultsStore(path) if path else None
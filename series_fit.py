@@ -0,0 +1,72 @@
+"""
+Global fit of an intensity series: OJIP traces of one light source at increasing drive currents.
+
+All traces are fitted at once with sigmoidal_OJIP, the sigmoidicities (soj, sji, sip by default)
+shared and the other parameters per trace (ojip_core.global_fit), then the rate 1/tau of the O-J
+phase is fitted as a straight line of the drive: the calibration of the source.
+
+    python series_fit.py led_10mA.csv led_20mA.csv led_40mA.csv --drive 10 20 40 --wavelength 470 -o series.csv
+"""
+import argparse
+import csv
+import time
+
+import numpy as np
+
+
+def read_trace(path, key_time=None, key_fluo=None):
+    from ingest import read_columns, read_header
+
+    with open(path, "rb") as f:
+        data = f.read()
+    columns = read_header(data, path)
+    key_time = key_time if key_time is not None else columns[0]
+    key_fluo = key_fluo if key_fluo is not None else columns[1]
+    columns = read_columns(data, path, [key_time, key_fluo])
+    return columns[key_time], columns[key_fluo]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Global OJIP fit of an intensity series and calibration against the drive.")
+    parser.add_argument("inputs", nargs="+", help="one trace per drive value")
+    parser.add_argument("--drive", type=float, nargs="+", required=True, help="drive value (e.g. LED current) of each trace")
+    parser.add_argument("--time", dest="key_time", default=None, help="time column (default: first column)")
+    parser.add_argument("--fluo", dest="key_fluo", default=None, help="fluorescence column (default: second column)")
+    parser.add_argument("--log", dest="N_log", type=int, default=1000, help="number of logarithmic bins of each trace")
+    parser.add_argument("--shared", nargs="+", default=["soj", "sji", "sip"],
+                        help="sigmoidal_OJIP parameters common to all traces (F0 Aoj koj soj Aji kji sji Aip kip sip)")
+    parser.add_argument("--wavelength", type=float, default=None, help="excitation wavelength (nm) to calibrate the intensity")
+    parser.add_argument("-o", "--output", default=None, help="CSV file of the per-trace results")
+    args = parser.parse_args(argv)
+    if len(args.drive) != len(args.inputs):
+        parser.error("{} drive values for {} traces".format(len(args.drive), len(args.inputs)))
+
+    from ojip_core import JC_PARAMETERS, global_fit, drive_calibration
+
+    start = time.perf_counter()
+    result = global_fit([read_trace(path, args.key_time, args.key_fluo) for path in args.inputs],
+                        shared=args.shared, N_log=args.N_log)
+    calibration = drive_calibration(args.drive, result["tau_JC"], result["tau_JC_ci"], wl=args.wavelength)
+    print("{} traces fitted in {:.1f} s".format(len(args.inputs), time.perf_counter() - start))
+    for path, drive, tau, (low, high) in zip(args.inputs, args.drive, result["tau_JC"], result["tau_JC_ci"]):
+        print("{} drive {:g}: tau = {:.3e} s (95%: {:.3e} - {:.3e})".format(path, drive, tau, low, high))
+    print("1/tau = {:.4e} (± {:.1e}) x drive + {:.4e} (± {:.1e}) /s, r² = {:.4f}".format(
+        calibration["slope"], calibration["slope_std"], calibration["intercept"], calibration["intercept_std"],
+        calibration["r2"]))
+    if args.wavelength is not None:
+        print("intensity = {:.4e} x drive + {:.4e} µE/m²/s = {:.4e} x drive + {:.4e} mW/mm²".format(
+            calibration["eins_slope"], calibration["eins_intercept"],
+            calibration["watt_slope"], calibration["watt_intercept"]))
+
+    if args.output is not None:
+        with open(args.output, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["file", "drive", "tau_JC", "tau_JC_low", "tau_JC_high", "fitted_rate"] + list(JC_PARAMETERS))
+            for row in zip(args.inputs, args.drive, result["tau_JC"], *np.transpose(result["tau_JC_ci"]),
+                           calibration["fitted_rate"], result["params"]):
+                writer.writerow(list(row[:-1]) + list(row[-1]))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
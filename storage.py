@@ -0,0 +1,107 @@
+"""
+Server-side storage of uploaded tables and fit arrays.
+
+The Dash stores only hold an opaque key: the arrays stay on the server in binary
+form, in memory with size-bounded LRU eviction and optionally written through to
+a directory of .npz files so that they survive eviction, restarts and can be
+shared between worker processes.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def arrays_key(arrays):
+    """ content hash of a dict of arrays"""
+    h = hashlib.blake2b(digest_size=16)
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        h.update(str(name).encode())
+        h.update(str(array.dtype).encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+
+class DatasetStore:
+    """
+    Key -> dict of numpy arrays.
+    max_bytes bounds the memory tier; with a directory, entries are also saved as
+    .npz files (bounded by disk_max_bytes) and reloaded when evicted from memory.
+    """
+    def __init__(self, max_bytes=512*2**20, directory=None, disk_max_bytes=4*2**30):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def put(self, arrays, key=None):
+        """ store a dict of arrays and return its key (content hash if not given)"""
+        arrays = {str(name): np.asarray(array) for name, array in arrays.items()}
+        key = key if key is not None else arrays_key(arrays)
+        with self._lock:
+            self._put_memory(key, arrays)
+        if self.directory is not None and not os.path.exists(self._path(key)):
+            self._put_disk(key, arrays)
+        return key
+
+    def get(self, key):
+        """ dict of arrays stored under key, None if it was evicted from every tier"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        if self.directory is None or key is None or not os.path.exists(self._path(key)):
+            return None
+        with np.load(self._path(key), allow_pickle=False) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+        os.utime(self._path(key))
+        with self._lock:
+            self._put_memory(key, arrays)
+        return arrays
+
+    def __contains__(self, key):
+        return key in self._memory or (self.directory is not None and os.path.exists(self._path(key)))
+
+    def _put_memory(self, key, arrays):
+        if key in self._memory:
+            self._nbytes -= self._size(self._memory.pop(key))
+        self._memory[key] = arrays
+        self._nbytes += self._size(arrays)
+        while self._nbytes > self.max_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._nbytes -= self._size(evicted)
+
+    def _put_disk(self, key, arrays):
+        #write to a temporary file first so that readers never see a partial file
+        tmp = self._path(key) + ".{}.tmp".format(threading.get_ident())
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, self._path(key))
+        self._evict_disk()
+
+    def _evict_disk(self):
+        files = [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith(".npz")]
+        stats = sorted(((os.stat(f).st_mtime, os.stat(f).st_size, f) for f in files), reverse=True)
+        total = 0
+        for _, size, f in stats:
+            total += size
+            if total > self.disk_max_bytes:
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    @staticmethod
+    def _size(arrays):
+        return sum(a.nbytes for a in arrays.values())
+
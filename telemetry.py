@@ -0,0 +1,190 @@
+"""
+Instrumentation of the fits.
+
+Each request (a fit job, a multi-column fit) gets a RequestTrace recording the
+wall time and output size of every pipeline stage and the statistics of every
+least_squares call made while it runs. The traces are aggregated in a Metrics
+registry rendered in the Prometheus text format, and the last ones are kept for
+the debug panel. profile_next() arms cProfile and tracemalloc for the next
+request only, since they slow the fit down.
+"""
+import contextvars
+import cProfile
+import io
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar("ojip_request", default=None)
+
+
+class RequestTrace:
+    """ stages and solver statistics of one request"""
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+        self.solvers = []
+        self.seconds = None
+        self.profile = None
+        self.memory = None
+
+    def as_dict(self):
+        return {"name": self.name, "seconds": self.seconds, "stages": self.stages, "solvers": self.solvers,
+                "profile": self.profile, "memory": self.memory}
+
+
+class Metrics:
+    """ thread-safe aggregates of the request traces and of the HTTP requests"""
+    def __init__(self, keep=20):
+        self._lock = threading.Lock()
+        self._sums = defaultdict(float)
+        self._help = {}
+        self.last = deque(maxlen=keep)
+
+    def add(self, name, labels, value, description):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._sums[key] += value
+            self._help[name] = description
+
+    def set(self, name, labels, value, description):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._sums[key] = value
+            self._help[name] = description
+
+    def record(self, trace):
+        self.add("ojip_requests_total", {"request": trace.name}, 1, "Requests")
+        self.add("ojip_request_seconds_total", {"request": trace.name}, trace.seconds, "Wall time of the requests")
+        for stage in trace.stages:
+            labels = {"stage": stage["stage"]}
+            self.add("ojip_stage_runs_total", dict(labels, cached=str(stage["cached"]).lower()), 1,
+                     "Pipeline stages run or read from the cache")
+            self.add("ojip_stage_seconds_total", labels, stage["seconds"], "Wall time of the pipeline stages")
+            self.add("ojip_stage_output_bytes_total", labels, stage["bytes"], "Size of the arrays output by the stages")
+        for solver in trace.solvers:
+            labels = {"model": solver["model"]}
+            self.add("ojip_solver_runs_total", dict(labels, status=str(solver["status"])), 1,
+                     "least_squares calls by termination status")
+            self.add("ojip_solver_nfev_total", labels, solver["nfev"], "Function evaluations of least_squares")
+            self.add("ojip_solver_njev_total", labels, solver["njev"] or 0, "Jacobian evaluations of least_squares")
+            self.add("ojip_solver_seconds_total", labels, solver["seconds"], "Wall time of least_squares")
+            self.set("ojip_solver_last_cost", labels, solver["cost"], "Final cost of the last least_squares call")
+        self.last.append(trace.as_dict())
+
+    def render(self):
+        """ Prometheus text exposition format"""
+        with self._lock:
+            items = sorted(self._sums.items())
+            descriptions = dict(self._help)
+        lines = []
+        for name in sorted({name for (name, _), _ in items}):
+            kind = "gauge" if name.endswith("_last_cost") else "counter"
+            lines += ["# HELP {} {}".format(name, descriptions[name]), "# TYPE {} {}".format(name, kind)]
+            for (metric, labels), value in items:
+                if metric == name:
+                    label_text = ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels)
+                    lines.append("{}{{{}}} {!r}".format(name, label_text, float(value)))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+_profile_next = threading.Event()
+
+
+def profile_next():
+    """ enable cProfile and tracemalloc for the next request"""
+    _profile_next.set()
+
+
+@contextmanager
+def request(name):
+    """ record the stages and solver calls made in this block as one request"""
+    trace = RequestTrace(name)
+    token = _current.set(trace)
+    profiler = None
+    #tracemalloc is global to the process, only one request is profiled at a time
+    if _profile_next.is_set() and not tracemalloc.is_tracing():
+        _profile_next.clear()
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        trace.seconds = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            trace.memory = {"peak_mb": tracemalloc.get_traced_memory()[1]/2**20,
+                            "top": [str(stat) for stat in snapshot.statistics("lineno")[:10]]}
+            tracemalloc.stop()
+            text = io.StringIO()
+            pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(25)
+            trace.profile = text.getvalue()
+        _current.reset(token)
+        metrics.record(trace)
+
+
+def record_stage(name, seconds, value, cached):
+    """ add a pipeline stage to the current request, if any"""
+    trace = _current.get()
+    if trace is not None:
+        trace.stages.append({"stage": name, "seconds": seconds, "bytes": nbytes(value), "cached": cached})
+
+
+def record_solver(model, result, seconds):
+    """ add the statistics of a least_squares result to the current request, if any"""
+    trace = _current.get()
+    if trace is not None:
+        trace.solvers.append({"model": model, "nfev": int(result.nfev),
+                              "njev": None if result.njev is None else int(result.njev),
+                              "status": int(result.status), "cost": float(result.cost), "seconds": seconds})
+
+
+def nbytes(value):
+    """ total size of the arrays in a (nested) stage result"""
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(v) for v in value)
+    return 0
+
+
+def instrument_server(server, metrics=metrics, profile=False):
+    """ time the HTTP requests of a Flask server and add the /metrics route
+    profile: also add the /debug/profile route, which lets any client profile the next fit"""
+    import flask
+
+    @server.before_request
+    def _start_timer():
+        flask.g.ojip_start = time.perf_counter()
+
+    @server.after_request
+    def _stop_timer(response):
+        start = flask.g.pop("ojip_start", None)
+        if start is not None and flask.request.path != "/metrics":
+            labels = {"path": flask.request.path}
+            metrics.add("ojip_http_requests_total", labels, 1, "HTTP requests")
+            metrics.add("ojip_http_seconds_total", labels, time.perf_counter() - start,
+                        "Wall time of the HTTP requests, including the JSON serialization")
+            if not response.direct_passthrough:
+                metrics.add("ojip_http_response_bytes_total", labels, response.calculate_content_length() or 0,
+                            "Size of the HTTP responses")
+        return response
+
+    @server.route("/metrics")
+    def _metrics():
+        return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    if profile:
+        @server.route("/debug/profile")
+        def _profile():
+            profile_next()
+            return flask.Response("cProfile and tracemalloc enabled for the next fit\n", mimetype="text/plain")
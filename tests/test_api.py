@@ -0,0 +1,67 @@
+"""
+Error handling of the HTTP fitting API on malformed payloads.
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+import numpy as np  # noqa: E402
+import api  # noqa: E402
+from ojip_core import FitPipeline  # noqa: E402
+from synthetic import synthetic_trace  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    flask = pytest.importorskip("flask")
+    server = flask.Flask(__name__)
+    api.register_api(server, FitPipeline())
+    return server.test_client()
+
+
+def test_non_numeric_json_is_a_bad_request(client):
+    payload = {"time": ["a", "b", "c"], "fluorescence": [1, 2, 3]}
+    response = client.post("/api/fit", data=json.dumps(payload), content_type="application/json")
+    assert response.status_code == 400
+    assert "time" in response.get_json()["error"]
+
+
+def test_malformed_arrays_are_rejected():
+    with pytest.raises(api.PayloadError) as error:
+        api.parse_payload("application/json", json.dumps({"time": [0, 1], "fluorescence": [[1], 2]}).encode())
+    assert error.value.status == 400
+    with pytest.raises(api.PayloadError) as error:
+        api._trace({"time": b"\0"*12, "fluorescence": b"\0"*16}, {})
+    assert error.value.status == 400
+
+
+def test_truncated_msgpack_bytes_is_a_bad_request(client):
+    msgpack = pytest.importorskip("msgpack")
+    payload = msgpack.packb({"time": b"\0"*12, "fluorescence": b"\0"*12})
+    response = client.post("/api/fit", data=payload, content_type="application/msgpack")
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("mode", ["mvgavg", "logbin"])
+def test_failed_fit_is_reported_per_trace(client, mode):
+    t, y, _ = synthetic_trace(10**5, seed=0)
+    payload = {"traces": [{"time": t.tolist(), "fluorescence": np.ones_like(y).tolist(), "mode": mode},
+                          {"time": t.tolist(), "fluorescence": y.tolist(), "mode": mode}]}
+    response = client.post("/api/fit", data=json.dumps(payload), content_type="application/json")
+    assert response.status_code == 200
+    flat, rise = response.get_json()["results"]
+    assert flat["error"] and "tau" not in flat
+    assert rise["error"] is None and rise["tau"] > 0
+
+
+def test_unexpected_fit_error_is_reported_per_trace():
+    class FailingPipeline(FitPipeline):
+        def run(self, *args, **kwargs):
+            raise RuntimeError("solver failure")
+
+    trace = api._trace({"time": [0.0, 1.0], "fluorescence": [0.0, 1.0]}, {})
+    assert api.fit_payload(FailingPipeline(), trace)["error"] == "RuntimeError: solver failure"
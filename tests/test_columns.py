@@ -0,0 +1,42 @@
+"""
+The vectorized fit of the columns of a table against fit_trace of each column.
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+from ojip_core import fit_columns, fit_trace, pre_process, pre_process_columns  # noqa: E402
+from synthetic import synthetic_trace  # noqa: E402
+
+
+def columns():
+    """ time and columns of the same rise with other amplitudes, blanks and noise: the columns cross
+    10% of their maximum at the same sample, so that their common cut is the cut of each one"""
+    t, rise, _ = synthetic_trace(10**5, noise=0.0, seed=0)
+    rng = np.random.default_rng(1)
+    fluo = np.stack([a*rise + b + rng.normal(0, 0.004*a, rise.size)
+                     for a, b in [(1, 0), (2.5, 0.1), (0.7, -0.05), (1.8, 0.3)]], axis=1)
+    return t, fluo
+
+
+def test_pre_process_columns_matches_pre_process():
+    t, fluo = columns()
+    t_columns, Y = pre_process_columns(t, fluo)
+    for i in range(fluo.shape[1]):
+        t_fit, y_fit = pre_process(t, fluo[:, i])
+        np.testing.assert_allclose(t_columns, t_fit, rtol=1e-12)
+        np.testing.assert_allclose(Y[:, i], y_fit, rtol=1e-12, atol=1e-14)
+
+
+def test_fit_columns_matches_fit_trace():
+    t, fluo = columns()
+    result = fit_columns(t, fluo)
+    for i in range(fluo.shape[1]):
+        expected = fit_trace(t, fluo[:, i])
+        np.testing.assert_allclose(result["tau_JC"][i], expected["tau_JC"], rtol=1e-5)
+        np.testing.assert_allclose(result["params_JC"][i], expected["params_JC"], rtol=1e-5)
+        np.testing.assert_allclose(result["params_exp"][i], expected["params_exp"], rtol=1e-5)
+        np.testing.assert_allclose(result["y_JC"][:, i], expected["y_JC"], rtol=1e-6)
@@ -0,0 +1,62 @@
+"""
+Analytic Jacobians of the fitted models against finite differences.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+from ojip_core import ResidualsWithJacobian, exp_decay, exp_decay_jac, jc_initial_guess, residuals, \
+    sigmoidal_OJIP, sigmoidal_OJIP_jac  # noqa: E402
+from synthetic import DEFAULT_PARAMETERS  # noqa: E402
+
+T = np.concatenate([[0], np.logspace(-5, 0, 300)])
+
+CASES = [(sigmoidal_OJIP, sigmoidal_OJIP_jac, np.array(DEFAULT_PARAMETERS)),
+         (sigmoidal_OJIP, sigmoidal_OJIP_jac, np.array(jc_initial_guess(np.linspace(0.3, 1.0, 10)))),
+         (exp_decay, exp_decay_jac, np.array([0.35, 3e-4, 0.3])),
+         (exp_decay, exp_decay_jac, np.array([1.0, 0.05, -0.1]))]
+
+
+def central_differences(func, P, t, rel_step=1e-7):
+    #steps relative to each parameter: the rates and taus span orders of magnitude
+    J = np.empty((t.size, P.size))
+    for i in range(P.size):
+        h = rel_step*max(abs(P[i]), 1e-12)
+        dP = np.zeros_like(P)
+        dP[i] = h
+        J[:, i] = (func(P + dP, t) - func(P - dP, t))/(2*h)
+    return J
+
+
+@pytest.mark.parametrize("func, model_jac, P", CASES)
+def test_jacobian_matches_finite_differences(func, model_jac, P):
+    y, J = model_jac(P, T)
+    np.testing.assert_allclose(y, func(P, T), rtol=1e-12, atol=1e-15)
+    assert np.all(np.isfinite(J))
+    J_fd = central_differences(func, P, T)
+    #relative to the largest value of each column
+    scale = np.abs(J_fd).max(axis=0)
+    np.testing.assert_allclose(J/scale, J_fd/scale, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize("func, model_jac, P", CASES[::2])
+def test_batched_jacobian(func, model_jac, P):
+    batch = P*np.array([[1.0], [1.1], [0.9]])
+    y, J = model_jac(batch, T)
+    for row, y_row, J_row in zip(batch, y, J):
+        y_ref, J_ref = model_jac(row, T)
+        np.testing.assert_array_equal(y_row, y_ref)
+        np.testing.assert_array_equal(J_row, J_ref)
+
+
+def test_weighted_residuals_with_jacobian():
+    P = np.array(DEFAULT_PARAMETERS)
+    y = sigmoidal_OJIP(P*1.01, T)
+    sigma = np.linspace(0.01, 0.02, T.size)
+    evaluator = ResidualsWithJacobian(sigmoidal_OJIP, sigma)
+    np.testing.assert_allclose(evaluator.residuals(P, T, y), residuals(P, T, y, sigmoidal_OJIP, sigma), rtol=1e-12)
+    np.testing.assert_allclose(evaluator.jac(P, T, y), sigmoidal_OJIP_jac(P, T)[1]/sigma[:, None], rtol=1e-12)
@@ -0,0 +1,58 @@
+"""
+The fused sigmoidal_OJIP kernel against the reference residuals and Jacobian.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+import kernels  # noqa: E402
+from ojip_core import JC_BOUNDS, jc_initial_guess, residuals, sigmoidal_OJIP, \
+    sigmoidal_OJIP_jac  # noqa: E402
+from synthetic import DEFAULT_PARAMETERS  # noqa: E402
+
+BACKENDS = ["numpy"] + (["numba"] if kernels.numba_kernel() is not None else [])
+
+
+def trace(n=2000):
+    t = np.concatenate([[0], np.logspace(-5, 0, n - 1)])
+    y = sigmoidal_OJIP(np.array(DEFAULT_PARAMETERS), t) + np.random.default_rng(0).normal(0, 0.005, n)
+    return t, y, np.full(n, 0.005)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("weighted", [False, True])
+def test_fused_kernel_matches_reference(backend, weighted):
+    t, y, sigma = trace()
+    sigma = sigma if weighted else None
+    fused = kernels.FusedResiduals(sigma, backend=backend)
+    for P in (np.array(DEFAULT_PARAMETERS), np.array(jc_initial_guess(y))):
+        res = residuals(P, t, y, sigmoidal_OJIP, sigma)
+        J = sigmoidal_OJIP_jac(P, t)[1]/(1 if sigma is None else sigma[:, None])
+        np.testing.assert_allclose(fused.residuals(P, t, y), res, rtol=0, atol=1e-12*np.abs(res).max())
+        np.testing.assert_allclose(fused.jac(P, t, y), J, rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("method", ["trf", "dogbox"])
+@pytest.mark.parametrize("tr_solver", ["exact", "lsmr"])
+def test_fit_with_workspace_views(backend, method, tr_solver):
+    #the fit on the workspace arrays is the fit on copies of them, step for step
+    from scipy import optimize
+
+    t, y, sigma = trace()
+    x0 = np.array(jc_initial_guess(y))
+    options = dict(bounds=JC_BOUNDS, args=(t, y), method=method, tr_solver=tr_solver)
+    fused = kernels.FusedResiduals(sigma, backend=backend)
+    result = optimize.least_squares(fused.residuals, x0, jac=fused.jac, **options)
+    copied = kernels.FusedResiduals(sigma, backend=backend)
+    expected = optimize.least_squares(lambda *args: np.copy(copied.residuals(*args)), x0,
+                                      jac=lambda *args: np.copy(copied.jac(*args)), **options)
+    np.testing.assert_array_equal(result.x, expected.x)
+    assert result.nfev == expected.nfev
+    #the returned arrays are those of the solution, not of a later trial step
+    np.testing.assert_allclose(result.fun, residuals(result.x, t, y, sigmoidal_OJIP, sigma), atol=1e-9)
+    np.testing.assert_allclose(result.jac, sigmoidal_OJIP_jac(result.x, t)[1]/sigma[:, None], rtol=1e-9, atol=1e-9)
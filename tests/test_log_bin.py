@@ -0,0 +1,41 @@
+"""
+Logarithmic binning of the fluorescence rise.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+from ojip_core import log_bin  # noqa: E402
+from synthetic import synthetic_trace  # noqa: E402
+
+
+def brute_force_bins(t, y, counts):
+    """ bin means and standard errors recomputed bin by bin from the counts of log_bin"""
+    blank = np.mean(y[:10])
+    start = np.flatnonzero(y > blank + 0.1*(y.max() - blank))[0]
+    bins_t = np.split(t[start:], np.cumsum(counts)[:-1])
+    bins_y = np.split(y[start:] - blank, np.cumsum(counts)[:-1])
+    std = np.array([np.std(b, ddof=1) if len(b) > 1 else np.nan for b in bins_y])
+    std[counts == 1] = np.median(std[counts > 1])
+    return (np.array([b.mean() for b in bins_t]) - t[start], np.array([b.mean() for b in bins_y]),
+            std/np.sqrt(counts))
+
+
+@pytest.mark.parametrize("chunk", [2**20, 1000])
+def test_log_bin_matches_brute_force(chunk):
+    t, y, _ = synthetic_trace(10**5, seed=1)
+    t_bin, y_bin, counts, sem = log_bin(t, y, N_log=500, chunk=chunk)
+    assert counts.sum() == len(t) - np.flatnonzero(y > np.mean(y[:10]) + 0.1*(y.max() - np.mean(y[:10])))[0]
+    t_ref, y_ref, sem_ref = brute_force_bins(t, y, counts)
+    np.testing.assert_allclose(t_bin, t_ref, rtol=1e-12, atol=1e-15)
+    np.testing.assert_allclose(y_bin, y_ref, rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(sem, sem_ref, rtol=1e-6)
+
+
+def test_log_bin_flat_trace():
+    with pytest.raises(ValueError, match="no fluorescence rise"):
+        log_bin(np.linspace(0, 1, 1000), np.ones(1000))
@@ -0,0 +1,33 @@
+"""
+Memory bound of the cached fit stages.
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+from ojip_core import FitPipeline, LRUCache  # noqa: E402
+from synthetic import synthetic_trace  # noqa: E402
+
+
+def test_lru_cache_bounded_by_bytes():
+    cache = LRUCache(64, max_bytes=3*800)
+    for i in range(5):
+        cache.put(i, (np.zeros(100), np.zeros(0)))
+    assert len(cache) == 3 and cache.nbytes == 3*800
+    assert cache.get(1) is None and cache.get(4) is not None
+    #an entry above the budget is still kept, alone
+    cache.put("large", {"t": np.zeros(1000)})
+    assert len(cache) == 1 and cache.get("large") is not None
+
+
+def test_pipeline_cache_stays_within_budget():
+    pipeline = FitPipeline(max_bytes=2*2**20)
+    t, y, _ = synthetic_trace(10**5, seed=0)
+    table = {"time": t, "fluorescence": y}
+    for N_log in (500, 1000):
+        for mode in ("mvgavg", "logbin"):
+            pipeline.run("trace", table, "time", "fluorescence", N_log = N_log, mode = mode)
+            assert pipeline.cache.nbytes <= 2*2**20
@@ -0,0 +1,42 @@
+"""
+The results store only creates its database with the first record.
+"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+from results import ResultsStore  # noqa: E402
+
+
+def test_store_created_by_first_append(tmp_path):
+    path = str(tmp_path/"results.sqlite")
+    store = ResultsStore(path)
+    settings = dict(input_hash="abc", time_column="time", fluo_column="fluo", N_mvg=10, N_log=1000)
+    assert store.find(**settings) is None
+    assert store.history() == [] and store.setups() == []
+    assert not os.path.exists(path)
+
+    store.append(dict(settings, mode="mvgavg", method="trf", ci="covariance", params_JC=[1.0, 2.0], tau=1e-3))
+    assert os.path.exists(path)
+    assert store.find(**settings)["params_JC"] == [1.0, 2.0]
+    assert ResultsStore(path).setups() == ["default"]
+
+
+def test_replace_keeps_the_last_fit_of_a_file(tmp_path):
+    store = ResultsStore(str(tmp_path/"results.sqlite"))
+    columns = dict(input_hash="abc", time_column="time", fluo_column="fluo", source="app", setup="bench")
+    for N_log in (500, 1000, 2000):
+        store.replace(dict(columns, N_mvg=10, N_log=N_log, mode="mvgavg", method="trf", ci="covariance", tau=1e-3))
+    store.replace(dict(columns, input_hash="def", N_mvg=10, N_log=1000, tau=2e-3))
+    store.append(dict(columns, source="batch", N_mvg=10, N_log=1000, tau=3e-3))
+    history = store.history("bench")
+    assert [(r["input_hash"], r["source"], r["N_log"]) for r in history] == \
+        [("abc", "app", 2000), ("def", "app", 1000), ("abc", "batch", 1000)]
+
+
+def test_app_import_creates_no_database(tmp_path):
+    env = dict(os.environ, OJIP_RESULTS_DB=str(tmp_path/"results.sqlite"))
+    subprocess.run([sys.executable, "-c", "import OJIP_fit"], cwd=ROOT, env=env, check=True, capture_output=True)
+    assert not os.path.exists(tmp_path/"results.sqlite")
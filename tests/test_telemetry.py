@@ -0,0 +1,31 @@
+"""
+Routes added to the Flask server by telemetry.instrument_server.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import telemetry  # noqa: E402
+
+
+def client(**kwargs):
+    flask = pytest.importorskip("flask")
+    server = flask.Flask(__name__)
+    telemetry.instrument_server(server, telemetry.Metrics(), **kwargs)
+    return server.test_client()
+
+
+def test_profile_route_only_with_the_flag():
+    assert client().get("/debug/profile").status_code == 404
+    assert not telemetry._profile_next.is_set()
+    assert client(profile=True).get("/debug/profile").status_code == 200
+    assert telemetry._profile_next.is_set()
+    telemetry._profile_next.clear()
+
+
+def test_metrics_route():
+    response = client().get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
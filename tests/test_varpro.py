@@ -0,0 +1,30 @@
+"""
+Variable projection against the default trf fit.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+from ojip_core import fit_trace  # noqa: E402
+from synthetic import synthetic_trace  # noqa: E402
+
+
+@pytest.mark.parametrize("jac", [True, False, "2-point", "3-point"])
+@pytest.mark.parametrize("mode", ["mvgavg", "logbin"])
+def test_varpro_tau_matches_trf(jac, mode):
+    t, y, _ = synthetic_trace(10**5, seed=0)
+    tau_trf = fit_trace(t, y, jac=jac, mode=mode)["params_exp"][1]
+    tau_varpro = fit_trace(t, y, jac=jac, mode=mode, method="varpro")["params_exp"][1]
+    assert np.isclose(tau_varpro, tau_trf, rtol=1e-3)
+
+
+@pytest.mark.parametrize("method", ["trf", "varpro"])
+def test_unresolved_rise_raises_value_error(method):
+    #1e4 samples over 1 s leave a single averaged point in the O-J phase
+    t, y, _ = synthetic_trace(10**4, seed=0)
+    with pytest.raises(ValueError, match="too coarse"):
+        fit_trace(t, y, method=method)